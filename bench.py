@@ -0,0 +1,357 @@
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+# Микробенчмарки горячих путей состояния и сохранения на синтетических игроках.
+# Сеть не нужна: main.py импортируется с фиктивным токеном, файлы пишутся во временный каталог.
+# Каждая строка вывода — JSON с результатом одного бенчмарка на одном размере:
+#   python bench.py --sizes 1000,10000 --out before.jsonl
+#   python bench.py --sizes 1000,10000 --compare before.jsonl
+# per_op_us — медиана по повторам, peak_alloc_kb — пик выделений за один прогон (tracemalloc),
+# rss_mb — максимальный RSS процесса к концу бенчмарка.
+
+SAMPLE = 2000  # Сколько операций в одном прогоне для поштучных бенчмарков
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Микробенчмарки состояния и сохранения")
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000", help="Число игроков через запятую")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", help="Запустить только эти бенчмарки (через запятую)")
+    parser.add_argument("--out", help="Дописать результаты в этот файл (JSON-строки)")
+    parser.add_argument("--compare", help="Файл с прошлыми результатами: вывести отношение времени")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def rss_mb():
+    # ru_maxrss: килобайты в Linux, байты в macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+# ====================== СИНТЕТИЧЕСКИЕ ДАННЫЕ ======================
+def synthetic_user(rng, clan, today):
+    costumes = rng.sample(["ghost", "vampire", "freddy", "jason"], rng.randint(0, 3))
+    total = rng.randint(10, 20000)
+    return {
+        "candies": rng.randint(0, total),
+        "total_candies": total,
+        "last_claim": (datetime.now(timezone.utc) - timedelta(hours=rng.randint(1, 72))).isoformat() if rng.random() < 0.7 else None,
+        "costume": costumes[0] if costumes else None,
+        "owned_costumes": costumes,
+        "active_potions": {"perm_boost": 2} if rng.random() < 0.1 else {},
+        "owned_potions": ["temp_boost"] * rng.randint(0, 2),
+        "licorice": rng.randint(0, 3),
+        "challenges": {"steal": rng.randint(0, 5), "give": rng.randint(0, 50), "buy": rng.randint(0, 3)},
+        "last_challenge_reset": today,
+        "duel_wins": rng.randint(0, 30),
+        "attacks_today": rng.randint(0, 10),
+        "last_attack_date": today,
+        "buys_today": rng.randint(0, 3),
+        "last_buy_date": today,
+        "gives_today": rng.randint(0, 50),
+        "last_give_date": today,
+        "clan": clan,
+    }
+
+
+def populate(bm, size, rng):
+    # Треть игроков в кланах, в среднем ~17 человек на клан (меньше MAX_CLAN_MEMBERS)
+    bm.candies.clear()
+    bm._dirty.clear()
+    clans = {}
+    today = datetime.now(timezone.utc).date().isoformat()
+    n_clans = max(10, size // 50)
+    for i in range(size):
+        uid = str(10 ** 9 + i)
+        clan = f"Клан {i % n_clans}" if i % 3 == 0 else None
+        if clan is not None:
+            data = clans.get(clan)
+            if data is None:
+                clans[clan] = {"owner": uid, "members": [], "candies": 0, "licorice": rng.randint(0, 5)}
+            else:
+                data["members"].append(uid)
+        user = bm.UserRecord.from_dict(synthetic_user(rng, clan, today))
+        bm.candies[uid] = user
+        if clan is not None:
+            clans[clan]["candies"] += user.total_candies
+    bm.clans.load(clans)
+    bm.rebuild_leaderboards()
+
+
+def sample_uids(bm, rng, count, predicate=None):
+    uids = [uid for uid, user in bm.candies.items() if predicate is None or predicate(user)]
+    return rng.sample(uids, min(count, len(uids)))
+
+
+# ====================== БЕНЧМАРКИ ======================
+# Каждый возвращает (prepare, run, ops): prepare() — подготовка без замера перед каждым прогоном,
+# run() — замеряемая часть, ops — число операций в одном прогоне.
+
+def bench_save_json_full(bm, rng):
+    changes = [("user", uid, user) for uid, user in bm.candies.items()]
+    changes += [("clan", name, clan) for name, clan in bm.clans.items()]
+    return None, lambda: bm.json_store.write(bm.encode_changes(bm.snapshot(changes))), 1
+
+
+def bench_save_json_dirty_1pct(bm, rng):
+    uids = sample_uids(bm, rng, max(1, len(bm.candies) // 100))
+    changes = [("user", uid, bm.candies[uid]) for uid in uids]
+    return None, lambda: bm.json_store.write(bm.encode_changes(bm.snapshot(changes))), 1
+
+
+def bench_load_json(bm, rng):
+    # Как load_state: чтение файлов + сборка UserRecord
+    def run():
+        state = bm.json_store.load()
+        return {uid: bm.UserRecord.from_dict(user) for uid, user in state["user"].items()}
+    return None, run, 1
+
+
+def bench_get_user_data(bm, rng):
+    uids = sample_uids(bm, rng, SAMPLE)
+    for uid in uids:
+        bm.get_user_data(uid)
+
+    def run():
+        for uid in uids:
+            bm.get_user_data(uid)
+    return bm._dirty.clear, run, len(uids)
+
+
+def bench_get_user_data_reset(bm, rng):
+    # Первое обращение за день: сброс дневных счётчиков
+    uids = sample_uids(bm, rng, SAMPLE)
+
+    def prepare():
+        bm._dirty.clear()
+        for uid in uids:
+            user = bm.candies[uid]
+            user.reset_day = user.last_attack_date = user.last_buy_date = None
+            user.last_give_date = user.last_challenge_reset = None
+
+    def run():
+        for uid in uids:
+            bm.get_user_data(uid)
+    return prepare, run, len(uids)
+
+
+def bench_add_candies_clan(bm, rng):
+    uids = sample_uids(bm, rng, SAMPLE, lambda user: user.clan is not None)
+
+    def run():
+        for uid in uids:
+            bm.add_candies(uid, 1)
+    return bm._dirty.clear, run, len(uids)
+
+
+def bench_get_current_bonus_temp_boost(bm, rng):
+    uids = sample_uids(bm, rng, SAMPLE, lambda user: user.costume is not None)
+    expires = (datetime.now(timezone.utc) + timedelta(hours=1)).isoformat()
+    for uid in uids:
+        bm.candies[uid]["active_potions"]["temp_boost"] = expires
+
+    def run():
+        for uid in uids:
+            bm.get_current_bonus(uid)
+    return bm._dirty.clear, run, len(uids)
+
+
+def bench_top(bm, rng):
+    return None, lambda: bm.user_ranks.top(5), 1
+
+
+def bench_top_full_sort(bm, rng):
+    # Прежний /top: полная сортировка всех игроков — для сравнения с индексом
+    return None, lambda: sorted(bm.candies.items(), key=lambda item: item[1]["total_candies"], reverse=True)[:5], 1
+
+
+def bench_player_rank(bm, rng):
+    # Место и число игроков для /profile
+    uids = sample_uids(bm, rng, SAMPLE)
+
+    def run():
+        for uid in uids:
+            bm.player_rank(uid)
+    return None, run, len(uids)
+
+
+def bench_top_clans(bm, rng):
+    return None, lambda: [(name, bm.clans[name]) for name, _ in bm.clan_ranks.top(5)], 1
+
+
+def bench_top_clans_full_sort(bm, rng):
+    return None, lambda: sorted(bm.clans.items(), key=lambda item: item[1]["candies"], reverse=True)[:5], 1
+
+
+def bench_clan_find(bm, rng):
+    # Поиск клана по тексту игрока: лишние пробелы и другой регистр
+    names = [f"  {name.upper()} " for name in rng.sample(list(bm.clans), min(SAMPLE, len(bm.clans)))]
+
+    def run():
+        for name in names:
+            bm.clans.find(name)
+    return None, run, len(names)
+
+
+def bench_clan_of(bm, rng):
+    # Прежде «в каком клане игрок» без поля clan — перебор всех кланов
+    uids = sample_uids(bm, rng, SAMPLE)
+
+    def run():
+        for uid in uids:
+            bm.clans.clan_of(uid)
+    return None, run, len(uids)
+
+
+def bench_add_chat(bm, rng):
+    # Команда из уже известного чата; реестр размером с число игроков
+    now = time.time()
+    bm.active_chats.load({str(-10 ** 12 - i): {"seen": now - rng.randint(0, 86400)} for i in range(len(bm.candies))})
+    chat_ids = rng.sample(list(bm.active_chats), min(SAMPLE, len(bm.active_chats)))
+
+    def run():
+        for chat_id in chat_ids:
+            bm.add_chat(chat_id)
+    return bm._dirty.clear, run, len(chat_ids)
+
+
+
+def bench_shop_keyboard(bm, rng):
+    # Клавиатура /shop для случайных игроков: ключ кэша — маска костюмов и клан
+    users = [bm.candies[uid] for uid in sample_uids(bm, rng, SAMPLE)]
+
+    def run():
+        for user in users:
+            bm.shop_keyboard(user.costume_mask(), bool(user["clan"]))
+    return None, run, len(users)
+
+
+BENCHES = {
+    "save_json_full": bench_save_json_full,
+    "save_json_dirty_1pct": bench_save_json_dirty_1pct,
+    "load_json": bench_load_json,
+    "get_user_data": bench_get_user_data,
+    "get_user_data_reset": bench_get_user_data_reset,
+    "add_candies_clan": bench_add_candies_clan,
+    "get_current_bonus_temp_boost": bench_get_current_bonus_temp_boost,
+    "top": bench_top,
+    "top_full_sort": bench_top_full_sort,
+    "player_rank": bench_player_rank,
+    "top_clans": bench_top_clans,
+    "top_clans_full_sort": bench_top_clans_full_sort,
+    "clan_find": bench_clan_find,
+    "clan_of": bench_clan_of,
+    "add_chat": bench_add_chat,
+    "shop_keyboard": bench_shop_keyboard,
+}
+
+
+def measure(prepare, run, ops, repeat):
+    times = []
+    for _ in range(repeat):
+        if prepare:
+            prepare()
+        start = time.perf_counter()
+        run()
+        times.append((time.perf_counter() - start) / ops)
+    times.sort()
+    # Отдельный прогон под tracemalloc: он замедляет код, поэтому во время не идёт
+    if prepare:
+        prepare()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    run()
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return times, peak
+
+
+def run_benchmarks(bm, args):
+    names = args.only.split(",") if args.only else list(BENCHES)
+    commit = git_commit()
+    bm.json_store.load()  # Как при запуске бота: создаёт каталог шардов
+    for size in (int(size) for size in args.sizes.split(",")):
+        rng = random.Random(args.seed)
+        start = time.perf_counter()
+        populate(bm, size, rng)
+        print(f"# {size} игроков подготовлено за {time.perf_counter() - start:.1f} с", file=sys.stderr)
+        for name in names:
+            prepare, run, ops = BENCHES[name](bm, rng)
+            times, peak = measure(prepare, run, ops, args.repeat)
+            yield {
+                "bench": name, "size": size, "ops": ops, "repeat": args.repeat,
+                "per_op_us": round(times[len(times) // 2] * 1e6, 3),
+                "min_us": round(times[0] * 1e6, 3),
+                "peak_alloc_kb": round(peak / 1024, 1),
+                "rss_mb": rss_mb(),
+                "commit": commit, "python": platform.python_version(),
+            }
+        bm._dirty.clear()
+
+
+def compare(results, path):
+    # Если в файле несколько прогонов, берётся последний
+    baseline = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                row = json.loads(line)
+                baseline[(row["bench"], row["size"])] = row
+    print("\nбенчмарк / размер: было → стало мкс (отношение)", file=sys.stderr)
+    for row in results:
+        old = baseline.get((row["bench"], row["size"]))
+        if old:
+            ratio = row["per_op_us"] / old["per_op_us"] if old["per_op_us"] else float("inf")
+            print(f"{row['bench']} / {row['size']}: {old['per_op_us']} → {row['per_op_us']} ({ratio:.2f}×)", file=sys.stderr)
+
+
+def main():
+    args = parse_args()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(tempfile.mkdtemp(prefix="bench-"))
+    os.environ.setdefault("API_TOKEN", "123456:BENCH")
+    os.environ["STORAGE_MODE"] = "json"
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    import main as bot_main
+
+    out = open(args.out, "a", encoding="utf-8") if args.out else None
+    results = []
+    try:
+        for row in run_benchmarks(bot_main, args):
+            results.append(row)
+            line = json.dumps(row, ensure_ascii=False)
+            print(line, flush=True)
+            if out:
+                out.write(line + "\n")
+                out.flush()
+    finally:
+        if out:
+            out.close()
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import asyncio
+import json
+import logging
+import time
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+
+from storage import atomic_write
+
+DEAD_CHAT_ERRORS = ("chat not found", "bot was kicked", "bot is not a member", "group chat was deleted")
+# Бот в чате, но писать ему не дают; права могут вернуть
+DENIED_CHAT_ERRORS = ("not enough rights", "have no rights", "chat_write_forbidden", "need administrator rights")
+
+
+def is_dead_chat(error):
+    # Бота выгнали или заблокировали, чата нет — это окончательно
+    if isinstance(error, TelegramForbiddenError):
+        return True
+    return isinstance(error, TelegramBadRequest) and any(text in str(error).lower() for text in DEAD_CHAT_ERRORS)
+
+
+def is_denied_chat(error):
+    return isinstance(error, TelegramBadRequest) and any(text in str(error).lower() for text in DENIED_CHAT_ERRORS)
+
+
+# Рассылка по всем чатам фоновой задачей. Сообщения уходят через RateLimitedSender
+# пачками по batch штук; после каждой пачки позиция сохраняется в path,
+# так что после перезапуска рассылка продолжается с места остановки.
+# on_chat_error(chat_id, error) — корутина, ошибка отправки в чат; возвращает True, если чат удалён из списка.
+class Broadcast:
+    def __init__(self, bot, sender, path, on_chat_error, batch=100, progress_every=5.0):
+        self.bot = bot
+        self.sender = sender
+        self.path = path
+        self.on_chat_error = on_chat_error
+        self.batch = batch
+        self.progress_every = progress_every
+        self.job = None
+        self._task = None
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def status_text(self):
+        job = self.job
+        if not job:
+            return "Рассылок не было."
+        state = "завершена" if job["pos"] >= len(job["chats"]) else "идёт" if self.running else "прервана"
+        return (
+            f"Рассылка {state}: {job['pos']}/{len(job['chats'])}\n"
+            f"Доставлено: {job['sent']}, ошибок: {job['failed']}, удалено чатов: {job['dropped']}"
+        )
+
+    def start(self, text, chats, admin_chat_id, progress_message_id=None):
+        self.job = {
+            "text": text, "chats": list(chats), "pos": 0,
+            "sent": 0, "failed": 0, "dropped": 0,
+            "admin_chat": admin_chat_id, "progress_message": progress_message_id,
+            "started": time.time(),
+        }
+        self._task = asyncio.create_task(self._run())
+
+    def resume(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                job = json.load(f)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logging.error(f"Ошибка загрузки рассылки {self.path}: {e}")
+            return False
+        self.job = job
+        if job["pos"] >= len(job["chats"]):
+            return False
+        logging.warning(f"Продолжаем рассылку с {job['pos']}/{len(job['chats'])}")
+        self._task = asyncio.create_task(self._run())
+        return True
+
+    async def _checkpoint(self):
+        try:
+            await asyncio.to_thread(atomic_write, self.path, json.dumps(self.job, ensure_ascii=False))
+        except Exception as e:
+            logging.error(f"Ошибка сохранения рассылки {self.path}: {e}")
+
+    async def _report(self, final=False):
+        job = self.job
+        text = self.status_text()
+        if final:
+            text += f"\nВремя: {int(time.time() - job['started'])} с"
+        try:
+            if job.get("progress_message"):
+                await self.bot.edit_message_text(text, chat_id=job["admin_chat"], message_id=job["progress_message"])
+            else:
+                message = await self.bot.send_message(job["admin_chat"], text)
+                job["progress_message"] = message.message_id
+        except Exception as e:
+            logging.error(f"Ошибка отчёта о рассылке: {e}")
+
+    async def _run(self):
+        job = self.job
+        chats = job["chats"]
+        last_report = 0.0
+        await self._checkpoint()
+        while job["pos"] < len(chats):
+            chunk = chats[job["pos"]:job["pos"] + self.batch]
+            futures = [self.sender.submit(chat_id, job["text"]) for chat_id in chunk]
+            results = await asyncio.gather(*futures, return_exceptions=True)
+            for chat_id, result in zip(chunk, results):
+                if not isinstance(result, Exception):
+                    job["sent"] += 1
+                elif await self.on_chat_error(chat_id, result):
+                    job["dropped"] += 1
+                else:
+                    job["failed"] += 1
+                    logging.error(f"Рассылка: ошибка для чата {chat_id}: {result}")
+            job["pos"] += len(chunk)
+            await self._checkpoint()
+            if time.monotonic() - last_report >= self.progress_every:
+                last_report = time.monotonic()
+                await self._report()
+        await self._report(final=True)
+        await self._checkpoint()
+        logging.warning(f"Рассылка завершена: {self.status_text()}")
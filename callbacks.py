@@ -0,0 +1,50 @@
+from enum import Enum
+from aiogram.filters.callback_data import CallbackData
+
+# callback_data кнопок: префикс с номером версии, поля через ":" — "b1:p:temp_boost".
+# Разбор и проверку типов делает aiogram (CallbackData.filter): неизвестный префикс, не то число полей
+# или значение не из перечисления — кнопка просто не совпадает с обработчиком и попадает в stale_button.
+# Изменился набор полей — поднимаем версию в префиксе, кнопки старых сообщений перестают совпадать.
+# Кто жмёт и с кем дуэль/«сладость», в кнопку не пишется: это знает запись ожидающего сообщения (pending).
+
+
+class Item(str, Enum):
+    COSTUME = "c"
+    POTION = "p"
+    LICORICE = "l"
+    CLAN_LICORICE = "cl"
+
+
+class Move(str, Enum):
+    ROCK = "r"
+    SCISSORS = "s"
+    PAPER = "p"
+
+
+class ClanAction(str, Enum):
+    CREATE = "c"
+    JOIN = "j"
+    LEAVE = "l"
+    DISBAND = "d"
+
+
+class Buy(CallbackData, prefix="b1"):
+    item: Item
+    key: str = ""  # Ключ костюма / зелья; у лакрицы пусто
+
+
+class Use(CallbackData, prefix="u1"):
+    item: Item
+    key: str
+
+
+class Trick(CallbackData, prefix="t1"):
+    sweet: bool
+
+
+class Duel(CallbackData, prefix="d1"):
+    move: Move
+
+
+class Clan(CallbackData, prefix="k1"):
+    action: ClanAction
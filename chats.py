@@ -0,0 +1,116 @@
+import time
+from collections import OrderedDict
+
+# Реестр чатов: упорядоченное множество chat_id с временем последней активности и счётчиком
+# ошибок «нет прав писать» (после «бота нет в чате» чат удаляется сразу). Порядок — по времени активности (давно молчавшие в начале), поэтому
+# недавно активные и устаревшие чаты выбираются с нужного конца без прохода по всему реестру.
+# Время активности обновляется не чаще раза в SEEN_STEP секунд — иначе каждая команда
+# меняла бы запись на диске.
+
+SEEN_STEP = 600
+
+
+class ChatRecord:
+    __slots__ = ("seen", "fails")
+
+    def __init__(self, seen, fails=0):
+        self.seen = seen  # unix-время последней команды из чата
+        self.fails = fails  # Ошибок «нет прав писать» подряд
+
+    @classmethod
+    def from_dict(cls, data, now):
+        # Старый формат — просто true: когда чат был активен, неизвестно, считаем, что сейчас
+        if not isinstance(data, dict):
+            return cls(now)
+        return cls(data.get("seen", now), data.get("fails", 0))
+
+    def to_dict(self):
+        data = {"seen": int(self.seen)}
+        if self.fails:
+            data["fails"] = self.fails
+        return data
+
+
+class ChatRegistry:
+    def __init__(self, max_failures=3):
+        self.max_failures = max_failures
+        self._chats = OrderedDict()  # chat_id -> ChatRecord, по возрастанию seen
+
+    def __contains__(self, chat_id):
+        return chat_id in self._chats
+
+    def __iter__(self):
+        return iter(self._chats)
+
+    def __len__(self):
+        return len(self._chats)
+
+    def get(self, chat_id):
+        return self._chats.get(chat_id)
+
+    def load(self, data, now=None):
+        # data — {"chat_id": запись из хранилища}
+        now = now or time.time()
+        records = [(int(chat_id), ChatRecord.from_dict(value, now)) for chat_id, value in data.items()]
+        records.sort(key=lambda item: item[1].seen)
+        self._chats = OrderedDict(records)
+
+    def touch(self, chat_id, now=None):
+        # Команда из чата. True — запись новая или изменилась и её нужно сохранить
+        now = now or time.time()
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            self._chats[chat_id] = ChatRecord(now)
+            return True
+        if now - chat.seen < SEEN_STEP and not chat.fails:
+            return False
+        chat.seen = now
+        chat.fails = 0
+        self._chats.move_to_end(chat_id)
+        return True
+
+    def failed(self, chat_id):
+        # Ошибка «нет прав писать». True — ошибок подряд набралось max_failures
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            return False
+        chat.fails += 1
+        return chat.fails >= self.max_failures
+
+    def delivered(self, chat_id):
+        # Сообщение дошло: счётчик ошибок сбрасывается. True — запись изменилась
+        chat = self._chats.get(chat_id)
+        if chat is None or not chat.fails:
+            return False
+        chat.fails = 0
+        return True
+
+    def remove(self, chat_id):
+        return self._chats.pop(chat_id, None) is not None
+
+    def is_recent(self, chat_id, since):
+        chat = self._chats.get(chat_id)
+        return chat is not None and chat.seen >= since
+
+    def recent(self, since):
+        # Чаты с командами не раньше since — с конца, пока не встретится более старый
+        result = []
+        for chat_id in reversed(self._chats):
+            if self._chats[chat_id].seen < since:
+                break
+            result.append(chat_id)
+        return result
+
+    def stale(self, before):
+        # Чаты без команд с момента before — с начала, пока не встретится более новый
+        result = []
+        for chat_id, chat in self._chats.items():
+            if chat.seen >= before:
+                break
+            result.append(chat_id)
+        return result
+
+
+def chat_worker(chat_id, workers):
+    # Режим воркеров: какой процесс обслуживает чат (ведущий раздаёт апдейты по этому же правилу)
+    return chat_id % workers
@@ -0,0 +1,174 @@
+import sys
+from collections.abc import Mapping
+
+# Кланы: участники — множество, поиск по названию без учёта регистра и лишних пробелов,
+# обратный индекс «игрок → клан». Вступление, выход, роспуск и поиск — O(1) (роспуск — O(участников)).
+# Снаружи ClanIndex — словарь {название: ClanRecord} только для чтения, менять состав — через методы,
+# чтобы обратный индекс не разошёлся с участниками. В файле — прежняя схема clans.json.
+
+
+def normalize_name(name):
+    return " ".join(name.split()).casefold()
+
+
+class ClanRecord:
+    __slots__ = ("owner", "members", "candies", "licorice", "_extra")
+    _PLAIN = frozenset(("owner", "candies", "licorice"))
+
+    def __init__(self, owner, candies=0, licorice=0):
+        self.owner = owner
+        self.members = set()  # Без владельца, как в прежнем списке members
+        self.candies = candies
+        self.licorice = licorice
+        self._extra = None
+
+    def __len__(self):
+        return len(self.members) + 1
+
+    def __getitem__(self, key):
+        if key in self._PLAIN or key == "members":
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self._PLAIN:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def everyone(self):
+        return [self.owner, *self.members]
+
+    @classmethod
+    def from_dict(cls, data):
+        clan = cls(str(data["owner"]), data.get("candies", 0), data.get("licorice", 0))
+        clan.members = {sys.intern(str(uid)) for uid in data.get("members", ())}
+        clan.members.discard(clan.owner)
+        extra = {key: value for key, value in data.items() if key not in cls._PLAIN and key != "members"}
+        clan._extra = extra or None
+        return clan
+
+    def to_dict(self):
+        data = {"owner": self.owner, "members": sorted(self.members), "candies": self.candies, "licorice": self.licorice}
+        if self._extra:
+            data.update(self._extra)
+        return data
+
+
+class ClanIndex(Mapping):
+    def __init__(self):
+        self._clans = {}  # название -> ClanRecord
+        self._by_norm = {}  # нормализованное название -> название
+        self._member_of = {}  # uid -> название
+
+    def __getitem__(self, name):
+        return self._clans[name]
+
+    def __iter__(self):
+        return iter(self._clans)
+
+    def __len__(self):
+        return len(self._clans)
+
+    def __contains__(self, name):
+        return name in self._clans
+
+    def find(self, text):
+        # Название, как его ввёл игрок -> точное название клана или None
+        return self._by_norm.get(normalize_name(text))
+
+    def clan_of(self, uid):
+        return self._member_of.get(uid)
+
+    def name_taken(self, name):
+        return normalize_name(name) in self._by_norm
+
+    def load(self, data):
+        # data — {название: dict из файла}; игрок, записанный в два клана, остаётся в первом
+        return self._rebuild({name: ClanRecord.from_dict(raw) for name, raw in data.items()})
+
+    def sync(self, data, keep=()):
+        # Режим воркеров: кланы перечитываются из общей базы, кроме keep — у них несохранённые изменения.
+        # keep идут первыми: при расхождении состава побеждают они
+        records = {name: self._clans[name] for name in keep if name in self._clans}
+        records.update((name, ClanRecord.from_dict(raw)) for name, raw in data.items() if name not in records)
+        return self._rebuild(records)
+
+    def replace(self, name, raw):
+        # Один клан из общей базы (raw=None — его там уже нет); свежий состав важнее прежнего
+        old = self._clans.pop(name, None)
+        if old is not None:
+            for uid in old.everyone():
+                if self._member_of.get(uid) == name:
+                    del self._member_of[uid]
+            if self._by_norm.get(normalize_name(name)) == name:
+                del self._by_norm[normalize_name(name)]
+        if raw is None:
+            return None
+        clan = self._clans[name] = ClanRecord.from_dict(raw)
+        self._by_norm.setdefault(normalize_name(name), name)
+        for uid in clan.everyone():
+            self._member_of[uid] = name
+        return clan
+
+    def _rebuild(self, records):
+        self._clans.clear()
+        self._by_norm.clear()
+        self._member_of.clear()
+        duplicates = []
+        for name, clan in records.items():
+            self._clans[name] = clan
+            self._by_norm.setdefault(normalize_name(name), name)
+            for uid in clan.everyone():
+                if self._member_of.setdefault(uid, name) != name:
+                    duplicates.append((uid, name))
+        for uid, name in duplicates:
+            self._clans[name].members.discard(uid)
+        return duplicates
+
+    def create(self, name, owner):
+        clan = self._clans[name] = ClanRecord(owner)
+        self._by_norm[normalize_name(name)] = name
+        self._member_of[owner] = name
+        return clan
+
+    def join(self, name, uid):
+        self._clans[name].members.add(uid)
+        self._member_of[uid] = name
+
+    def leave(self, uid):
+        # Название клана, из которого вышел игрок, или None
+        name = self._member_of.pop(uid, None)
+        if name is not None:
+            self._clans[name].members.discard(uid)
+        return name
+
+    def disband(self, name):
+        # Удаляет клан, возвращает всех, кто в нём был (с владельцем)
+        clan = self._clans.pop(name)
+        if self._by_norm.get(normalize_name(name)) == name:
+            del self._by_norm[normalize_name(name)]
+        everyone = clan.everyone()
+        for uid in everyone:
+            if self._member_of.get(uid) == name:
+                del self._member_of[uid]
+        return everyone
+
+    def audit(self, users):
+        # Сверка поля clan у игроков с индексом; users — пары (uid, запись игрока).
+        # Возвращает расхождения [(uid, было, должно быть)] — исправляет вызывающий, в пользу индекса
+        return [(uid, user.clan, name) for uid, user in users if user.clan != (name := self._member_of.get(uid))]
+
+    def members(self):
+        return self._member_of.keys()
+
+    def member_totals(self, get_user):
+        # {клан: сумма total_candies участников} — для сверки с казной в /clancheck
+        totals = {}
+        for name, clan in self._clans.items():
+            total = 0
+            for uid in clan.everyone():
+                user = get_user(uid)
+                if user is not None:
+                    total += user.total_candies
+            totals[name] = total
+        return totals
@@ -0,0 +1,99 @@
+import heapq
+import time
+
+
+# Ключи с дедлайнами на монотонных часах и автоматическим истечением.
+# Просроченные записи снимаются с вершины кучи при каждом обращении, так что в памяти
+# остаются только ключи, активные за последние ttl секунд, а не все когда-либо встреченные.
+class Deadlines:
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._deadlines = {}
+        self._heap = []  # (дедлайн, ключ); устаревшие записи пропускаются при снятии
+
+    def expire(self):
+        now = self.clock()
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            deadline, key = heapq.heappop(heap)
+            if self._deadlines.get(key) == deadline:
+                del self._deadlines[key]
+
+    def set(self, key, ttl):
+        self.expire()
+        deadline = self.clock() + ttl
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, key))
+        # Частые продления копят устаревшие записи в куче — периодически пересобираем её
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._heap = [(d, k) for k, d in self._deadlines.items()]
+            heapq.heapify(self._heap)
+
+    touch = set
+
+    def remaining(self, key):
+        deadline = self._deadlines.get(key)
+        if deadline is None:
+            return 0.0
+        left = deadline - self.clock()
+        if left <= 0:
+            self.expire()
+            return 0.0
+        return left
+
+    def claim(self, key, ttl):
+        # Сколько ещё ждать; 0 — дедлайна не было, и он сразу поставлен на ttl
+        left = self.remaining(key)
+        if left <= 0:
+            self.set(key, ttl)
+        return left
+
+    def __contains__(self, key):
+        return self.remaining(key) > 0
+
+    def __len__(self):
+        self.expire()
+        return len(self._deadlines)
+
+    def to_wall(self):
+        # Для сохранения между перезапусками: монотонные дедлайны -> unix-время
+        self.expire()
+        offset = time.time() - self.clock()
+        return {str(key): deadline + offset for key, deadline in self._deadlines.items()}
+
+    def load_wall(self, data):
+        offset = self.clock() - time.time()
+        now = self.clock()
+        for key, wall in data.items():
+            deadline = wall + offset
+            if deadline > now:
+                self._deadlines[key] = deadline
+                self._heap.append((deadline, key))
+        heapq.heapify(self._heap)
+
+
+# То же для режима воркеров: дедлайны в общей базе (SqliteStore, таблица deadlines), в unix-времени.
+# Проверка и установка идут под общей блокировкой игрока или клана (SharedLocks), поэтому
+# кулдаун срабатывает один раз, в каком бы процессе ни обработали команду.
+# Каждый вызов — запрос к базе: из цикла событий их делают через asyncio.to_thread (main.claim_cooldown).
+class SharedDeadlines:
+    def __init__(self, store, kind):
+        self.store = store
+        self.kind = kind
+
+    def set(self, key, ttl):
+        self.store.set_deadline(self.kind, str(key), time.time() + ttl)
+
+    touch = set
+
+    def remaining(self, key):
+        until = self.store.get_deadline(self.kind, str(key))
+        return max(0.0, until - time.time()) if until is not None else 0.0
+
+    claim = Deadlines.claim
+
+    def __contains__(self, key):
+        return self.remaining(key) > 0
+
+    def __len__(self):
+        return self.store.count_deadlines(self.kind)
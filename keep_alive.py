@@ -1,16 +1,18 @@
-from flask import Flask
-from threading import Thread
+from aiohttp import web
 
-app = Flask('')
+# Веб-сервер в том же цикле событий, что и бот: страница для UptimeRobot
+# и, в режиме вебхука, приём апдейтов от Telegram (маршрут добавляет main.py)
 
-@app.route('/')
-def home():
-    return "Bot is alive! 🎃"
+async def home(request):
+    return web.Response(text="Bot is alive! 🎃")
 
-def run():
-    app.run(host='0.0.0.0', port=8080)
+def create_app():
+    app = web.Application()
+    app.router.add_get('/', home)
+    return app
 
-def keep_alive():
-    t = Thread(target=run)
-    t.daemon = True
-    t.start()
+async def keep_alive(app=None, host='0.0.0.0', port=8080):
+    runner = web.AppRunner(app or create_app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
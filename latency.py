@@ -0,0 +1,79 @@
+from collections import deque
+from contextvars import ContextVar
+
+# Время в запросах к Telegram внутри текущего обработчика: [секунды, число запросов]
+_api_time = ContextVar("api_time", default=None)
+
+
+def _percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class _Stats:
+    __slots__ = ("count", "slow", "total", "api")
+
+    def __init__(self, window):
+        self.count = 0
+        self.slow = 0
+        self.total = deque(maxlen=window)  # полное время последних window вызовов
+        self.api = deque(maxlen=window)  # из него в запросах к Telegram
+
+
+# Задержки обработчиков по командам: скользящее окно последних window вызовов на команду.
+# Запись — два append в deque, перцентили считаются только при выводе таблицы.
+class LatencyTracker:
+    def __init__(self, window=512, slow_threshold=1.0):
+        self.window = window
+        self.slow_threshold = slow_threshold
+        self._stats = {}
+
+    def begin(self):
+        return _api_time.set([0.0, 0])
+
+    def end(self, token):
+        spent = _api_time.get()
+        _api_time.reset(token)
+        return spent
+
+    def add_api(self, seconds):
+        # Вызывается из middleware сессии бота; вне обработчика (sender, рейды) ничего не делает
+        spent = _api_time.get()
+        if spent is not None:
+            spent[0] += seconds
+            spent[1] += 1
+
+    def record(self, name, total, api):
+        stats = self._stats.get(name)
+        if stats is None:
+            stats = self._stats[name] = _Stats(self.window)
+        stats.count += 1
+        stats.total.append(total)
+        stats.api.append(min(api, total))  # Параллельные запросы (gather) в сумме могут превысить общее время
+        if total >= self.slow_threshold:
+            stats.slow += 1
+            return True
+        return False
+
+    def table(self):
+        # [(команда, вызовов, медленных, p50, p95, p99, доля API)], сортировка по p95
+        rows = []
+        for name, stats in self._stats.items():
+            ordered = sorted(stats.total)
+            total = sum(stats.total)
+            api_share = sum(stats.api) / total if total else 0.0
+            rows.append((name, stats.count, stats.slow, _percentile(ordered, 0.5),
+                         _percentile(ordered, 0.95), _percentile(ordered, 0.99), api_share))
+        rows.sort(key=lambda row: row[4], reverse=True)
+        return rows
+
+    def format_table(self, limit=30):
+        rows = self.table()
+        if not rows:
+            return "Замеров пока нет."
+        lines = ["команда: вызовов (медл.) p50/p95/p99 мс, API %"]
+        for name, count, slow, p50, p95, p99, api_share in rows[:limit]:
+            lines.append(f"{name}: {count} ({slow}) {p50 * 1000:.0f}/{p95 * 1000:.0f}/{p99 * 1000:.0f}, {api_share:.0%}")
+        return "\n".join(lines)
+
+    def reset(self):
+        self._stats.clear()
@@ -0,0 +1,133 @@
+from bisect import bisect_left, insort
+from itertools import count
+
+
+# Упорядоченный индекс рейтинга: отсортированный список, разбитый на корзины.
+# Ключ (-очки, порядковый номер, id): при равенстве очков выше тот, кто появился раньше —
+# так же, как устойчивая sorted(..., reverse=True) по словарю в порядке вставки.
+# Размеры корзин — в дереве Фенвика: сколько участников в корзинах до i-й — O(log(n/B)).
+# Обновление — O(log n + B), топ-K — O(K), место игрока — O(log n).
+class RankIndex:
+    BUCKET = 512
+
+    def __init__(self):
+        self._buckets = []
+        self._maxes = []
+        self._tree = [0]  # Дерево Фенвика по len(корзины), с единицы
+        self._keys = {}
+        self._seq = count()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, member):
+        return member in self._keys
+
+    def _rebuild_tree(self):
+        # После появления или исчезновения корзины — O(n/B), бывает раз на B вставок
+        tree = [0] * (len(self._buckets) + 1)
+        for i, bucket in enumerate(self._buckets, 1):
+            tree[i] += len(bucket)
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _add(self, i, delta):
+        i += 1
+        tree = self._tree
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    def _before(self, i):
+        # Сколько участников в корзинах 0..i-1
+        total = 0
+        tree = self._tree
+        while i:
+            total += tree[i]
+            i -= i & -i
+        return total
+
+    def _insert(self, key):
+        if not self._buckets:
+            self._buckets.append([key])
+            self._maxes.append(key)
+            self._rebuild_tree()
+            return
+        i = bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            i -= 1
+        bucket = self._buckets[i]
+        insort(bucket, key)
+        self._maxes[i] = bucket[-1]
+        if len(bucket) > 2 * self.BUCKET:
+            self._buckets.insert(i + 1, bucket[self.BUCKET:])
+            del bucket[self.BUCKET:]
+            self._maxes.insert(i, bucket[-1])
+            self._rebuild_tree()
+        else:
+            self._add(i, 1)
+
+    def _remove(self, key):
+        i = bisect_left(self._maxes, key)
+        bucket = self._buckets[i]
+        del bucket[bisect_left(bucket, key)]
+        if bucket:
+            self._maxes[i] = bucket[-1]
+            self._add(i, -1)
+        else:
+            del self._buckets[i]
+            del self._maxes[i]
+            self._rebuild_tree()
+
+    def load(self, items):
+        # Заполнить заново из (участник, очки) в порядке появления: одна сортировка вместо n вставок
+        self.clear()
+        keys = [(-score, next(self._seq), member) for member, score in items]
+        self._keys = {key[2]: key for key in keys}
+        keys.sort()
+        self._buckets = [keys[i:i + self.BUCKET] for i in range(0, len(keys), self.BUCKET)]
+        self._maxes = [bucket[-1] for bucket in self._buckets]
+        self._rebuild_tree()
+
+    def update(self, member, score):
+        old = self._keys.get(member)
+        if old is not None:
+            if old[0] == -score:
+                return
+            self._remove(old)
+            seq = old[1]
+        else:
+            seq = next(self._seq)
+        key = (-score, seq, member)
+        self._keys[member] = key
+        self._insert(key)
+
+    def discard(self, member):
+        key = self._keys.pop(member, None)
+        if key is not None:
+            self._remove(key)
+
+    def clear(self):
+        self._buckets.clear()
+        self._maxes.clear()
+        self._tree = [0]
+        self._keys.clear()
+
+    def top(self, k):
+        result = []
+        for bucket in self._buckets:
+            for neg_score, _, member in bucket:
+                if len(result) >= k:
+                    return result
+                result.append((member, -neg_score))
+        return result
+
+    def rank(self, member):
+        # Место с единицы или None, если участника нет в индексе
+        key = self._keys.get(member)
+        if key is None:
+            return None
+        i = bisect_left(self._maxes, key)
+        return self._before(i) + bisect_left(self._buckets[i], key) + 1
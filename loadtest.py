@@ -0,0 +1,436 @@
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+# Нагрузочный тест без Telegram: апдейты собираются здесь и подаются в dp.feed_update,
+# а Bot вместо HTTP ходит в FakeSession, которая отвечает на методы API с заданной задержкой.
+# Запуск: python loadtest.py --users 5000 --chats 200 --updates 50000 --api-latency 30
+# Все файлы бота (candies.json, bot.db, bot.log, ...) пишутся во временный каталог.
+# --workers N — режим воркеров (workers.py): N процессов с общей базой SQLite, у каждого свои чаты
+# (по тому же правилу, что у ведущего) и updates / N апдейтов; в отчёте — суммарная пропускная способность.
+# --scale 1,2,4 — те же апдейты по очереди с 1, 2 и 4 воркерами (каждый прогон на свежей базе SQLite),
+# в отчёте — пропускная способность и ускорение относительно первого прогона.
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+
+# Доли действий в смеси апдейтов; "click" — нажатие на одну из ранее отправленных ботом клавиатур
+MIX = {
+    "daily": 15, "trickortreat": 20, "click": 25, "give": 10,
+    "shop": 10, "duel": 5, "clan": 5, "top": 5, "balance": 5,
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на локальном фейковом API")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--clans", type=int, default=20)
+    parser.add_argument("--updates", type=int, default=20000, help="Сколько апдейтов подать")
+    parser.add_argument("--concurrency", type=int, default=200, help="Апдейтов в обработке одновременно")
+    parser.add_argument("--api-latency", type=float, default=30, help="Средняя задержка ответа API, мс")
+    parser.add_argument("--storage", default=os.getenv("STORAGE_MODE", "json"), choices=("json", "journal", "sqlite"))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workdir", help="Каталог для файлов бота (по умолчанию временный)")
+    parser.add_argument("--json", action="store_true", help="Вывести отчёт одной JSON-строкой")
+    parser.add_argument("--workers", type=int, default=1, help="Процессов в режиме воркеров (только sqlite)")
+    parser.add_argument("--scale", help="Числа воркеров через запятую: прогнать с каждым и сравнить (только sqlite)")
+    args = parser.parse_args()
+    if args.workers > 1 or args.scale:
+        args.storage = "sqlite"
+    return args
+
+
+def _message_result(chat_id, message_id, text=""):
+    return {
+        "message_id": message_id, "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"},
+        "from": BOT_USER, "text": text or "...",
+    }
+
+
+def _reply_to(method):
+    # message.reply() в разных версиях aiogram заполняет reply_to_message_id или reply_parameters
+    reply_to = getattr(method, "reply_to_message_id", None)
+    parameters = getattr(method, "reply_parameters", None)
+    if reply_to is None and parameters is not None:
+        reply_to = parameters.message_id
+    return reply_to
+
+
+def make_session(latency, ids):
+    from aiogram.client.session.base import BaseSession
+    from aiogram.types import InlineKeyboardMarkup
+
+    class FakeSession(BaseSession):
+        # Вместо HTTP: ответ собирается на месте и проходит ту же проверку, что ответ настоящего API
+        def __init__(self):
+            super().__init__()
+            self.calls = Counter()
+            self.keyboards = []  # (chat_id, message_id, ответ на message_id, [callback_data])
+
+        async def close(self):
+            pass
+
+        async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+            # Абстрактный метод BaseSession (скачивание файлов). Бот файлы не качает; фейковый файл — пустой
+            yield b""
+
+        async def make_request(self, bot, method, timeout=None):
+            name = method.__api_method__
+            self.calls[name] += 1
+            if latency:
+                await asyncio.sleep(random.uniform(0.5, 1.5) * latency)
+            result = self.result(name, method)
+            response = self.check_response(
+                bot=bot, method=method, status_code=200,
+                content=json.dumps({"ok": True, "result": result}, ensure_ascii=False),
+            )
+            return response.result
+
+        def result(self, name, method):
+            if name == "sendMessage":
+                message_id = next(ids)
+                markup = method.reply_markup
+                if isinstance(markup, InlineKeyboardMarkup):
+                    data = [button.callback_data for row in markup.inline_keyboard for button in row if button.callback_data]
+                    self.keyboards.append((method.chat_id, message_id, _reply_to(method), data))
+                return _message_result(method.chat_id, message_id, method.text)
+            if name in ("editMessageText", "editMessageReplyMarkup"):
+                return _message_result(method.chat_id, method.message_id, getattr(method, "text", ""))
+            if name == "getChat":
+                return {"id": method.chat_id, "type": "private", "first_name": f"Игрок {method.chat_id}",
+                        "accent_color_id": 0, "max_reaction_count": 11}
+            if name == "getMe":
+                return BOT_USER
+            return True
+
+    return FakeSession()
+
+
+class LoadTest:
+    def __init__(self, bot_main, session, ids, args, updates=None):
+        self.bm = bot_main
+        self.session = session
+        self.ids = ids
+        self.args = args
+        self.updates = updates or args.updates
+        self.users = [100000 + i for i in range(args.users)]
+        self.chats = [-1000000000 - i for i in range(args.chats)]
+        if bot_main.SHARED:
+            # Воркер получает апдейты только своих чатов; игроки общие
+            self.chats = [chat for chat in self.chats if bot_main.chat_worker(chat, bot_main.WORKER_COUNT) == bot_main.WORKER_INDEX]
+        self.update_ids = itertools.count(1)
+        self.clicker = {}  # (chat_id, message_id команды) -> кто нажмёт кнопку в ответе бота
+        self.actions = Counter()
+        self.errors = Counter()  # Тип исключения -> сколько раз вылетело из обработки апдейта
+        self.actions_list = list(MIX)
+        from callbacks import Clan, ClanAction
+        self.join_clan = Clan(action=ClanAction.JOIN).pack()
+        self.weights = list(MIX.values())
+
+    def seed(self):
+        # Игроки с запасом конфет и кланы — как будто игра идёт не первый день
+        bm = self.bm
+        for i, uid in enumerate(self.users):
+            if i % 2 == 0 and self.args.clans:
+                name = f"Клан {(i // 2) % self.args.clans}"
+                clan = bm.clans.get(name)
+                if clan is None:
+                    bm.clans.create(name, str(uid))
+                    bm.get_user_data(str(uid))["clan"] = name
+                elif len(clan) < bm.MAX_CLAN_MEMBERS:
+                    bm.clans.join(name, str(uid))
+                    bm.get_user_data(str(uid))["clan"] = name
+                bm.mark_dirty("clan", name)
+                bm.update_clan_rank(name)
+            bm.add_candies(str(uid), 1000)
+
+    def user(self, uid):
+        return {"id": uid, "is_bot": False, "first_name": f"Игрок {uid}"}
+
+    def message(self, chat_id, uid, text, reply_to=None):
+        message = {
+            "message_id": next(self.ids), "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": f"Чат {chat_id}"},
+            "from": self.user(uid), "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        if reply_to is not None:
+            message["reply_to_message"] = {
+                "message_id": next(self.ids), "date": int(time.time()),
+                "chat": message["chat"], "from": self.user(reply_to), "text": "привет",
+            }
+        return {"update_id": next(self.update_ids), "message": message}
+
+    def callback(self, chat_id, message_id, uid, data):
+        return {"update_id": next(self.update_ids), "callback_query": {
+            "id": str(next(self.ids)), "from": self.user(uid), "chat_instance": str(chat_id), "data": data,
+            "message": {"message_id": message_id, "date": int(time.time()),
+                        "chat": {"id": chat_id, "type": "supergroup", "title": f"Чат {chat_id}"},
+                        "from": BOT_USER, "text": "..."},
+        }}
+
+    def pick_click(self):
+        keyboards = self.session.keyboards
+        while keyboards:
+            index = random.randrange(len(keyboards))
+            keyboards[index], keyboards[-1] = keyboards[-1], keyboards[index]
+            chat_id, message_id, reply_to, data = keyboards.pop()
+            uid = self.clicker.pop((chat_id, reply_to), None)
+            data = [d for d in data if d != self.join_clan]  # Вступление ждёт текст названия — не моделируем
+            if uid is not None and data:
+                return self.callback(chat_id, message_id, uid, random.choice(data))
+        return None
+
+    def next_update(self):
+        action = random.choices(self.actions_list, self.weights)[0]
+        if action == "click":
+            update = self.pick_click()
+            if update is not None:
+                self.actions["click"] += 1
+                return update
+            action = "daily"
+        self.actions[action] += 1
+        chat_id = random.choice(self.chats)
+        uid, other = random.sample(self.users, 2)
+        if action == "trickortreat":
+            update = self.message(chat_id, uid, "/trickortreat", reply_to=other)
+            self.clicker[(chat_id, update["message"]["message_id"])] = other
+        elif action == "duel":
+            update = self.message(chat_id, uid, "/duel", reply_to=other)
+            self.clicker[(chat_id, update["message"]["message_id"])] = other
+        elif action == "give":
+            update = self.message(chat_id, uid, f"/give {random.randint(1, 5)}", reply_to=other)
+        elif action in ("shop", "clan"):
+            update = self.message(chat_id, uid, f"/{action}")
+            self.clicker[(chat_id, update["message"]["message_id"])] = uid
+        else:
+            update = self.message(chat_id, uid, f"/{action}")
+        return update
+
+    async def run(self):
+        from aiogram import types
+
+        bot, dp = self.bm.bot, self.bm.dp
+        limit = asyncio.Semaphore(self.args.concurrency)
+        tasks = set()
+
+        async def feed(update):
+            try:
+                await dp.feed_update(bot, update)
+            except Exception as e:
+                self.errors[type(e).__name__] += 1
+            finally:
+                limit.release()
+
+        start = time.perf_counter()
+        for _ in range(self.updates):
+            await limit.acquire()
+            update = types.Update.model_validate(self.next_update(), context={"bot": bot})
+            task = asyncio.create_task(feed(update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+        flush_start = time.perf_counter()
+        await self.bm.flush_changes()
+        return elapsed, time.perf_counter() - flush_start
+
+    def report(self, elapsed, final_flush):
+        metrics = self.bm.metrics
+        latency = [
+            {"handler": name, "calls": count, "slow": slow, "p50_ms": round(p50 * 1000, 2),
+             "p95_ms": round(p95 * 1000, 2), "p99_ms": round(p99 * 1000, 2), "api_share": round(api_share, 3)}
+            for name, count, slow, p50, p95, p99, api_share in self.bm.latency.table()
+        ]
+        return {
+            "storage": self.args.storage,
+            "users": self.args.users, "chats": self.args.chats, "clans": self.args.clans,
+            "updates": self.updates, "concurrency": self.args.concurrency,
+            "api_latency_ms": self.args.api_latency, "workers": self.args.workers,
+            "seconds": round(elapsed, 3),
+            "updates_per_second": round(self.updates / elapsed, 1),
+            "errors": dict(self.errors),
+            "actions": dict(self.actions),
+            "latency": latency,
+            "api_calls": dict(self.session.calls),
+            "persistence": {
+                "saves": metrics.get("bot_saves_total"),
+                "seconds": round(metrics.get("bot_save_seconds_total"), 3),
+                "bytes": metrics.get("bot_save_bytes_total"),
+                "entities": metrics.get("bot_saved_entities_total"),
+                "final_flush_seconds": round(final_flush, 3),
+            },
+            "event_loop_lag_max": metrics.get("bot_event_loop_lag_seconds_max"),
+        }
+
+
+def merge_reports(reports):
+    # Отчёты воркеров -> один: апдейты и счётчики складываются, время — самого долгого воркера,
+    # перцентили задержки — худшие по воркерам (точнее по разрозненным окнам не посчитать)
+    merged = dict(reports[0])
+    merged["updates"] = sum(r["updates"] for r in reports)
+    merged["seconds"] = max(r["seconds"] for r in reports)
+    merged["updates_per_second"] = round(merged["updates"] / merged["seconds"], 1)
+    for field in ("errors", "actions", "api_calls"):
+        total = Counter()
+        for r in reports:
+            total.update(r[field])
+        merged[field] = dict(total)
+    handlers = {}
+    for r in reports:
+        for row in r["latency"]:
+            row = dict(row)
+            known = handlers.setdefault(row["handler"], row)
+            if known is not row:
+                calls = known["calls"] + row["calls"]
+                known["api_share"] = round((known["api_share"] * known["calls"] + row["api_share"] * row["calls"]) / calls, 3)
+                known["calls"], known["slow"] = calls, known["slow"] + row["slow"]
+                for p in ("p50_ms", "p95_ms", "p99_ms"):
+                    known[p] = max(known[p], row[p])
+    merged["latency"] = sorted(handlers.values(), key=lambda row: -row["calls"])
+    merged["persistence"] = {key: sum(r["persistence"][key] or 0 for r in reports) for key in reports[0]["persistence"]}
+    merged["persistence"]["seconds"] = round(merged["persistence"]["seconds"], 3)
+    merged["persistence"]["final_flush_seconds"] = max(r["persistence"]["final_flush_seconds"] for r in reports)
+    merged["event_loop_lag_max"] = max(r["event_loop_lag_max"] or 0 for r in reports)
+    return merged
+
+
+def print_report(report):
+    print(f"Хранилище: {report['storage']}, игроков {report['users']}, чатов {report['chats']}, кланов {report['clans']}")
+    if report["workers"] > 1:
+        print(f"Воркеров: {report['workers']} (процессоров: {os.cpu_count()})")
+    print(f"Апдейтов: {report['updates']} за {report['seconds']} с — {report['updates_per_second']} в секунду, ошибок {sum(report['errors'].values())}")
+    for name, count in report["errors"].items():
+        print(f"  {name}: {count}")
+    print(f"Задержка API: {report['api_latency_ms']} мс, одновременно {report['concurrency']}")
+    print("\nОбработчик: вызовов (медл.) p50 / p95 / p99 мс, доля API")
+    for row in report["latency"]:
+        print(f"  {row['handler']}: {row['calls']} ({row['slow']}) {row['p50_ms']} / {row['p95_ms']} / {row['p99_ms']}, {row['api_share']:.0%}")
+    print("\nЗапросы к API:")
+    for name, count in sorted(report["api_calls"].items(), key=lambda item: -item[1]):
+        print(f"  {name}: {count}")
+    p = report["persistence"]
+    print(f"\nСохранение: {p['saves']} раз, {p['seconds']} с, {p['bytes']} байт, {p['entities']} сущностей, "
+          f"финальное {p['final_flush_seconds']} с")
+    print(f"Макс. задержка цикла событий: {report['event_loop_lag_max']} с")
+
+
+async def amain(args, ready=None, barrier=None):
+    import main as bot_main
+
+    random.seed(args.seed + bot_main.WORKER_INDEX)
+    ids = itertools.count(1)
+    session = make_session(args.api_latency / 1000, ids)
+    bot_main.bot.session = session
+    await bot_main.startup()
+    test = LoadTest(bot_main, session, ids, args, args.updates // args.workers)
+    # Воркеры: игроков и кланы заводит первый, остальные читают их из общей базы
+    if bot_main.WORKER_INDEX == 0:
+        test.seed()
+    await bot_main.flush_changes()
+    if ready is not None:
+        ready.put(None)
+    if barrier is not None:
+        await asyncio.to_thread(barrier.wait)
+    try:
+        elapsed, final_flush = await test.run()
+        return test.report(elapsed, final_flush)
+    finally:
+        await bot_main.shutdown()
+
+
+def prepare(args, index=0):
+    # main.py читает настройки из окружения при импорте и пишет файлы в текущий каталог
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(args.workdir)
+    os.environ.setdefault("API_TOKEN", "123456:LOADTEST")
+    os.environ["STORAGE_MODE"] = args.storage
+    os.environ.setdefault("SLOW_HANDLER_MS", "100000")  # Не засорять лог предупреждениями
+    if args.workers > 1:
+        os.environ["WORKER_COUNT"] = str(args.workers)
+        os.environ["WORKER_INDEX"] = str(index)
+
+
+def run_worker(args, index, ready, barrier, results):
+    prepare(args, index)
+    results.put(asyncio.run(amain(args, ready, barrier)))
+
+
+def wait_for(channel, processes):
+    # Упавший воркер не ответит никогда — не ждём его вечно
+    while True:
+        try:
+            return channel.get(timeout=1)
+        except queue.Empty:
+            if not all(process.is_alive() for process in processes):
+                raise SystemExit("Воркер завершился с ошибкой")
+
+
+def run_workers(args):
+    ctx = multiprocessing.get_context("spawn")
+    ready, barrier, results = ctx.Queue(), ctx.Barrier(args.workers), ctx.Queue()
+    processes = []
+    for index in range(args.workers):
+        process = ctx.Process(target=run_worker, args=(args, index, ready, barrier, results))
+        process.start()
+        processes.append(process)
+        wait_for(ready, processes)  # Как в workers.py: следующий стартует, когда предыдущий открыл базу (первый — и заполнил её)
+    reports = [wait_for(results, processes) for _ in processes]
+    for process in processes:
+        process.join()
+    return merge_reports(reports)
+
+
+def run_scale(args, counts):
+    # Каждый прогон — в новых процессах и своём каталоге: main.py импортируется заново, база пустая
+    reports = []
+    for count in counts:
+        run = argparse.Namespace(**vars(args))
+        run.workers = count
+        run.workdir = tempfile.mkdtemp(prefix=f"workers-{count}-", dir=args.workdir)
+        reports.append(run_workers(run))
+    return reports
+
+
+def print_scale(reports):
+    base = reports[0]["updates_per_second"]
+    print(f"Апдейтов: {reports[0]['updates']}, задержка API: {reports[0]['api_latency_ms']} мс, процессоров: {os.cpu_count()}")
+    print("Воркеров: апдейтов в секунду, ускорение, ошибок, макс. задержка цикла событий")
+    for report in reports:
+        print(f"  {report['workers']}: {report['updates_per_second']}, x{report['updates_per_second'] / base:.2f}, "
+              f"{sum(report['errors'].values())}, {report['event_loop_lag_max']} с")
+    if max(report["workers"] for report in reports) > (os.cpu_count() or 1):
+        print("Воркеров больше, чем процессоров: процессы делят ядра, ускорения от них здесь не будет")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.workdir = args.workdir or tempfile.mkdtemp(prefix="loadtest-")
+    os.makedirs(args.workdir, exist_ok=True)
+    if args.scale:
+        reports = run_scale(args, [int(count) for count in args.scale.split(",")])
+        if args.json:
+            print(json.dumps(reports, ensure_ascii=False))
+        else:
+            print_scale(reports)
+        sys.exit()
+    if args.workers > 1:
+        report = run_workers(args)
+    else:
+        prepare(args)
+        report = asyncio.run(amain(args))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False))
+    else:
+        print_report(report)
@@ -0,0 +1,145 @@
+import asyncio
+import fcntl
+import os
+import time
+import zlib
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+
+class _Entry:
+    __slots__ = ("lock", "refs")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.refs = 0
+
+
+# Блокировки по ключам вида ("user", uid) / ("clan", name).
+# Несколько ключей берутся в отсортированном порядке, поэтому два обработчика,
+# которым нужны одни и те же игроки или кланы, не могут заблокировать друг друга.
+# Запись о ключе живёт, пока его держат или ждут, и удаляется сразу после.
+class KeyedLocks:
+    def __init__(self):
+        self._entries = {}
+        self.acquired = 0  # сколько раз взяты блокировки
+        self.contended = 0  # из них пришлось ждать
+        self.wait_total = 0.0  # суммарное ожидание, сек
+        self.wait_max = 0.0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @asynccontextmanager
+    async def hold(self, *keys):
+        keys = sorted(set(keys))
+        taken = []
+        for key in keys:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _Entry()
+            entry.refs += 1
+            taken.append((key, entry))
+        start = time.perf_counter()
+        locked = []
+        try:
+            for _, entry in taken:
+                await entry.lock.acquire()
+                locked.append(entry)
+            waited = time.perf_counter() - start
+            self.acquired += 1
+            if waited > 0.001:
+                self.contended += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            yield waited
+        finally:
+            for entry in reversed(locked):
+                entry.lock.release()
+            for key, entry in taken:
+                entry.refs -= 1
+                if entry.refs == 0:
+                    del self._entries[key]
+
+    def stats(self):
+        avg = self.wait_total / self.acquired if self.acquired else 0.0
+        return {
+            "acquired": self.acquired,
+            "contended": self.contended,
+            "wait_avg_ms": avg * 1000,
+            "wait_max_ms": self.wait_max * 1000,
+            "keys": len(self._entries),
+        }
+
+
+# Те же блокировки, но общие для нескольких процессов (режим воркеров, workers.py).
+# Ключ хешируется в байт файла path, байт захватывается fcntl-блокировкой записи: её снимает
+# ядро, даже если процесс упал. Внутри процесса ключи по-прежнему разводит KeyedLocks,
+# а fcntl держится, пока байт нужен хотя бы одному ключу процесса.
+# Ключи, уже взятые в текущем контексте (апдейт целиком держит своих игроков), повторно не ждутся.
+# on_acquire(keys) — после захвата (перечитать сущности из общей базы), before_release(keys) —
+# перед освобождением (дописать изменения в базу); оба — корутины.
+class SharedLocks(KeyedLocks):
+    def __init__(self, path, on_acquire=None, before_release=None, stripes=1 << 16, timeout=30.0):
+        super().__init__()
+        self.on_acquire = on_acquire
+        self.before_release = before_release
+        self.stripes = stripes
+        self.timeout = timeout
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._stripe_refs = {}  # байт -> сколько ключей этого процесса его держат
+        self._held = ContextVar("shared_locks_held", default=frozenset())
+
+    def _stripe(self, key):
+        return zlib.crc32(repr(key).encode()) % self.stripes
+
+    def _try_lock(self, stripe):
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, stripe)
+        except OSError:
+            return False
+        return True
+
+    async def _lock_stripe(self, stripe, deadline):
+        if not self._stripe_refs.get(stripe):
+            delay = 0.0005
+            while not self._try_lock(stripe):
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f"Общая блокировка не получена за {self.timeout} с")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.02)
+        self._stripe_refs[stripe] = self._stripe_refs.get(stripe, 0) + 1
+
+    def _unlock_stripe(self, stripe):
+        self._stripe_refs[stripe] -= 1
+        if not self._stripe_refs[stripe]:
+            del self._stripe_refs[stripe]
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, stripe)
+
+    @asynccontextmanager
+    async def hold(self, *keys):
+        held = self._held.get()
+        keys = sorted(set(keys) - held)
+        if not keys:
+            yield 0.0
+            return
+        async with super().hold(*keys) as waited:
+            start = time.perf_counter()
+            deadline = time.monotonic() + self.timeout
+            locked = []
+            try:
+                for stripe in sorted({self._stripe(key) for key in keys}):
+                    await self._lock_stripe(stripe, deadline)
+                    locked.append(stripe)
+                token = self._held.set(held | set(keys))
+                try:
+                    if self.on_acquire:
+                        await self.on_acquire(keys)
+                    yield waited + time.perf_counter() - start
+                finally:
+                    self._held.reset(token)
+                    if self.before_release:
+                        await self.before_release(keys)
+            finally:
+                for stripe in reversed(locked):
+                    self._unlock_stripe(stripe)
@@ -0,0 +1,135 @@
+import atexit
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import time
+from contextvars import ContextVar
+
+# chat_id / user_id текущего апдейта — попадают в каждую запись лога
+_log_context = ContextVar("log_context", default=(None, None))
+
+
+def set_log_context(chat_id, user_id):
+    return _log_context.set((chat_id, user_id))
+
+
+def reset_log_context(token):
+    _log_context.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    # Выполняется в потоке цикла событий, до очереди: в потоке записи контекста апдейта уже нет
+    def filter(self, record):
+        record.chat_id, record.user_id = _log_context.get()
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    # Не больше burst записей за interval секунд с одной строки кода; ERROR и выше пропускаются всегда.
+    # Сколько записей отброшено, дописывается к первой пропущенной после паузы.
+    def __init__(self, burst=20, interval=10.0):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self._sites = {}  # (pathname, lineno) -> [начало окна, записей в окне, отброшено]
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        site = self._sites.get(key)
+        if site is None or now - site[0] >= self.interval:
+            dropped = site[2] if site else 0
+            self._sites[key] = [now, 1, 0]
+            if dropped:
+                record.msg = f"{record.getMessage()} (ещё {dropped} таких записей пропущено)"
+                record.args = None
+            return True
+        if site[1] < self.burst:
+            site[1] += 1
+            return True
+        site[2] += 1
+        return False
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "chat_id", None) is not None:
+            data["chat_id"] = record.chat_id
+        if getattr(record, "user_id", None) is not None:
+            data["user_id"] = record.user_id
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+def _gzip_namer(name):
+    return name + ".gz"
+
+
+def _gzip_rotator(source, dest):
+    with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+def parse_levels(spec):
+    # "aiogram=INFO,aiohttp.access=WARNING" -> {"aiogram": "INFO", ...}
+    levels = {}
+    for part in spec.split(","):
+        name, _, level = part.strip().partition("=")
+        if name and level:
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+# Обработчики лишь кладут записи в очередь; в файл пишет QueueListener в своём потоке,
+# там же ротация и сжатие старых файлов. rotate: "size" — по max_bytes, иначе when для TimedRotatingFileHandler.
+def setup_logging(path, level="INFO", levels=None, rotate="size", max_bytes=10 * 1024 * 1024, backups=5,
+                  as_json=False, burst=20, interval=10.0):
+    if rotate == "size":
+        file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+    else:
+        file_handler = logging.handlers.TimedRotatingFileHandler(path, when=rotate, backupCount=backups, encoding="utf-8", utc=True)
+    file_handler.namer = _gzip_namer
+    file_handler.rotator = _gzip_rotator
+    if as_json:
+        file_handler.setFormatter(JsonFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    queue_handler.addFilter(RateLimitFilter(burst, interval))
+
+    root = logging.getLogger()
+    root.setLevel(level.upper())
+    root.addHandler(queue_handler)
+    for name, logger_level in (levels or {}).items():
+        logging.getLogger(name).setLevel(logger_level)
+
+    listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    running = True
+
+    def stop():
+        # Дописать очередь в файл и остановить поток; повторный вызов (atexit после ручного) ничего не делает
+        nonlocal running
+        if running:
+            running = False
+            listener.stop()
+
+    atexit.register(stop)
+    return stop
@@ -1,39 +1,128 @@
 import asyncio
+import heapq
 import json
 import logging
+import math
 import random
 import os
+import secrets
+import time
+import zlib
+from contextvars import ContextVar
+from aiohttp import web
 from aiogram import Bot, Dispatcher, Router, types, F
 from aiogram.filters import Command
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
 from datetime import datetime, timedelta, timezone
 from collections import Counter
-import aiofiles
-from keep_alive import keep_alive  # Импорт веб-сервера для Replit
+from functools import lru_cache
+from keep_alive import keep_alive, create_app  # Веб-сервер для Replit и вебхука
+from storage import JsonStore, Journal, SqliteStore, UserCache, atomic_write
+from leaderboard import RankIndex
+from namecache import NameCache
+from records import UserRecord, costume_index, register_costumes
+import promos
+from promos import PromoRecord
+from clans import ClanIndex
+from locks import KeyedLocks, SharedLocks
+from cooldowns import Deadlines, SharedDeadlines
+from sender import RateLimitedSender
+from broadcast import Broadcast, is_dead_chat, is_denied_chat
+from chats import ChatRegistry, chat_worker
+from pending import PendingInteractions, interaction_key
+from callbacks import Buy, Use, Trick, Duel, Clan, Item, Move, ClanAction
+from metrics import Metrics, ErrorCounter, loop_lag_monitor
+from latency import LatencyTracker
+from logsetup import setup_logging, parse_levels, set_log_context, reset_log_context
 
 # ====================== КОНСТАНТЫ ======================
 API_TOKEN = os.getenv('API_TOKEN')  # Токен из секретов Replit
 ADMIN_USERNAMES = ["CO7163", "OLRMS", "nugopac2"]
 FINAL_EVENT_TIME = datetime(2025, 10, 31, 21, 0, 0, tzinfo=timezone.utc)
 RAID_INTERVAL = 3 * 3600
+RAID_DURATION = 30 * 60
+RAID_ACTIVE_HOURS = float(os.getenv("RAID_ACTIVE_HOURS", 24))  # Рейды только в чатах с командами за последние N часов
+CHAT_INACTIVE_DAYS = float(os.getenv("CHAT_INACTIVE_DAYS", 30))  # Чат без команд дольше — удаляется (0 — не удалять)
+CHAT_MAX_FAILURES = int(os.getenv("CHAT_MAX_FAILURES", 3))  # Ошибок «нет прав писать» подряд до удаления чата
+SEND_RATE = float(os.getenv("SEND_RATE", 25))  # Сообщений в секунду на весь бот
+SEND_CHAT_INTERVAL = float(os.getenv("SEND_CHAT_INTERVAL", 1.0))  # Секунд между сообщениями в один чат
 LICORICE_PRICE = 15
 CLAN_LICORICE_PRICE = 30
 CLAN_WAR_COST = 50
 MAX_CLAN_MEMBERS = 20
-SAVE_INTERVAL = 5  # Секунды для отложенного сохранения
+ATTACK_COOLDOWN = 600  # Кулдаун /trickortreat, сек
+CLAN_WAR_COOLDOWN = 600  # Кулдаун /clanwar на клан, сек
+PROMO_MINT_MAX = 10000  # Сколько одноразовых кодов можно выпустить за раз
+PROMO_PAGE_SIZE = 20
+CLAN_CHECK_LINES = 20  # Сколько расхождений показывать в /clancheck
+TRICK_TIMEOUT = 120  # Сколько ждать выбора «сладость или гадость», сек
+DUEL_TIMEOUT = 300  # Сколько ждать ответа на дуэль, потом ставки возвращаются, сек
+DUEL_STAKE = 10
+ONLINE_WINDOW = 15 * 60  # «Онлайн» — кто писал боту за последние N секунд
+NAME_CACHE_TTL = int(os.getenv("NAME_CACHE_TTL", 24 * 3600))  # Сколько секунд доверять сохранённому имени
+NAME_CACHE_SIZE = int(os.getenv("NAME_CACHE_SIZE", 20000))
+NAME_CACHE_FILE = os.getenv("NAME_CACHE_FILE", "names.json")  # Пустая строка — не сохранять на диск
+NAME_FETCH_CONCURRENCY = 5  # Одновременных get_chat при промахах кэша
+SAVE_INTERVAL = float(os.getenv("SAVE_INTERVAL", 5))  # Период фонового сохранения JSON, сек
+FLUSH_DIRTY_LIMIT = int(os.getenv("FLUSH_DIRTY_LIMIT", 1000))  # Сохранять раньше, если накопилось столько изменений
+JSON_SHARDS = int(os.getenv("JSON_SHARDS", 16))  # На сколько файлов делить candies.json (1 — один файл)
+STORAGE_MODE = os.getenv("STORAGE_MODE", "json")  # json — полные файлы, journal — журнал + снапшоты, sqlite — база
+JOURNAL_DIR = os.getenv("JOURNAL_DIR", "journal")
+JOURNAL_MAX_BYTES = int(os.getenv("JOURNAL_MAX_BYTES", 8 * 1024 * 1024))  # Порог свёртки по размеру
+JOURNAL_MAX_AGE = int(os.getenv("JOURNAL_MAX_AGE", 15 * 60))  # Порог свёртки по времени, сек
+SQLITE_PATH = os.getenv("SQLITE_PATH", "bot.db")
+SQLITE_CACHE_USERS = int(os.getenv("SQLITE_CACHE_USERS", 50000))  # Сколько игроков держать в памяти
+FLUSH_DELAY = float(os.getenv("FLUSH_DELAY", 0.2))  # Период фонового сохранения в журнал / SQLite, сек
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Публичный https-адрес; пусто — polling
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)  # Без переменной — новый на каждый запуск
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.getenv("WEB_PORT", 8080))
+SLOW_HANDLER_MS = float(os.getenv("SLOW_HANDLER_MS", 1000))  # Логировать обработчики дольше этого, мс
+LATENCY_WINDOW = int(os.getenv("LATENCY_WINDOW", 512))  # Сколько последних вызовов команды учитывать в перцентилях
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVELS = os.getenv("LOG_LEVELS", "aiogram.event=WARNING,aiohttp.access=WARNING")  # Уровни отдельных логгеров
+LOG_ROTATE = os.getenv("LOG_ROTATE", "size")  # size — по размеру, иначе интервал TimedRotatingFileHandler (midnight, H, ...)
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", 5))  # Сколько сжатых старых файлов хранить
+LOG_JSON = os.getenv("LOG_JSON", "") == "1"  # JSON-строки с chat_id / user_id вместо текста
+LOG_BURST = int(os.getenv("LOG_BURST", 20))  # Записей с одной строки кода за LOG_BURST_INTERVAL, дальше пропуск
+LOG_BURST_INTERVAL = float(os.getenv("LOG_BURST_INTERVAL", 10))
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", 1))  # Больше 1 — процесс запущен workers.py как один из воркеров
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", 0))
+CLAN_REFRESH = float(os.getenv("CLAN_REFRESH", 2))  # Режим воркеров: как часто перечитывать кланы из базы, сек
+RANK_REFRESH = float(os.getenv("RANK_REFRESH", 30))  # Режим воркеров: как часто пересобирать рейтинг игроков по базе, сек
+
+# Режим воркеров: игроки, кланы, промокоды и кулдауны — в общей базе SQLite, см. workers.py
+SHARED = WORKER_COUNT > 1
+if SHARED and STORAGE_MODE != "sqlite":
+    raise SystemExit("Режим воркеров работает только с STORAGE_MODE=sqlite")
+
+def worker_file(path):
+    # Файлы состояния своих чатов у каждого воркера свои: raids.json -> raids-2.json
+    if not SHARED or not path:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}-{WORKER_INDEX}{ext}"
 
 # ====================== ЛОГИ ======================
-logging.basicConfig(
-    level=logging.DEBUG,
-    filename="bot.log",
-    filemode="a",
-    format="%(asctime)s - %(levelname)s - %(message)s"
+# Запись в файл — в отдельном потоке, цикл событий только кладёт записи в очередь
+setup_logging(
+    worker_file(LOG_FILE), LOG_LEVEL, parse_levels(LOG_LEVELS), LOG_ROTATE, LOG_MAX_BYTES, LOG_BACKUPS,
+    LOG_JSON, LOG_BURST, LOG_BURST_INTERVAL
 )
 
 # ====================== ИНИЦИАЛИЗАЦИЯ ======================
+metrics = Metrics()
+logging.getLogger().addHandler(ErrorCounter(metrics))
+latency = LatencyTracker(LATENCY_WINDOW, SLOW_HANDLER_MS / 1000)
+
 bot = Bot(token=API_TOKEN)
+sender = RateLimitedSender(bot, SEND_RATE / WORKER_COUNT, SEND_CHAT_INTERVAL)  # Общий лимит делится между воркерами
 dp = Dispatcher()
 router = Router()
 
@@ -41,123 +130,527 @@ CANDIES_FILE = "candies.json"
 PROMOS_FILE = "promos.json"
 CHATS_FILE = "chats.json"
 CLANS_FILE = "clans.json"
+ADMINS_FILE = "admins.json"
+RAIDS_FILE = worker_file("raids.json")
+BROADCAST_FILE = worker_file("broadcast.json")
+PENDING_FILE = worker_file("pending.json")
+# Пустая строка — не сохранять кулдауны; в режиме воркеров они и так в базе
+COOLDOWNS_FILE = "" if SHARED else os.getenv("COOLDOWNS_FILE", "cooldowns.json")
+CANDIES_SHARD_DIR = "candies"
 
-# ====================== JSON HELPERS ======================
-async def load_json(file, default):
-    try:
-        async with aiofiles.open(file, mode="r", encoding="utf-8") as f:
-            content = await f.read()
-            data = json.loads(content)
-            if file == CLANS_FILE:
-                for clan in data.values():
-                    if "licorice" not in clan:
-                        clan["licorice"] = 0
-            return data
-    except FileNotFoundError:
-        logging.warning(f"Файл {file} не найден, используется значение по умолчанию")
-        return default
-    except json.JSONDecodeError as e:
-        logging.error(f"Ошибка декодирования JSON в {file}: {e}")
-        return default
-    except Exception as e:
-        logging.error(f"Неизвестная ошибка при загрузке {file}: {e}")
-        return default
+# Изменённые с последнего сохранения сущности: {("user", uid), ("clan", name), ...}
+_dirty = set()
+# Режим воркеров: несохранённые приращения казны и лакрицы {(клан, поле): сколько}
+_clan_deltas = Counter()
+
+json_store = JsonStore(
+    {"user": CANDIES_FILE, "promo": PROMOS_FILE, "chat": CHATS_FILE, "clan": CLANS_FILE},
+    JSON_SHARDS, CANDIES_SHARD_DIR
+)
+journal = Journal(JOURNAL_DIR, JOURNAL_MAX_BYTES, JOURNAL_MAX_AGE) if STORAGE_MODE == "journal" else None
+store = SqliteStore(SQLITE_PATH) if STORAGE_MODE == "sqlite" else None
+
+# Игроки, с которыми сейчас работают обработчики: {uid: число апдейтов}
+_users_in_use = Counter()
+
+# В режиме sqlite игроки подгружаются из базы по требованию
+candies = UserCache(
+    store, SQLITE_CACHE_USERS, lambda uid: ("user", uid) in _dirty or uid in _users_in_use, UserRecord.from_dict
+) if store else {}
+promo_codes = {}
+active_chats = ChatRegistry(CHAT_MAX_FAILURES)  # chat_id -> ChatRecord(seen, fails)
+clans = ClanIndex()  # {"clan_name": ClanRecord(owner, members={uid, ...}, candies, licorice)} + поиск по названию и игроку
+
+# Рейтинги: игроки по total_candies, кланы по candies. В режиме sqlite в индексе игроков все игроки,
+# а не только записи в памяти: пары (очки, id) собираются по базе при запуске
+user_ranks = RankIndex()
+clan_ranks = RankIndex()
+
+# Блокировки игроков и кланов на время «проверить → await → изменить»;
+# в режиме воркеров — общие для всех процессов (обработчики назначаются в РЕЖИМ ВОРКЕРОВ)
+locks = SharedLocks(SQLITE_PATH + ".locks") if SHARED else KeyedLocks()
+
+# Сообщения с кнопками, ждущие ответа: {"chat_id:message_id": {...}}
+pending = PendingInteractions(PENDING_FILE)
+
+names = NameCache(NAME_CACHE_SIZE, NAME_CACHE_TTL, worker_file(NAME_CACHE_FILE) or None)
+
+_dirty_since = None  # monotonic-время самого старого несохранённого изменения
+_last_flush_at = time.monotonic()
+_flush_lock = asyncio.Lock()
+_flush_wakeup = asyncio.Event()
+
+def mark_dirty(kind, key):
+    global _dirty_since
+    if _dirty_since is None:
+        _dirty_since = time.monotonic()
+    _dirty.add((kind, key))
+    if len(_dirty) >= FLUSH_DIRTY_LIMIT:
+        _flush_wakeup.set()
+
+def flush_lag():
+    # Сколько секунд самое старое изменение ждёт записи на диск
+    return time.monotonic() - _dirty_since if _dirty_since is not None else 0.0
+
+def _lookup(kind, key):
+    if kind == "user":
+        return candies.get(key)
+    if kind == "clan":
+        return clans.get(key)
+    if kind == "promo":
+        return promo_codes.get(key)
+    return active_chats.get(key)
+
+def snapshot(changes):
+    # В цикле событий, между шагами обработчиков: записи копируются в простые dict,
+    # рабочему потоку достаются только копии. None — сущность удалена
+    return [(kind, key, None if value is None else value.to_dict()) for kind, key, value in changes]
+
+def collect_changes():
+    changes = snapshot([(kind, key, _lookup(kind, key)) for kind, key in _dirty])
+    _dirty.clear()
+    return changes
+
+def encode_changes(changes):
+    # Выполняется в рабочем потоке, на копиях из snapshot()
+    return [(kind, key, None if value is None else json.dumps(value, ensure_ascii=False))
+            for kind, key, value in changes]
+
+def collect_clan_deltas():
+    if not SHARED:
+        return None
+    deltas = dict(_clan_deltas)
+    _clan_deltas.clear()
+    return deltas
+
+def write_changes(changes, clan_deltas=None, pending_entries=None):
+    # Возвращает объём записанных данных в байтах
+    encoded = encode_changes(changes)
+    if pending_entries is not None:
+        # Ожидающие сообщения — в том же сохранении, что и балансы: ставка дуэли списана вместе с записью о ней
+        pending.write(pending_entries)
+    if journal:
+        journal.append(encoded)
+    elif store:
+        store.write(encoded, clan_deltas)
+    else:
+        json_store.write(encoded)
+    return sum(len(value.encode()) for _, _, value in encoded if value is not None)
+
+async def load_state():
+    # Первый запуск в режиме journal/sqlite: переносим данные из JSON-файлов
+    if journal and journal.is_empty():
+        await asyncio.to_thread(journal.seed, await asyncio.to_thread(json_store.load))
+    if store and store.is_empty():
+        imported = await asyncio.to_thread(store.import_state, await asyncio.to_thread(json_store.load))
+        logging.warning(f"Импортировано в {SQLITE_PATH}: {imported} записей")
+    if journal:
+        state = await asyncio.to_thread(journal.load)
+    elif store:
+        state = await asyncio.to_thread(store.load_resident)
+    else:
+        state = await asyncio.to_thread(json_store.load)
+    if not store:
+        candies.update((uid, UserRecord.from_dict(user)) for uid, user in state["user"].items())
+    promo_codes.update((code, PromoRecord.from_dict(promo)) for code, promo in state["promo"].items())
+    chats = state["chat"]
+    if SHARED:
+        # Апдейты чата приходят только в один воркер — он и держит чат у себя
+        chats = {chat_id: chat for chat_id, chat in chats.items() if chat_worker(int(chat_id), WORKER_COUNT) == WORKER_INDEX}
+    active_chats.load(chats)
+    for uid, name in clans.load(state["clan"]):
+        logging.error(f"Игрок {uid} числился в нескольких кланах, убран из {name}")
+    if not store:
+        # Поле clan у игроков — по составу кланов (в режиме sqlite сверка — командой /clancheck)
+        for uid, _, name in clans.audit(candies.items()):
+            candies[uid].clan = name
+            mark_dirty("user", uid)
+    rebuild_leaderboards()
+    if store:
+        await reload_user_ranks()
+    logging.info(f"Загружено: игроков {len(user_ranks)}, кланов {len(clans)}, чатов {len(active_chats)}")
+
+def rebuild_leaderboards():
+    user_ranks.clear()
+    clan_ranks.clear()
+    if not store:
+        for uid, user in candies.items():
+            user_ranks.update(uid, user["total_candies"])
+    for name, clan in clans.items():
+        clan_ranks.update(name, clan["candies"])
+
+def load_user_ranks():
+    # Из рабочего потока: индекс по всем игрокам базы
+    ranks = RankIndex()
+    ranks.load(store.user_totals())
+    return ranks
+
+async def reload_user_ranks():
+    # Режим sqlite: рейтинг игроков по базе. Пока он собирается, запись не идёт — всё несохранённое
+    # этого процесса лежит в изменённых записях и записях в работе, их очки накладываются поверх
+    global user_ranks
+    async with _flush_lock:
+        ranks = await asyncio.to_thread(load_user_ranks)
+        for uid in {uid for kind, uid in _dirty if kind == "user"} | _users_in_use.keys():
+            user = candies.cached(uid)
+            if user is not None:
+                ranks.update(uid, user.total_candies)
+        user_ranks = ranks
+
+def update_clan_rank(name):
+    clan_ranks.update(name, clans[name]["candies"])
+
+def user_clan(user):
+    # Клан игрока или None: клан мог распустить другой процесс, а поле clan игрока ещё не исправлено
+    return clans.get(user["clan"]) if user["clan"] else None
+
+def change_clan(name, field, amount):
+    # Казна ("candies") и лакрица клана; в режиме воркеров в базу уходит только приращение,
+    # чтобы не затереть прибавки от других процессов. Клана, которого уже нет, приращение
+    # не создаёт: UPDATE в базе просто не найдёт строки
+    global _dirty_since
+    clan = clans.get(name)
+    if clan is not None:
+        clan[field] += amount
+    if SHARED:
+        _clan_deltas[(name, field)] += amount
+        if _dirty_since is None:
+            _dirty_since = time.monotonic()
+    elif clan is not None:
+        mark_dirty("clan", name)
+    if field == "candies" and clan is not None:
+        update_clan_rank(name)
+
+async def set_player_clans(updates):
+    # Поле clan игроков, чьи апдейты сейчас не обрабатываются (роспуск клана, /clancheck); updates — {uid: клан или None}.
+    # В sqlite — одним UPDATE только этого поля: запись из кэша могла устареть (режим воркеров),
+    # и полная перезапись откатила бы конфеты, записанные другим процессом. Целиком сохраняются
+    # лишь записи, которые этот процесс и так пишет (изменённые или в работе у его обработчиков)
+    if store:
+        await asyncio.to_thread(store.set_user_clans, updates)
+    for uid, name in updates.items():
+        user = candies.cached(uid) if store else candies.get(uid)
+        if user is None:
+            continue
+        user.clan = name
+        if not store or ("user", uid) in _dirty or uid in _users_in_use:
+            mark_dirty("user", uid)
+
+def apply_clan_deltas(name):
+    # Клан перечитан из базы — добавить то, что этот процесс ещё не записал
+    for field in ("candies", "licorice"):
+        amount = _clan_deltas.get((name, field))
+        if amount:
+            clans[name][field] += amount
+
+# Рейтинг игроков — из user_ranks: топ-K за O(K), место за O(log n), число игроков — его размер.
+# В режиме воркеров изменения других процессов попадают в user_ranks при перечитывании игрока под
+# блокировкой и при пересборке раз в RANK_REFRESH, поэтому топ там читается из индекса базы
+# (ORDER BY ... LIMIT без принудительного сохранения: отстаёт не больше чем на FLUSH_DELAY)
+async def top_players(k):
+    if SHARED:
+        return await asyncio.to_thread(store.top_users, k)
+    return user_ranks.top(k)
 
-async def save_json(file, data):
+def player_rank(uid):
+    # (место, всего игроков)
+    return user_ranks.rank(uid), len(user_ranks)
+
+async def flush_changes():
+    global _dirty_since, _last_flush_at
+    async with _flush_lock:
+        if not _dirty and not _clan_deltas and not pending.dirty:
+            return
+        started = _dirty_since
+        _dirty_since = None
+        changes = collect_changes()
+        deltas = collect_clan_deltas()
+        entries = pending.snapshot()
+        t0 = time.perf_counter()
+        try:
+            written = await asyncio.to_thread(write_changes, changes, deltas, entries)
+        except Exception as e:
+            logging.error(f"Ошибка записи изменений ({STORAGE_MODE}): {e}")
+            metrics.inc("bot_save_failures_total")
+            _dirty.update((kind, key) for kind, key, _ in changes)
+            _clan_deltas.update(deltas or {})
+            if entries is not None:
+                pending.unsaved()
+            _dirty_since = started if _dirty_since is None else min(started, _dirty_since)
+            return
+        duration = time.perf_counter() - t0
+        _last_flush_at = time.monotonic()
+        metrics.inc("bot_saves_total")
+        metrics.inc("bot_save_seconds_total", duration)
+        metrics.set("bot_save_last_seconds", round(duration, 6))
+        metrics.inc("bot_save_bytes_total", written)
+        metrics.inc("bot_saved_entities_total", len(changes))
+        if store:
+            candies.trim()
+
+# Фоновое сохранение: обработчики только помечают изменения, запись — здесь,
+# по таймеру или раньше, если изменений накопилось FLUSH_DIRTY_LIMIT
+async def persistence_loop():
+    interval = FLUSH_DELAY if journal or store else SAVE_INTERVAL
+    while True:
+        try:
+            await asyncio.wait_for(_flush_wakeup.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+        _flush_wakeup.clear()
+        await flush_changes()
+
+async def shutdown_persistence():
+    for _ in range(3):
+        await flush_changes()
+        if not _dirty:
+            break
+    if _dirty:
+        logging.error(f"При остановке не сохранено изменений: {len(_dirty)}")
+    if journal:
+        journal.close()
+    if store:
+        store.close()
+    logging.warning("Состояние сохранено, хранилище закрыто")
+
+async def journal_compactor():
+    while True:
+        await asyncio.sleep(60)
+        if not journal.needs_compaction():
+            continue
+        try:
+            await asyncio.to_thread(journal.compact)
+        except Exception as e:
+            logging.error(f"Ошибка свёртки журнала: {e}")
+
+def update_users(update: types.Update):
+    # Все пользователи, упомянутые в апдейте: отправитель и автор сообщения, на которое ответили
+    users = []
+    if update.message:
+        users.append(update.message.from_user)
+        if update.message.reply_to_message:
+            users.append(update.message.reply_to_message.from_user)
+    elif update.callback_query:
+        users.append(update.callback_query.from_user)
+    return [u for u in users if u]
+
+def update_chat_id(update: types.Update):
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query and update.callback_query.message:
+        return update.callback_query.message.chat.id
+    return None
+
+async def track_users(handler, event: types.Update, data):
+    metrics.inc("bot_updates_total", type=event.event_type)
+    users = update_users(event)
+    # Имена отправителей пополняют кэш имён без лишних запросов к Telegram
+    for u in users:
+        names.put(u.id, u.first_name)
+    if users:
+        online_users.touch(users[0].id, ONLINE_WINDOW)
+    if SHARED:
+        # Апдейт целиком — транзакция над своими игроками: общая блокировка, свежие данные из базы,
+        # запись в базу до того, как игроков сможет взять другой воркер
+        async with locks.hold(*lease_keys(event, users)):
+            return await run_update(handler, event, data, users)
+    # В режиме sqlite подгружаем игроков апдейта в рабочем потоке, чтобы обработчик не читал базу в цикле событий
+    if store and users:
+        candies.merge(await asyncio.to_thread(candies.prefetch_missing, {str(u.id) for u in users}))
+    return await run_update(handler, event, data, users)
+
+def lease_keys(update: types.Update, users):
+    # Игроки апдейта, включая участников дуэли или «сладости», на кнопку которой нажали
+    keys = {("user", str(u.id)) for u in users if not u.is_bot}
+    callback = update.callback_query
+    if callback and callback.message:
+        entry = pending.get(interaction_key(callback.message.chat.id, callback.message.message_id))
+        if entry:
+            keys.update(("user", entry[role]) for role in ("att", "vic"))
+    return keys
+
+async def run_update(handler, event, data, users):
+    log_token = set_log_context(update_chat_id(event), users[0].id if users else None)
+    token = begin_update()
     try:
-        async with aiofiles.open(file, mode="w", encoding="utf-8") as f:
-            await f.write(json.dumps(data, ensure_ascii=False, indent=2))
-    except PermissionError:
-        logging.error(f"Нет прав на запись в файл {file}")
-    except Exception as e:
-        logging.error(f"Ошибка сохранения {file}: {e}")
-
-candies = await load_json(CANDIES_FILE, {})
-promo_codes = await load_json(PROMOS_FILE, {})
-active_chats = await load_json(CHATS_FILE, [])
-clans = await load_json(CLANS_FILE, {})  # { "clan_name": { "owner": uid, "members": [], "candies": 0, "licorice": 0 } }
-
-# Отложенное сохранение
-_save_pending = False
-async def save_all():
-    global _save_pending
-    if _save_pending:
-        return
-    _save_pending = True
-    await asyncio.sleep(SAVE_INTERVAL)
-    await save_json(CANDIES_FILE, candies)
-    await save_json(PROMOS_FILE, promo_codes)
-    await save_json(CHATS_FILE, active_chats)
-    await save_json(CLANS_FILE, clans)
-    _save_pending = False
+        return await handler(event, data)
+    finally:
+        end_update(token)
+        reset_log_context(log_token)
+
+async def fetch_name(uid):
+    user = await bot.get_chat(int(uid))
+    return user.first_name
+
+async def resolve_names(uids):
+    return await names.resolve(uids, fetch_name, NAME_FETCH_CONCURRENCY)
+
+async def save_names():
+    data = names.snapshot()
+    if data is not None:
+        try:
+            await asyncio.to_thread(names.write, data)
+        except Exception as e:
+            logging.error(f"Ошибка сохранения кэша имён: {e}")
+
+async def names_saver():
+    while True:
+        await asyncio.sleep(600)
+        await save_names()
 
 # ====================== ЧАТЫ ======================
 def add_chat(chat_id):
-    if chat_id not in active_chats:
-        active_chats.append(chat_id)
-        asyncio.create_task(save_all())
+    # На каждую команду; на диск — только новый чат или раз в chats.SEEN_STEP
+    if active_chats.touch(chat_id):
+        mark_dirty("chat", chat_id)
+        schedule_raids(chat_id)
+
+def remove_chat(chat_id):
+    # Бота выгнали, чат удалён или давно молчит — больше туда не пишем
+    if not active_chats.remove(chat_id):
+        return False
+    mark_dirty("chat", chat_id)
+    logging.warning(f"Чат {chat_id} удалён из рассылки")
+    return True
+
+def chat_failed(chat_id, error):
+    # Ошибка отправки в чат. «Бота нет в чате» окончательна — чат удаляется сразу (рассылка пробует
+    # каждый чат один раз); «нет прав писать» может пройти — после CHAT_MAX_FAILURES подряд. True — удалён
+    if is_dead_chat(error):
+        return remove_chat(chat_id)
+    if not is_denied_chat(error) or chat_id not in active_chats:
+        return False
+    if active_chats.failed(chat_id):
+        return remove_chat(chat_id)
+    mark_dirty("chat", chat_id)
+    return False
+
+def post_to_chat(chat_id, text):
+    # Как sender.post, но исход отправки учитывается в реестре чатов
+    def on_done(future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is None:
+            if active_chats.delivered(chat_id):
+                mark_dirty("chat", chat_id)
+        elif is_dead_chat(error) or is_denied_chat(error):
+            chat_failed(chat_id, error)
+        else:
+            logging.error(f"Ошибка отправки в чат {chat_id}: {error}")
+
+    future = sender.submit(chat_id, text)
+    future.add_done_callback(on_done)
+    return future
+
+def prune_chats():
+    if CHAT_INACTIVE_DAYS <= 0:
+        return
+    stale = active_chats.stale(time.time() - CHAT_INACTIVE_DAYS * 86400)
+    for chat_id in stale:
+        active_chats.remove(chat_id)
+        mark_dirty("chat", chat_id)
+    if stale:
+        logging.warning(f"Удалено чатов без команд дольше {CHAT_INACTIVE_DAYS:g} дн.: {len(stale)}")
+
+async def chat_pruner():
+    while True:
+        prune_chats()
+        await asyncio.sleep(3600)
+
+async def broadcast_chat_failed(chat_id, error):
+    # Рассылка в режиме воркеров идёт по всем чатам базы. Реестр чата другого воркера в его памяти,
+    # поэтому ошибка учитывается прямо в общей базе; у владельца чат уйдёт при его собственной ошибке
+    # отправки, а при новой команде из чата запишется снова
+    if SHARED and chat_worker(chat_id, WORKER_COUNT) != WORKER_INDEX:
+        if is_dead_chat(error):
+            return await asyncio.to_thread(store.drop_chat, chat_id)
+        if is_denied_chat(error):
+            return await asyncio.to_thread(store.chat_failed, chat_id, CHAT_MAX_FAILURES)
+        return False
+    return chat_failed(chat_id, error)
+
+broadcaster = Broadcast(bot, sender, BROADCAST_FILE, broadcast_chat_failed)
 
 # ====================== ПОЛЬЗОВАТЕЛЬ ======================
+# Контекст апдейта: день считается один раз, каждый игрок достаётся один раз
+_update_ctx = ContextVar("update_ctx", default=None)
+
+def current_day():
+    # Номер дня от эпохи по UTC
+    return int(time.time() // 86400)
+
+def begin_update():
+    return _update_ctx.set({"day": current_day(), "users": {}})
+
+def end_update(token):
+    ctx = _update_ctx.get()
+    _update_ctx.reset(token)
+    # В сохранение попадают только игроки, чьи поля действительно менялись (UserRecord.take_changed)
+    for uid, user in ctx["users"].items():
+        if user.take_changed():
+            mark_dirty("user", uid)
+        _users_in_use[uid] -= 1
+        if _users_in_use[uid] <= 0:
+            del _users_in_use[uid]
+
 def get_user_data(user_id: str):
     uid = str(user_id)
+    ctx = _update_ctx.get()
+    if ctx is not None:
+        user = ctx["users"].get(uid)
+        if user is not None:
+            return user
     if uid not in candies:
-        candies[uid] = {
-            "candies": 10,
-            "total_candies": 10,
-            "last_claim": None,
-            "costume": None,
-            "owned_costumes": [],
-            "active_potions": {},
-            "owned_potions": [],
-            "licorice": 0,
-            "challenges": {"steal": 0, "give": 0, "buy": 0},
-            "last_challenge_reset": None,
-            "duel_wins": 0,
-            "attacks_today": 0,
-            "last_attack_date": None,
-            "buys_today": 0,
-            "last_buy_date": None,
-            "gives_today": 0,
-            "last_give_date": None,
-            "clan": None
-        }
+        candies[uid] = UserRecord()
+        user_ranks.update(uid, 10)
     user = candies[uid]
-    today = datetime.now().date().isoformat()
-    if user.get("last_attack_date") != today:
-        user["attacks_today"] = 0
-        user["last_attack_date"] = today
-    if user.get("last_buy_date") != today:
-        user["buys_today"] = 0
-        user["last_buy_date"] = today
-    if user.get("last_give_date") != today:
-        user["gives_today"] = 0
-        user["last_give_date"] = today
-    if user.get("last_challenge_reset") != today:
-        user["challenges"] = {"steal": 0, "give": 0, "buy": 0}
-        user["last_challenge_reset"] = today
+    if ctx is not None:
+        ctx["users"][uid] = user
+        _users_in_use[uid] += 1
+    else:
+        # Вне апдейта (фоновые задачи, loadtest/bench) конца работы с игроком не видно — помечаем сразу
+        mark_dirty("user", uid)
+    day = ctx["day"] if ctx is not None else current_day()
+    if user.reset_day == day:
+        return user
+    user.reset_day = day
+    if user.last_attack_date != day:
+        user.attacks_today = 0
+        user.last_attack_date = day
+    if user.last_buy_date != day:
+        user.buys_today = 0
+        user.last_buy_date = day
+    if user.last_give_date != day:
+        user.gives_today = 0
+        user.last_give_date = day
+    if user.last_challenge_reset != day:
+        user.ch_steal = user.ch_give = user.ch_buy = 0
+        user.last_challenge_reset = day
     return user
 
 def add_candies(user_id: str, amount: int):
     user = get_user_data(user_id)
     user["candies"] += amount
     user["total_candies"] += amount
-    if user["clan"]:
-        clan = clans.get(user["clan"])
-        if clan:
-            clan["candies"] += amount
-    asyncio.create_task(save_all())
+    user_ranks.update(str(user_id), user["total_candies"])
+    if user["clan"] and user["clan"] in clans:
+        change_clan(user["clan"], "candies", amount)
 
 def remove_candies(user_id: str, amount: int):
     user = get_user_data(user_id)
     user["candies"] = max(0, user["candies"] - amount)
-    asyncio.create_task(save_all())
+
+def refund_candies(user_id: str, amount: int):
+    # Возврат ставки: не считается заработком, в total_candies и клан не идёт
+    get_user_data(user_id)["candies"] += amount
 
 def get_current_bonus(user_id: str):
     user = get_user_data(user_id)
     bonus = 0
     if user.get("costume"):
         bonus += costumes_data[user["costume"]]["bonus"]
-    pots = user.get("active_potions", {})
+    pots = user.active_potions or {}
     if "perm_boost" in pots:
         bonus += pots["perm_boost"]
     if "temp_boost" in pots:
@@ -167,8 +660,10 @@ def get_current_bonus(user_id: str):
                 bonus += 2
             else:
                 del pots["temp_boost"]
+                user.mark_changed()
         except:
             del pots["temp_boost"]
+            user.mark_changed()
     return bonus
 
 # ====================== ДАННЫЕ ======================
@@ -179,6 +674,7 @@ costumes_data = {
     "jason": {"name": "Джейсон", "bonus": 8, "price": 100},
     "barry": {"name": "Барри", "bonus": 9, "price": 0}
 }
+register_costumes(costumes_data)
 
 potions_data = {
     "temp_boost": {"name": "Зелье временного бонуса", "bonus": 2, "price": 50, "duration": 30},
@@ -186,21 +682,148 @@ potions_data = {
 }
 
 RAID_ACTIVE = {}
-cooldowns = {}
-clan_war_cooldowns = {}
+cooldowns = SharedDeadlines(store, "trick") if SHARED else Deadlines()
+clan_war_cooldowns = SharedDeadlines(store, "clan_war") if SHARED else Deadlines()
+online_users = Deadlines()
+
+async def claim_cooldown(deadlines, key, ttl):
+    # Сколько ещё ждать (0 — кулдаун прошёл и поставлен заново); общие кулдауны воркеров — запросы к базе
+    if SHARED:
+        return await asyncio.to_thread(deadlines.claim, key, ttl)
+    return deadlines.claim(key, ttl)
+
+def load_cooldowns():
+    if not COOLDOWNS_FILE:
+        return
+    try:
+        with open(COOLDOWNS_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        logging.error(f"Ошибка загрузки {COOLDOWNS_FILE}: {e}")
+        return
+    cooldowns.load_wall(data.get("trick", {}))
+    clan_war_cooldowns.load_wall(data.get("clan_war", {}))
+
+async def save_cooldowns():
+    if not COOLDOWNS_FILE:
+        return
+    data = {"trick": cooldowns.to_wall(), "clan_war": clan_war_cooldowns.to_wall()}
+    try:
+        await asyncio.to_thread(atomic_write, COOLDOWNS_FILE, json.dumps(data, ensure_ascii=False))
+    except Exception as e:
+        logging.error(f"Ошибка сохранения {COOLDOWNS_FILE}: {e}")
+
+def format_wait(seconds):
+    m, s = divmod(math.ceil(seconds), 60)
+    return f"Подожди {m}м {s}с"
 
 # FSM для присоединения к клану
 class ClanStates(StatesGroup):
     JOIN_CLAN = State()
 
+# ====================== КЛАВИАТУРЫ ======================
+# Клавиатуры без данных игрока собираются один раз; магазин и инвентарь — один раз на ключ
+# (маска костюмов, клан / надетый костюм, число зелий), разметка отдаётся одним и тем же объектом
+def button(text, data):
+    return [InlineKeyboardButton(text=text, callback_data=data.pack())]
+
+TRICK_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    button("Сладость", Trick(sweet=True)),
+    button("Гадость", Trick(sweet=False)),
+])
+DUEL_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    button("Камень", Duel(move=Move.ROCK)),
+    button("Ножницы", Duel(move=Move.SCISSORS)),
+    button("Бумага", Duel(move=Move.PAPER)),
+])
+OWNER_CLAN_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[button("Распустить клан", Clan(action=ClanAction.DISBAND))])
+MEMBER_CLAN_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[button("Выйти", Clan(action=ClanAction.LEAVE))])
+NO_CLAN_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    button("Создать клан (100 конфет)", Clan(action=ClanAction.CREATE)),
+    button("Присоединиться", Clan(action=ClanAction.JOIN)),
+])
+BEATS = {Move.ROCK: Move.SCISSORS, Move.SCISSORS: Move.PAPER, Move.PAPER: Move.ROCK}
+
+def owns(mask, key):
+    return bool(mask >> (costume_index(key) - 1) & 1)
+
+@lru_cache(maxsize=256)
+def shop_keyboard(mask, in_clan):
+    kb = []
+    for key, data in costumes_data.items():
+        if key == "barry" and not owns(mask, key):
+            continue
+        owned = "Уже куплено" if owns(mask, key) else ""
+        kb.append(button(f"{owned} {data['name']} (+{data['bonus']}) — {data['price']} конфет", Buy(item=Item.COSTUME, key=key)))
+    for key, data in potions_data.items():
+        kb.append(button(f"{data['name']} (+{data['bonus']}) — {data['price']} конфет", Buy(item=Item.POTION, key=key)))
+    kb.append(button("Купить лакрицу (личную)", Buy(item=Item.LICORICE)))
+    if in_clan:
+        kb.append(button("Купить лакрицу (для клана)", Buy(item=Item.CLAN_LICORICE)))
+    return InlineKeyboardMarkup(inline_keyboard=kb)
+
+@lru_cache(maxsize=1024)
+def inventory_keyboard(mask, costume, potion_counts):
+    # potion_counts — число зелий в порядке potions_data
+    kb = []
+    for key, data in costumes_data.items():
+        if owns(mask, key):
+            active = " (надет)" if costume == key else ""
+            kb.append(button(f"{data['name']}{active}", Use(item=Item.COSTUME, key=key)))
+    for (key, data), qty in zip(potions_data.items(), potion_counts):
+        if qty:
+            kb.append(button(f"{data['name']} ×{qty}", Use(item=Item.POTION, key=key)))
+    return InlineKeyboardMarkup(inline_keyboard=kb) if kb else None
+
 # ====================== АДМИН-ПРОВЕРКА ======================
-async def is_admin(user_id: int) -> bool:
+# Проверка по from_user без запросов к Telegram. При первой встрече админа его username
+# привязывается к числовому id: дальше админ узнаётся по id даже после смены ника,
+# а чужой аккаунт, занявший освободившийся ник, админом не станет. Привязки ников,
+# убранных из ADMIN_USERNAMES, права не дают и удаляются при загрузке.
+admin_ids = {}  # {"username в нижнем регистре": id}
+_admin_usernames = {name.lower() for name in ADMIN_USERNAMES}
+
+def load_admins():
+    try:
+        with open(ADMINS_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        logging.error(f"Ошибка загрузки {ADMINS_FILE}: {e}")
+        return
+    admin_ids.update((name, uid) for name, uid in data.items() if name in _admin_usernames)
+    stale = sorted(data.keys() - admin_ids.keys())
+    if stale:
+        logging.warning(f"Удалены привязки бывших админов: {', '.join(stale)}")
+        try:
+            atomic_write(ADMINS_FILE, json.dumps(admin_ids, indent=2))
+        except Exception as e:
+            logging.error(f"Ошибка сохранения {ADMINS_FILE}: {e}")
+
+async def save_admins():
     try:
-        user = await bot.get_chat(user_id)
-        return user.username in ADMIN_USERNAMES
+        await asyncio.to_thread(atomic_write, ADMINS_FILE, json.dumps(admin_ids, indent=2))
     except Exception as e:
-        logging.error(f"Ошибка проверки админа {user_id}: {e}")
+        logging.error(f"Ошибка сохранения {ADMINS_FILE}: {e}")
+
+def is_admin(user: types.User) -> bool:
+    # По id — только пока привязанный ник остаётся в ADMIN_USERNAMES
+    if any(bound == user.id and name in _admin_usernames for name, bound in admin_ids.items()):
+        return True
+    username = (user.username or "").lower()
+    if username not in _admin_usernames:
+        return False
+    bound = admin_ids.get(username)
+    if bound is not None and bound != user.id:
+        logging.warning(f"Ник админа @{username} у чужого id {user.id} (привязан к {bound})")
         return False
+    admin_ids[username] = user.id
+    asyncio.create_task(save_admins())
+    logging.warning(f"Админ @{username} привязан к id {user.id}")
+    return True
 
 # ====================== КОМАНДЫ ======================
 
@@ -246,9 +869,11 @@ async def help_command(message: types.Message):
         "/announce TEXT — рассылка по всем чатам\n"
         "/addcandies — реплай на игрока + N конфет → дать конфеты\n"
         "/removecandies — реплай на игрока + N конфет → забрать конфеты\n"
-        "/createpromo CODE N — создать промокод\n"
+        "/createpromo CODE N [MAX] [СРОК] — создать промокод\n"
+        "/mintpromos K N [СРОК] [ПРЕФИКС] — K одноразовых кодов на N конфет\n"
         "/deletepromo CODE — удалить промокод\n"
-        "/listpromos — список промокодов"
+        "/listpromos [СТРАНИЦА] — список промокодов\n"
+        "СРОК: 30m, 12h, 7d"
     )
     await message.reply(text)
 
@@ -276,16 +901,11 @@ async def balance(message: types.Message):
 @router.message(Command("top"))
 async def top(message: types.Message):
     add_chat(message.chat.id)
-    sorted_users = sorted(candies.items(), key=lambda x: x[1]["total_candies"], reverse=True)[:5]
+    sorted_users = await top_players(5)
+    user_names = await resolve_names(uid for uid, _ in sorted_users)
     text = "ТОП-5 ПО СОБРАННЫМ КОНФЕТАМ:\n"
-    for i, (uid, data) in enumerate(sorted_users, 1):
-        try:
-            user = await bot.get_chat(int(uid))
-            name = user.first_name
-        except Exception as e:
-            logging.error(f"Ошибка получения пользователя {uid}: {e}")
-            name = f"User #{uid}"
-        text += f"{i}. {name} — {data['total_candies']}\n"
+    for i, (uid, total) in enumerate(sorted_users, 1):
+        text += f"{i}. {user_names[str(uid)]} — {total}\n"
     await message.reply(text or "Пока никто не играл.")
 
 @router.message(Command("give"))
@@ -305,79 +925,49 @@ async def give_candies(message: types.Message):
     if amt <= 0 or tid == uid:
         await message.reply("Нельзя")
         return
-    giver = get_user_data(uid)
-    if giver["candies"] < amt:
-        await message.reply("Недостаточно конфет")
-        return
-    try:
-        await bot.get_chat(int(tid))  # Проверка существования пользователя
-        get_user_data(tid)
-    except Exception as e:
-        logging.error(f"Ошибка получения пользователя {tid}: {e}")
-        await message.reply("Пользователь не найден")
-        return
-    remove_candies(uid, amt)
-    add_candies(tid, amt)
-    giver["gives_today"] += amt
-    giver["challenges"]["give"] += amt
-    await save_all()
-    await message.reply(f"Передано {amt} конфет → {tname}")
+    async with locks.hold(("user", uid), ("user", tid)):
+        giver = get_user_data(uid)
+        if giver["candies"] < amt:
+            await message.reply("Недостаточно конфет")
+            return
+        try:
+            await bot.get_chat(int(tid))  # Проверка существования пользователя
+            get_user_data(tid)
+        except Exception as e:
+            logging.error(f"Ошибка получения пользователя {tid}: {e}")
+            await message.reply("Пользователь не найден")
+            return
+        remove_candies(uid, amt)
+        add_candies(tid, amt)
+        giver["gives_today"] += amt
+        giver["challenges"]["give"] += amt
+        await message.reply(f"Передано {amt} конфет → {tname}")
 
 @router.message(Command("shop"))
 async def shop(message: types.Message):
     add_chat(message.chat.id)
     uid = str(message.from_user.id)
     user = get_user_data(uid)
-    kb = []
-    text = "МАГАЗИН ХЭЛЛОУИНА\n\nКОСТЮМЫ:\n"
-    for key, data in costumes_data.items():
-        if key == "barry" and key not in user["owned_costumes"]:
-            continue
-        owned = "Уже куплено" if key in user["owned_costumes"] else ""
-        kb.append([InlineKeyboardButton(
-            text=f"{owned} {data['name']} (+{data['bonus']}) — {data['price']} конфет",
-            callback_data=f"buy_costume_{key}"
-        )])
-    text += "\nЗЕЛЬЯ:\n"
-    for key, data in potions_data.items():
-        kb.append([InlineKeyboardButton(
-            text=f"{data['name']} (+{data['bonus']}) — {data['price']} конфет",
-            callback_data=f"buy_potion_{key}"
-        )])
+    text = "МАГАЗИН ХЭЛЛОУИНА\n\nКОСТЮМЫ:\n\nЗЕЛЬЯ:\n"
     text += f"\nЛакрица (личная) — {LICORICE_PRICE} конфет\n"
     text += f"Лакрица (для клана) — {CLAN_LICORICE_PRICE} конфет\n"
-    kb.append([InlineKeyboardButton(text="Купить лакрицу (личную)", callback_data="buy_licorice")])
-    if user["clan"]:
-        kb.append([InlineKeyboardButton(text="Купить лакрицу (для клана)", callback_data="buy_clan_licorice")])
-    await message.reply(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
+    await message.reply(text, reply_markup=shop_keyboard(user.costume_mask(), bool(user["clan"])))
 
 @router.message(Command("inventory"))
 async def inventory(message: types.Message):
     add_chat(message.chat.id)
     uid = str(message.from_user.id)
     user = get_user_data(uid)
-    kb = []
+    mask = user.costume_mask()
+    potion_counts = tuple(user.potion_count(key) for key in potions_data)
     text = "ИНВЕНТАРЬ\n\n"
-    if user["owned_costumes"]:
-        text += "КОСТЮМЫ:\n"
-        for key in user["owned_costumes"]:
-            data = costumes_data[key]
-            active = " (надет)" if user["costume"] == key else ""
-            kb.append([InlineKeyboardButton(text=f"{data['name']}{active}", callback_data=f"use_costume_{key}")])
-    else:
-        text += "Костюмов нет\n"
-    if user["owned_potions"]:
-        text += "\nЗЕЛЬЯ:\n"
-        count = Counter(user["owned_potions"])
-        for key, qty in count.items():
-            data = potions_data[key]
-            kb.append([InlineKeyboardButton(text=f"{data['name']} ×{qty}", callback_data=f"use_potion_{key}")])
-    else:
-        text += "\nЗелий нет\n"
+    text += "КОСТЮМЫ:\n" if mask else "Костюмов нет\n"
+    text += "\nЗЕЛЬЯ:\n" if any(potion_counts) else "\nЗелий нет\n"
     text += f"\nЛакрица: {user['licorice']} шт."
-    if user["clan"]:
-        text += f"\nЛакрица клана: {clans[user['clan']]['licorice']} шт."
-    await message.reply(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=kb) if kb else None)
+    clan = user_clan(user)
+    if clan is not None:
+        text += f"\nЛакрица клана: {clan['licorice']} шт."
+    await message.reply(text, reply_markup=inventory_keyboard(mask, user["costume"], potion_counts))
 
 @router.message(Command("profile"))
 async def profile(message: types.Message):
@@ -392,6 +982,8 @@ async def profile(message: types.Message):
     bonus = get_current_bonus(uid)
     costume = costumes_data.get(user["costume"], {"name": "Нет"})["name"] if user["costume"] else "Нет"
     clan_text = f"\nКлан: {user['clan']}" if user["clan"] else ""
+    rank, players = player_rank(uid)
+    rank_text = f"\nМесто: {rank} из {players} (топ {rank / players * 100:.1f}%)" if rank else ""
     text = (
         f"ПРОФИЛЬ: {name}\n\n"
         f"Конфет: {user['candies']}\n"
@@ -400,6 +992,7 @@ async def profile(message: types.Message):
         f"Бонус: +{bonus}\n"
         f"Лакрица: {user['licorice']}\n"
         f"Побед в дуэлях: {user.get('duel_wins', 0)}"
+        f"{rank_text}"
         f"{clan_text}"
     )
     await message.reply(text)
@@ -441,7 +1034,6 @@ async def claim_rewards(message: types.Message):
         add_candies(uid, reward)
     if licorice > 0:
         user["licorice"] += licorice
-    await save_all()
     await message.reply(f"Получено: +{reward} конфет, +{licorice} лакрица")
 
 @router.message(Command("duel"))
@@ -455,39 +1047,39 @@ async def duel(message: types.Message):
     if target == attacker:
         await message.reply("Нельзя себе!")
         return
-    attacker_user = get_user_data(attacker)
-    victim = get_user_data(target)
-    if attacker_user["candies"] < 10:
-        await message.reply("Нужно 10 конфет")
-        return
-    remove_candies(attacker, 10)
-    if victim["candies"] < 10:
-        add_candies(attacker, 10)
-        await message.reply("У соперника мало конфет")
-        return
-    remove_candies(target, 10)
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Камень", callback_data=f"duel_rock_{attacker}_{target}")],
-        [InlineKeyboardButton(text="Ножницы", callback_data=f"duel_scissors_{attacker}_{target}")],
-        [InlineKeyboardButton(text="Бумага", callback_data=f"duel_paper_{attacker}_{target}")]
-    ])
-    await message.reply("Дуэль! Выбери:", reply_markup=kb)
+    async with locks.hold(("user", attacker), ("user", target)):
+        attacker_user = get_user_data(attacker)
+        victim = get_user_data(target)
+        if attacker_user["candies"] < DUEL_STAKE:
+            await message.reply(f"Нужно {DUEL_STAKE} конфет")
+            return
+        if victim["candies"] < DUEL_STAKE:
+            await message.reply("У соперника мало конфет")
+            return
+        remove_candies(attacker, DUEL_STAKE)
+        remove_candies(target, DUEL_STAKE)
+        try:
+            msg = await message.reply("Дуэль! Выбери:", reply_markup=DUEL_KEYBOARD)
+        except Exception:
+            refund_candies(attacker, DUEL_STAKE)
+            refund_candies(target, DUEL_STAKE)
+            raise
+        pending.add(interaction_key(msg.chat.id, msg.message_id), "duel", DUEL_TIMEOUT, att=attacker, vic=target)
 
 @router.message(Command("buyclanlicorice"))
 async def buy_clan_licorice(message: types.Message):
     add_chat(message.chat.id)
     uid = str(message.from_user.id)
     user = get_user_data(uid)
-    if not user["clan"]:
+    if user_clan(user) is None:
         await message.reply("Ты не в клане!")
         return
     if user["candies"] < CLAN_LICORICE_PRICE:
         await message.reply("Недостаточно конфет!")
         return
     remove_candies(uid, CLAN_LICORICE_PRICE)
-    clans[user["clan"]]["licorice"] += 1
+    change_clan(user["clan"], "licorice", 1)
     user["challenges"]["buy"] += 1
-    await save_all()
     await message.reply("Лакрица для клана куплена!")
 
 # ====================== ВОЙНА КЛАНОВ ======================
@@ -497,17 +1089,18 @@ async def clan_war(message: types.Message):
     uid = str(message.from_user.id)
     user = get_user_data(uid)
     
-    if not user["clan"]:
+    clan = user_clan(user)
+    if clan is None:
         await message.reply("Ты не в клане!")
         return
-    if clans[user["clan"]]["owner"] != uid:
+    if clan["owner"] != uid:
         await message.reply("Только владелец клана может начинать войну!")
         return
     if not message.reply_to_message:
         await message.reply("Реплай на сообщение с названием клана!")
         return
-    target_clan = message.reply_to_message.text.strip()
-    if target_clan not in clans:
+    target_clan = clans.find(message.reply_to_message.text or "")
+    if target_clan is None:
         await message.reply("Клан не найден!")
         return
     attacker_clan = user["clan"]
@@ -515,53 +1108,53 @@ async def clan_war(message: types.Message):
         await message.reply("Нельзя атаковать свой клан!")
         return
     
-    now = datetime.now(timezone.utc)
-    last = clan_war_cooldowns.get(attacker_clan)  # Кулдаун по клану
-    if last and now - last < timedelta(minutes=10):
-        rem = 600 - int((now - last).total_seconds())
-        m, s = divmod(rem, 60)
-        await message.reply(f"Подожди {m}м {s}с")
-        return
-    clan_war_cooldowns[attacker_clan] = now
+    async with locks.hold(("clan", attacker_clan), ("clan", target_clan)):
+        now = datetime.now(timezone.utc)
+        # Под блокировкой кланы перечитаны из базы: любой из них мог быть распущен
+        attacker_clan_data = clans.get(attacker_clan)
+        target_clan_data = clans.get(target_clan)
+        if attacker_clan_data is None or target_clan_data is None:
+            await message.reply("Клан не найден!")
+            return
+        rem = await claim_cooldown(clan_war_cooldowns, attacker_clan, CLAN_WAR_COOLDOWN)  # Кулдаун по клану
+        if rem > 0:
+            await message.reply(format_wait(rem))
+            return
     
-    attacker_clan_data = clans[attacker_clan]
-    if attacker_clan_data["candies"] < CLAN_WAR_COST:
-        await message.reply(f"Нужно {CLAN_WAR_COST} конфет в казне клана!")
-        return
+        if attacker_clan_data["candies"] < CLAN_WAR_COST:
+            await message.reply(f"Нужно {CLAN_WAR_COST} конфет в казне клана!")
+            return
     
-    attacker_clan_data["candies"] -= CLAN_WAR_COST
+        change_clan(attacker_clan, "candies", -CLAN_WAR_COST)
     
-    multiplier = 1
-    if message.chat.id in RAID_ACTIVE and RAID_ACTIVE[message.chat.id] > now:
-        multiplier *= 2
-    if now >= FINAL_EVENT_TIME:
-        multiplier *= 5
+        multiplier = 1
+        if message.chat.id in RAID_ACTIVE and RAID_ACTIVE[message.chat.id] > now:
+            multiplier *= 2
+        if now >= FINAL_EVENT_TIME:
+            multiplier *= 5
     
-    bonus = get_current_bonus(attacker_clan_data["owner"])
-    target_clan_data = clans[target_clan]
-    if target_clan_data["licorice"] > 0:
-        target_clan_data["licorice"] -= 1
-        await save_all()
-        await message.reply(f"Клан {target_clan} защищён лакрицей! Атака провалилась.\nЛакриц у {target_clan}: {target_clan_data['licorice']}")
-        return
+        bonus = get_current_bonus(attacker_clan_data["owner"])
+        if target_clan_data["licorice"] > 0:
+            change_clan(target_clan, "licorice", -1)
+            await message.reply(f"Клан {target_clan} защищён лакрицей! Атака провалилась.\nЛакриц у {target_clan}: {target_clan_data['licorice']}")
+            return
     
-    attacker_members = len(attacker_clan_data["members"]) + 1
-    target_members = len(target_clan_data["members"]) + 1
-    success_chance = 0.6 * (attacker_members / max(target_members, 1))
-    success = random.random() < success_chance
-    if success:
-        steal_amount = (20 + bonus) * multiplier
-        steal_amount = min(steal_amount, target_clan_data["candies"])
-        target_clan_data["candies"] = max(0, target_clan_data["candies"] - steal_amount)
-        attacker_clan_data["candies"] += steal_amount
-        await message.reply(f"Атака успешна! Клан {attacker_clan} украл {steal_amount} конфет у {target_clan}!")
-        try:
-            await bot.send_message(target_clan_data["owner"], f"Ваш клан {target_clan} был атакован кланом {attacker_clan}! Потеряно {steal_amount} конфет.")
-        except Exception as e:
-            logging.error(f"Ошибка отправки уведомления владельцу клана {target_clan}: {e}")
-    else:
-        await message.reply(f"Атака провалилась! Клан {target_clan} отбился.")
-    await save_all()
+        attacker_members = len(attacker_clan_data["members"]) + 1
+        target_members = len(target_clan_data["members"]) + 1
+        success_chance = 0.6 * (attacker_members / max(target_members, 1))
+        success = random.random() < success_chance
+        if success:
+            steal_amount = (20 + bonus) * multiplier
+            steal_amount = max(0, min(steal_amount, target_clan_data["candies"]))
+            change_clan(target_clan, "candies", -steal_amount)
+            change_clan(attacker_clan, "candies", steal_amount)
+            await message.reply(f"Атака успешна! Клан {attacker_clan} украл {steal_amount} конфет у {target_clan}!")
+            try:
+                await bot.send_message(target_clan_data["owner"], f"Ваш клан {target_clan} был атакован кланом {attacker_clan}! Потеряно {steal_amount} конфет.")
+            except Exception as e:
+                logging.error(f"Ошибка отправки уведомления владельцу клана {target_clan}: {e}")
+        else:
+            await message.reply(f"Атака провалилась! Клан {target_clan} отбился.")
 
 # ====================== TRICK OR TREAT ======================
 @router.message(Command("trickortreat", ignore_case=True))
@@ -584,13 +1177,10 @@ async def trick_or_treat(message: types.Message):
         return
 
     now = datetime.now(timezone.utc)
-    last = cooldowns.get(attacker)
-    if last and now - last < timedelta(minutes=10):
-        rem = 600 - int((now - last).total_seconds())
-        m, s = divmod(rem, 60)
-        await message.reply(f"Подожди {m}м {s}с")
+    rem = await claim_cooldown(cooldowns, attacker, ATTACK_COOLDOWN)
+    if rem > 0:
+        await message.reply(format_wait(rem))
         return
-    cooldowns[attacker] = now
 
     multiplier = 1
     if message.chat.id in RAID_ACTIVE and RAID_ACTIVE[message.chat.id] > now:
@@ -598,176 +1188,194 @@ async def trick_or_treat(message: types.Message):
     if now >= FINAL_EVENT_TIME:
         multiplier *= 5
 
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Сладость", callback_data=f"sweet_{attacker}_{target}_{multiplier}")],
-        [InlineKeyboardButton(text="Гадость", callback_data=f"trick_{attacker}_{target}")]
-    ])
-    msg = await message.reply(f"{tname}, тебе кинули 'Сладость или гадость'!\nВыбор: 2 минуты.", reply_markup=kb)
-    asyncio.create_task(remove_markup_later(msg))
+    msg = await message.reply(f"{tname}, тебе кинули 'Сладость или гадость'!\nВыбор: {TRICK_TIMEOUT // 60} минуты.", reply_markup=TRICK_KEYBOARD)
+    pending.add(interaction_key(msg.chat.id, msg.message_id), "trick", TRICK_TIMEOUT,
+                att=attacker, vic=target, multiplier=multiplier)
 
 # ====================== CALLBACKS ======================
-async def remove_markup_later(msg: types.Message):
-    await asyncio.sleep(120)
+# Истечение ожидающих сообщений: кнопки убираются, ставки дуэли возвращаются обоим
+async def expire_interaction(key, entry):
+    chat_id, message_id = (int(part) for part in key.split(":"))
     try:
-        await msg.edit_reply_markup(reply_markup=None)
+        if entry["kind"] == "duel":
+            token = begin_update()
+            try:
+                async with locks.hold(("user", entry["att"]), ("user", entry["vic"])):
+                    refund_candies(entry["att"], DUEL_STAKE)
+                    refund_candies(entry["vic"], DUEL_STAKE)
+            finally:
+                end_update(token)
+            await bot.edit_message_text(
+                f"Дуэль не состоялась — по {DUEL_STAKE} конфет возвращено обоим.",
+                chat_id=chat_id, message_id=message_id
+            )
+        else:
+            await bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=None)
     except Exception as e:
-        logging.error(f"Ошибка удаления разметки: {e}")
+        logging.error(f"Ошибка истечения {entry['kind']} {key}: {e}")
 
-@router.callback_query(F.data.startswith("sweet_") | F.data.startswith("trick_"))
-async def process_choice(callback: types.CallbackQuery):
+def claim_interaction(callback: types.CallbackQuery, kind):
+    # Запись ожидающего сообщения, если жмёт нужный игрок; None — уже обработано или истекло
+    key = interaction_key(callback.message.chat.id, callback.message.message_id)
+    entry = pending.get(key)
+    if entry is None or entry["kind"] != kind:
+        return key, None
+    if str(callback.from_user.id) != entry["vic"]:
+        return key, entry
+    return key, pending.claim(key)
+
+@router.callback_query(Trick.filter())
+async def process_choice(callback: types.CallbackQuery, callback_data: Trick):
     try:
-        if callback.message.reply_markup is None:
+        key, entry = claim_interaction(callback, "trick")
+        if entry is None:
             await callback.answer("Уже обработано!", show_alert=True)
             return
-        parts = callback.data.split("_")
-        choice = parts[0]
-        att, vic = parts[1], parts[2]
-        multiplier = int(parts[3]) if len(parts) > 3 and choice == "sweet" else 1
+        att, vic = entry["att"], entry["vic"]
+        multiplier = entry["multiplier"] if callback_data.sweet else 1
         if str(callback.from_user.id) != vic:
             await callback.answer("Не твой выбор!", show_alert=True)
             return
-        attacker = get_user_data(att)
-        victim = get_user_data(vic)
-        bonus = get_current_bonus(att)
-        now = datetime.now(timezone.utc)
-        if choice == "sweet":
-            if victim["licorice"] > 0:
-                victim["licorice"] -= 1
-                text = f"Сладость! Но была лакрица.\nЛакриц: {victim['licorice']}"
+        async with locks.hold(("user", att), ("user", vic)):
+            attacker = get_user_data(att)
+            victim = get_user_data(vic)
+            bonus = get_current_bonus(att)
+            now = datetime.now(timezone.utc)
+            if callback_data.sweet:
+                if victim["licorice"] > 0:
+                    victim["licorice"] -= 1
+                    text = f"Сладость! Но была лакрица.\nЛакриц: {victim['licorice']}"
+                else:
+                    loss = 5
+                    remove_candies(vic, loss)
+                    add_candies(att, (5 + bonus) * multiplier)
+                    text = f"Сладость!\nУкрадено: {loss * multiplier} + {bonus * multiplier} бонус"
             else:
-                loss = 5
-                remove_candies(vic, loss)
-                add_candies(att, (5 + bonus) * multiplier)
-                text = f"Сладость!\nУкрадено: {loss * multiplier} + {bonus * multiplier} бонус"
-            await save_all()
-        else:
-            try:
-                await bot.restrict_chat_member(
-                    callback.message.chat.id, int(vic),
-                    types.ChatPermissions(can_send_messages=False),
-                    until_date=now + timedelta(minutes=2)
-                )
-                text = "Гадость! Мут 2 минуты."
-            except Exception as e:
-                logging.error(f"Ошибка мута пользователя {vic}: {e}")
-                await callback.answer("Не удалось замутить.", show_alert=True)
-                return
-        await callback.message.edit_text(text)
-        await callback.message.edit_reply_markup(reply_markup=None)
+                try:
+                    await bot.restrict_chat_member(
+                        callback.message.chat.id, int(vic),
+                        types.ChatPermissions(can_send_messages=False),
+                        until_date=now + timedelta(minutes=2)
+                    )
+                    text = "Гадость! Мут 2 минуты."
+                except Exception as e:
+                    logging.error(f"Ошибка мута пользователя {vic}: {e}")
+                    pending.restore(key, entry)  # Кнопки остаются, можно выбрать ещё раз
+                    await callback.answer("Не удалось замутить.", show_alert=True)
+                    return
+            await callback.message.edit_text(text)
+            await callback.message.edit_reply_markup(reply_markup=None)
     except Exception as e:
         logging.error(f"Ошибка в sweet/trick: {e}")
 
-@router.callback_query(F.data.startswith("buy_"))
-async def buy_item(callback: types.CallbackQuery):
+@router.callback_query(Buy.filter())
+async def buy_item(callback: types.CallbackQuery, callback_data: Buy):
     uid = str(callback.from_user.id)
-    user = get_user_data(uid)
-    item = callback.data.split("_", 1)[1]
-    if item.startswith("costume_"):
-        key = item.split("_")[1]
-        price = costumes_data[key]["price"]
-        if user["candies"] < price:
-            await callback.answer("Недостаточно конфет!")
-            return
-        if key in user["owned_costumes"]:
-            await callback.answer("Уже куплено!")
-            return
-        remove_candies(uid, price)
-        user["owned_costumes"].append(key)
-        if not user["costume"]:
-            user["costume"] = key
-        user["challenges"]["buy"] += 1
-        await save_all()
-        await callback.answer(f"Куплено: {costumes_data[key]['name']}!")
-        await callback.message.edit_reply_markup(reply_markup=None)
-    elif item.startswith("potion_"):
-        key = item.split("_")[1]
-        price = potions_data[key]["price"]
-        if user["candies"] < price:
-            await callback.answer("Недостаточно конфет!")
-            return
-        remove_candies(uid, price)
-        user["owned_potions"].append(key)
-        await save_all()
-        await callback.answer(f"Куплено: {potions_data[key]['name']}!")
-        await callback.message.edit_reply_markup(reply_markup=None)
-    elif item == "licorice":
-        if user["candies"] < LICORICE_PRICE:
-            await callback.answer("Недостаточно конфет!")
-            return
-        remove_candies(uid, LICORICE_PRICE)
-        user["licorice"] += 1
-        user["challenges"]["buy"] += 1
-        await save_all()
-        await callback.answer("Лакрица куплена!")
-        await callback.message.edit_reply_markup(reply_markup=None)
-    elif item == "clan_licorice":
-        if not user["clan"]:
-            await callback.answer("Ты не в клане!")
-            return
-        if user["candies"] < CLAN_LICORICE_PRICE:
-            await callback.answer("Недостаточно конфет!")
-            return
-        remove_candies(uid, CLAN_LICORICE_PRICE)
-        clans[user["clan"]]["licorice"] += 1
-        user["challenges"]["buy"] += 1
-        await save_all()
-        await callback.answer("Лакрица для клана куплена!")
-        await callback.message.edit_reply_markup(reply_markup=None)
-
-@router.callback_query(F.data.startswith("use_"))
-async def use_item(callback: types.CallbackQuery):
+    item, key = callback_data.item, callback_data.key
+    catalog = {Item.COSTUME: costumes_data, Item.POTION: potions_data}.get(item)
+    if catalog is not None and key not in catalog:
+        await callback.answer("Товара больше нет в магазине", show_alert=True)
+        return
+    async with locks.hold(("user", uid)):
+        user = get_user_data(uid)
+        if item == Item.COSTUME:
+            price = costumes_data[key]["price"]
+            if user["candies"] < price:
+                await callback.answer("Недостаточно конфет!")
+                return
+            if user.has_costume(key):
+                await callback.answer("Уже куплено!")
+                return
+            remove_candies(uid, price)
+            user.add_costume(key)
+            if not user["costume"]:
+                user["costume"] = key
+            user["challenges"]["buy"] += 1
+            await callback.answer(f"Куплено: {costumes_data[key]['name']}!")
+            await callback.message.edit_reply_markup(reply_markup=None)
+        elif item == Item.POTION:
+            price = potions_data[key]["price"]
+            if user["candies"] < price:
+                await callback.answer("Недостаточно конфет!")
+                return
+            remove_candies(uid, price)
+            user.add_potion(key)
+            await callback.answer(f"Куплено: {potions_data[key]['name']}!")
+            await callback.message.edit_reply_markup(reply_markup=None)
+        elif item == Item.LICORICE:
+            if user["candies"] < LICORICE_PRICE:
+                await callback.answer("Недостаточно конфет!")
+                return
+            remove_candies(uid, LICORICE_PRICE)
+            user["licorice"] += 1
+            user["challenges"]["buy"] += 1
+            await callback.answer("Лакрица куплена!")
+            await callback.message.edit_reply_markup(reply_markup=None)
+        elif item == Item.CLAN_LICORICE:
+            if user_clan(user) is None:
+                await callback.answer("Ты не в клане!")
+                return
+            if user["candies"] < CLAN_LICORICE_PRICE:
+                await callback.answer("Недостаточно конфет!")
+                return
+            remove_candies(uid, CLAN_LICORICE_PRICE)
+            change_clan(user["clan"], "licorice", 1)
+            user["challenges"]["buy"] += 1
+            await callback.answer("Лакрица для клана куплена!")
+            await callback.message.edit_reply_markup(reply_markup=None)
+
+@router.callback_query(Use.filter())
+async def use_item(callback: types.CallbackQuery, callback_data: Use):
     uid = str(callback.from_user.id)
     user = get_user_data(uid)
-    item = callback.data.split("_", 1)[1]
-    if item.startswith("costume_"):
-        key = item.split("_")[1]
-        if key not in user["owned_costumes"]:
+    item, key = callback_data.item, callback_data.key
+    if key not in {Item.COSTUME: costumes_data, Item.POTION: potions_data}.get(item, ()):
+        await callback.answer("Предмет больше не существует", show_alert=True)
+        return
+    if item == Item.COSTUME:
+        if not user.has_costume(key):
             await callback.answer("Нет в инвентаре!")
             return
         user["costume"] = key
-        await save_all()
         await callback.answer(f"Надет: {costumes_data[key]['name']}")
-    elif item.startswith("potion_"):
-        key = item.split("_")[1]
-        if key not in user["owned_potions"]:
+    else:
+        if not user.take_potion(key):
             await callback.answer("Нет в инвентаре!")
             return
-        user["owned_potions"].remove(key)
         if key == "temp_boost":
             user["active_potions"]["temp_boost"] = (datetime.now(timezone.utc) + timedelta(minutes=potions_data[key]["duration"])).isoformat()
         elif key == "perm_boost":
             user["active_potions"]["perm_boost"] = user["active_potions"].get("perm_boost", 0) + potions_data[key]["bonus"]
-        await save_all()
         await callback.answer(f"Использовано: {potions_data[key]['name']}")
     await callback.message.edit_reply_markup(reply_markup=None)
 
-@router.callback_query(F.data.startswith("duel_"))
-async def process_duel(callback: types.CallbackQuery):
+@router.callback_query(Duel.filter())
+async def process_duel(callback: types.CallbackQuery, callback_data: Duel):
     try:
-        parts = callback.data.split("_")
-        choice = parts[1]
-        att, vic = parts[2], parts[3]
+        choice = callback_data.move
+        _, entry = claim_interaction(callback, "duel")
+        if entry is None:
+            await callback.answer("Дуэль уже завершена!", show_alert=True)
+            return
+        att, vic = entry["att"], entry["vic"]
         if str(callback.from_user.id) != vic:
             await callback.answer("Не твоя дуэль!", show_alert=True)
             return
-        choices = ["rock", "scissors", "paper"]
-        att_choice = random.choice(choices)
-        if att_choice == choice:
-            add_candies(att, 10)
-            add_candies(vic, 10)
-            await callback.message.edit_text("Ничья! +10 конфет каждому.")
-        elif (att_choice == "rock" and choice == "scissors") or \
-             (att_choice == "scissors" and choice == "paper") or \
-             (att_choice == "paper" and choice == "rock"):
-            add_candies(att, 20)
-            get_user_data(att)["duel_wins"] += 1
-            await callback.message.edit_text(f"Ты проиграл! Противник +20 конфет")
-        else:
-            add_candies(vic, 20)
-            get_user_data(vic)["duel_wins"] += 1
-            await callback.message.edit_text(f"Ты выиграл! +20 конфет")
-        await callback.message.edit_reply_markup(reply_markup=None)
-        await save_all()
+        async with locks.hold(("user", att), ("user", vic)):
+            att_choice = random.choice(list(Move))
+            if att_choice == choice:
+                add_candies(att, 10)
+                add_candies(vic, 10)
+                await callback.message.edit_text("Ничья! +10 конфет каждому.")
+            elif BEATS[att_choice] == choice:
+                add_candies(att, 20)
+                get_user_data(att)["duel_wins"] += 1
+                await callback.message.edit_text(f"Ты проиграл! Противник +20 конфет")
+            else:
+                add_candies(vic, 20)
+                get_user_data(vic)["duel_wins"] += 1
+                await callback.message.edit_text(f"Ты выиграл! +20 конфет")
+            await callback.message.edit_reply_markup(reply_markup=None)
     except Exception as e:
         logging.error(f"Дуэль: {e}")
 
@@ -781,21 +1389,25 @@ async def use_promo(message: types.Message):
         await message.reply("Формат: /promo CODE")
         return
     code = args[1].upper()
-    if code not in promo_codes:
+    async with locks.hold(("promo", code)):
+        promo = promo_codes.get(code)
+        status = promo.redeem(uid) if promo is not None else None
+        if status == promos.OK:
+            add_candies(uid, promo.candies)
+            mark_dirty("promo", code)
+    if promo is None:
         await message.reply("Промокод не найден")
         return
-    promo = promo_codes[code]
-    if uid in promo["used_by"]:
+    if status == promos.USED:
         await message.reply("Ты уже использовал")
         return
-    max_uses = promo.get("max_uses")
-    if max_uses and len(promo["used_by"]) >= max_uses:
+    if status == promos.EXPIRED:
+        await message.reply("Срок действия промокода истёк")
+        return
+    if status == promos.LIMIT:
         await message.reply("Лимит исчерпан")
         return
-    add_candies(uid, promo["candies"])
-    promo["used_by"].append(uid)
-    await save_all()
-    await message.reply(f"Промокод `{code}`: +{promo['candies']} конфет")
+    await message.reply(f"Промокод `{code}`: +{promo.candies} конфет")
 
 # ====================== КЛАНЫ ======================
 @router.message(Command("clan"))
@@ -803,100 +1415,106 @@ async def clan_menu(message: types.Message):
     add_chat(message.chat.id)
     uid = str(message.from_user.id)
     user = get_user_data(uid)
-    kb = []
     text = "КЛАНЫ\n\n"
-    if user["clan"]:
-        clan = clans[user["clan"]]
+    clan = user_clan(user)
+    if clan is not None:
         members = len(clan["members"]) + 1
         text += f"Твой клан: {user['clan']}\n"
         text += f"Участников: {members}\n"
         text += f"Конфет: {clan['candies']}\n"
         text += f"Лакриц: {clan['licorice']}\n"
         text += "Участники:\n"
-        try:
-            owner = await bot.get_chat(int(clan["owner"]))
-            text += f"- {owner.first_name} (владелец)\n"
-        except Exception as e:
-            logging.error(f"Ошибка получения владельца клана {clan['owner']}: {e}")
-            text += f"- User #{clan['owner']} (владелец)\n"
-        for member in clan["members"]:
-            try:
-                member_user = await bot.get_chat(int(member))
-                text += f"- {member_user.first_name}\n"
-            except Exception as e:
-                logging.error(f"Ошибка получения участника клана {member}: {e}")
-                text += f"- User #{member}\n"
-        if clan["owner"] == uid:
-            kb.append([InlineKeyboardButton(text="Распустить клан", callback_data="disband_clan")])
-        else:
-            kb.append([InlineKeyboardButton(text="Выйти", callback_data="leave_clan")])
+        members = sorted(clan.members)
+        member_names = await resolve_names([clan.owner, *members])
+        text += f"- {member_names[str(clan.owner)]} (владелец)\n"
+        for member in members:
+            text += f"- {member_names[str(member)]}\n"
+        kb = OWNER_CLAN_KEYBOARD if clan["owner"] == uid else MEMBER_CLAN_KEYBOARD
     else:
         text += "Ты не в клане.\n"
-        kb.append([InlineKeyboardButton(text="Создать клан (100 конфет)", callback_data="create_clan")])
-        kb.append([InlineKeyboardButton(text="Присоединиться", callback_data="join_clan")])
-    await message.reply(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
+        kb = NO_CLAN_KEYBOARD
+    await message.reply(text, reply_markup=kb)
 
-@router.callback_query(F.data == "create_clan")
+@router.callback_query(Clan.filter(F.action == ClanAction.CREATE))
 async def create_clan(callback: types.CallbackQuery):
     uid = str(callback.from_user.id)
     user = get_user_data(uid)
     if user["candies"] < 100:
         await callback.answer("Нужно 100 конфет!")
         return
-    if user["clan"]:
+    if clans.clan_of(uid):
         await callback.answer("Ты уже в клане!")
         return
     base_name = callback.from_user.first_name[:20]
     clan_name = f"Клан {base_name}"
     i = 1
-    while clan_name in clans:
+    while clans.name_taken(clan_name):
         clan_name = f"Клан {base_name} {i}"
         i += 1
-    remove_candies(uid, 100)
-    clans[clan_name] = {"owner": uid, "members": [], "candies": 0, "licorice": 0}
-    user["clan"] = clan_name
-    await save_all()
+    # Игрок и клан вместе (hold берёт ключи в одном порядке): второй create/join того же игрока ждёт здесь
+    async with locks.hold(("clan", clan_name), ("user", uid)):
+        if clans.clan_of(uid) or user["clan"]:
+            await callback.answer("Ты уже в клане!")
+            return
+        if user["candies"] < 100:
+            await callback.answer("Нужно 100 конфет!")
+            return
+        if clan_name in clans:  # Режим воркеров: название только что занял другой процесс
+            await callback.answer("Название занято, попробуй ещё раз")
+            return
+        remove_candies(uid, 100)
+        clans.create(clan_name, uid)
+        mark_dirty("clan", clan_name)
+        update_clan_rank(clan_name)
+        user["clan"] = clan_name
     await callback.answer(f"Клан создан: {clan_name}")
     await callback.message.edit_reply_markup(reply_markup=None)
 
-@router.callback_query(F.data == "disband_clan")
+@router.callback_query(Clan.filter(F.action == ClanAction.DISBAND))
 async def disband_clan(callback: types.CallbackQuery):
     uid = str(callback.from_user.id)
     user = get_user_data(uid)
-    if not user["clan"] or clans[user["clan"]]["owner"] != uid:
+    clan_name = clans.clan_of(uid)
+    if not clan_name:
         await callback.answer("Ты не владелец!")
         return
-    clan_name = user["clan"]
-    for member in clans[clan_name]["members"]:
-        get_user_data(member)["clan"] = None
-    del clans[clan_name]
-    user["clan"] = None
-    await save_all()
+    async with locks.hold(("clan", clan_name)):
+        if clan_name not in clans or clans[clan_name].owner != uid:
+            await callback.answer("Ты не владелец!")
+            return
+        # Участникам только снимаем клан — без get_user_data и их дневных сбросов
+        await set_player_clans(dict.fromkeys(clans.disband(clan_name)))
+        mark_dirty("clan", clan_name)
+        clan_ranks.discard(clan_name)
+        user["clan"] = None
     await callback.answer(f"Клан {clan_name} распущен.")
     await callback.message.edit_reply_markup(reply_markup=None)
 
-@router.callback_query(F.data == "leave_clan")
+@router.callback_query(Clan.filter(F.action == ClanAction.LEAVE))
 async def leave_clan(callback: types.CallbackQuery):
     uid = str(callback.from_user.id)
     user = get_user_data(uid)
-    if not user["clan"]:
+    clan_name = clans.clan_of(uid)
+    if not clan_name:
         await callback.answer("Ты не в клане!")
         return
-    clan = clans[user["clan"]]
-    if clan["owner"] == uid:
-        await callback.answer("Владелец не может выйти! Распусти клан.")
-        return
-    clan["members"].remove(uid)
-    user["clan"] = None
-    await save_all()
+    async with locks.hold(("clan", clan_name)):
+        if clans.clan_of(uid) != clan_name:
+            await callback.answer("Ты не в клане!")
+            return
+        if clans[clan_name].owner == uid:
+            await callback.answer("Владелец не может выйти! Распусти клан.")
+            return
+        clans.leave(uid)
+        mark_dirty("clan", clan_name)
+        user["clan"] = None
     await callback.answer("Ты вышел из клана.")
     await callback.message.edit_reply_markup(reply_markup=None)
 
-@router.callback_query(F.data == "join_clan")
+@router.callback_query(Clan.filter(F.action == ClanAction.JOIN))
 async def join_clan(callback: types.CallbackQuery, state: FSMContext):
     uid = str(callback.from_user.id)
-    user = get_user_data(uid)
-    if user["clan"]:
+    if clans.clan_of(uid):
         await callback.answer("Ты уже в клане!")
         return
     await state.set_state(ClanStates.JOIN_CLAN)
@@ -906,27 +1524,39 @@ async def join_clan(callback: types.CallbackQuery, state: FSMContext):
 @router.message(ClanStates.JOIN_CLAN)
 async def process_join_clan(message: types.Message, state: FSMContext):
     uid = str(message.from_user.id)
-    clan_name = message.text.strip()
-    if clan_name not in clans:
+    await state.clear()
+    clan_name = clans.find(message.text or "")
+    if clan_name is None:
         await message.reply("Клан не найден!")
-        await state.finish()
         return
-    clan = clans[clan_name]
-    if len(clan["members"]) + 1 >= MAX_CLAN_MEMBERS:
-        await message.reply("Клан переполнен!")
-        await state.finish()
+    if clans.clan_of(uid):
+        await message.reply("Ты уже в клане!")
         return
-    user = get_user_data(uid)
-    user["clan"] = clan_name
-    clan["members"].append(uid)
-    await save_all()
+    async with locks.hold(("clan", clan_name), ("user", uid)):
+        if clan_name not in clans:
+            await message.reply("Клан не найден!")
+            return
+        if clans.clan_of(uid) or get_user_data(uid)["clan"]:
+            await message.reply("Ты уже в клане!")
+            return
+        if len(clans[clan_name]) >= MAX_CLAN_MEMBERS:
+            await message.reply("Клан переполнен!")
+            return
+        clans.join(clan_name, uid)
+        get_user_data(uid)["clan"] = clan_name
+        mark_dirty("clan", clan_name)
     await message.reply(f"Ты вступил в клан {clan_name}!")
-    await state.finish()
+
+# Кнопка, не совпавшая ни с одним обработчиком: старая версия callback_data или испорченные данные.
+# Должен регистрироваться после всех обработчиков кнопок
+@router.callback_query()
+async def stale_button(callback: types.CallbackQuery):
+    await callback.answer("Кнопка устарела — вызови команду ещё раз", show_alert=True)
 
 @router.message(Command("topclans"))
 async def top_clans(message: types.Message):
     add_chat(message.chat.id)
-    sorted_clans = sorted(clans.items(), key=lambda x: x[1]["candies"], reverse=True)[:5]
+    sorted_clans = [(name, clans[name]) for name, _ in clan_ranks.top(5) if name in clans]
     text = "ТОП-5 КЛАНОВ:\n"
     for i, (name, data) in enumerate(sorted_clans, 1):
         members = len(data["members"]) + 1
@@ -936,28 +1566,95 @@ async def top_clans(message: types.Message):
 # ====================== АДМИН-ПАНЕЛЬ ======================
 @router.message(Command("admin"))
 async def admin_panel(message: types.Message):
-    if not await is_admin(message.from_user.id):
+    if not is_admin(message.from_user):
         await message.reply("Ты не админ.")
         return
+    lock_stats = locks.stats()
     text = (
         "АДМИН-ПАНЕЛЬ\n\n"
-        f"Игроков: {len(candies)}\n"
+        f"Игроков: {len(user_ranks)}\n"
         f"Кланов: {len(clans)}\n"
-        f"Чатов: {len(active_chats)}\n"
-        f"Онлайн: {len(set(cooldowns.keys()))}\n\n"
+        f"Чатов: {len(active_chats)}, с командами за {RAID_ACTIVE_HOURS:g} ч: {len(active_chats.recent(time.time() - RAID_ACTIVE_HOURS * 3600))}\n"
+        f"Онлайн ({ONLINE_WINDOW // 60} мин): {len(online_users)}\n"
+        f"Задержка сохранения: {flush_lag():.1f} с\n"
+        f"Ожидание блокировок: ср. {lock_stats['wait_avg_ms']:.1f} мс, макс. {lock_stats['wait_max_ms']:.1f} мс "
+        f"({lock_stats['contended']}/{lock_stats['acquired']})\n\n"
         "Команды:\n"
         "/announce TEXT — рассылка\n"
+        "/latency [reset] — задержки команд\n"
+        "/clancheck — сверка кланов и казны\n"
         "/addcandies — реплай + N конфет → дать\n"
         "/removecandies — реплай + N конфет → забрать\n"
-        "/createpromo CODE N — создать промокод\n"
+        "/createpromo CODE N [MAX] [СРОК] — создать промокод\n"
+        "/mintpromos K N [СРОК] [ПРЕФИКС] — K одноразовых кодов на N конфет\n"
         "/deletepromo CODE — удалить промокод\n"
-        "/listpromos — список промокодов"
+        "/listpromos [СТРАНИЦА] — список промокодов\n"
+        "СРОК: 30m, 12h, 7d"
     )
     await message.reply(text)
 
+@router.message(Command("latency"))
+async def latency_report(message: types.Message):
+    if not is_admin(message.from_user):
+        await message.reply("Ты не админ.")
+        return
+    if message.text.split()[1:] == ["reset"]:
+        latency.reset()
+        await message.reply("Замеры сброшены.")
+        return
+    await message.reply(latency.format_table())
+
+@router.message(Command("clancheck"))
+async def clan_check(message: types.Message):
+    if not is_admin(message.from_user):
+        await message.reply("Ты не админ.")
+        return
+    if store:
+        # В sqlite сверяются только участники кланов: ради поля clan читать всю базу слишком дорого.
+        # Записи читаются из базы заново (кроме тех, что этот процесс ещё не сохранил)
+        uids = list(clans.members())
+        for uid in uids:
+            if ("user", uid) not in _dirty and uid not in _users_in_use:
+                candies.evict(uid)
+        candies.merge(await asyncio.to_thread(candies.prefetch_missing, uids))
+        users = [(uid, user) for uid in uids if (user := candies.cached(uid)) is not None]
+    else:
+        users = candies.items()
+    fixed = clans.audit(users)
+    await set_player_clans({uid: new for uid, _, new in fixed})
+    totals = clans.member_totals(candies.get)
+    diffs = [(name, clans[name].candies, total) for name, total in totals.items() if clans[name].candies != total]
+    text = f"Кланов: {len(clans)}, участников: {len(clans.members())}\n"
+    text += f"Исправлено поле клана у игроков: {len(fixed)}\n"
+    for uid, old, new in fixed[:CLAN_CHECK_LINES]:
+        text += f"- {uid}: {old or '—'} → {new or '—'}\n"
+    # Только для сведения: в казну не входит собранное до вступления, а войны и лакрица её тратят,
+    # так что сумма total_candies участников — не правильный баланс, и казна не переписывается
+    text += f"\nКазна не равна сумме конфет участников: {len(diffs)}\n"
+    for name, treasury, total in diffs[:CLAN_CHECK_LINES]:
+        text += f"- {name}: {treasury} / {total}\n"
+    await message.reply(text)
+
+@router.message(Command("announce"))
+async def announce(message: types.Message):
+    if not is_admin(message.from_user):
+        await message.reply("Ты не админ.")
+        return
+    args = message.text.split(maxsplit=1)
+    if len(args) != 2 or not args[1].strip():
+        await message.reply("Формат: /announce TEXT\n\n" + broadcaster.status_text())
+        return
+    if broadcaster.running:
+        await message.reply("Рассылка уже идёт.\n\n" + broadcaster.status_text())
+        return
+    # В режиме воркеров — все чаты из базы, а не только чаты этого процесса
+    chat_ids = await asyncio.to_thread(store.chat_ids) if SHARED else active_chats
+    progress = await message.reply(f"Рассылка запущена: 0/{len(chat_ids)}")
+    broadcaster.start(args[1].strip(), chat_ids, message.chat.id, progress.message_id)
+
 @router.message(Command("addcandies"))
 async def add_candies_admin(message: types.Message):
-    if not await is_admin(message.from_user.id):
+    if not is_admin(message.from_user):
         await message.reply("Ты не админ.")
         return
     if not message.reply_to_message:
@@ -980,7 +1677,7 @@ async def add_candies_admin(message: types.Message):
 
 @router.message(Command("removecandies"))
 async def remove_candies_admin(message: types.Message):
-    if not await is_admin(message.from_user.id):
+    if not is_admin(message.from_user):
         await message.reply("Ты не админ.")
         return
     if not message.reply_to_message:
@@ -1003,22 +1700,58 @@ async def remove_candies_admin(message: types.Message):
 
 @router.message(Command("createpromo"))
 async def create_promo(message: types.Message):
-    if not await is_admin(message.from_user.id):
+    if not is_admin(message.from_user):
         await message.reply("Ты не админ.")
         return
     args = message.text.split()
-    if len(args) != 3 or not args[2].isdigit():
-        await message.reply("Формат: /createpromo CODE N")
+    ttl = promos.parse_ttl(args[4]) if len(args) == 5 else None
+    if len(args) not in (3, 4, 5) or not args[2].isdigit() or (len(args) >= 4 and not args[3].isdigit()) \
+            or (len(args) == 5 and ttl is None):
+        await message.reply("Формат: /createpromo CODE N [MAX] [СРОК]\nMAX 0 — без лимита, СРОК: 30m, 12h, 7d")
         return
     code = args[1].upper()
     candies_amt = int(args[2])
-    promo_codes[code] = {"candies": candies_amt, "used_by": []}
-    await save_all()
-    await message.reply(f"Промокод {code} создан на {candies_amt} конфет")
+    max_uses = int(args[3]) if len(args) >= 4 else None
+    promo_codes[code] = PromoRecord(candies_amt, max_uses or None, time.time() + ttl if ttl else None)
+    mark_dirty("promo", code)
+    await message.reply(f"Промокод {code} создан на {candies_amt} конфет{describe_promo_limits(promo_codes[code])}")
+
+def format_promo_expiry(promo):
+    return f", до {datetime.fromtimestamp(promo.expires, timezone.utc):%d.%m %H:%M} UTC" if promo.expires is not None else ""
+
+def describe_promo_limits(promo):
+    text = f", лимит {promo.max_uses}" if promo.max_uses else ""
+    return text + format_promo_expiry(promo)
+
+@router.message(Command("mintpromos"))
+async def mint_promos(message: types.Message):
+    if not is_admin(message.from_user):
+        await message.reply("Ты не админ.")
+        return
+    args = message.text.split()
+    ttl = promos.parse_ttl(args[3]) if len(args) >= 4 else None
+    if len(args) not in (3, 4, 5) or not args[1].isdigit() or not args[2].isdigit() or (len(args) >= 4 and ttl is None):
+        await message.reply(f"Формат: /mintpromos K N [СРОК] [ПРЕФИКС]\nK до {PROMO_MINT_MAX}, СРОК: 30m, 12h, 7d")
+        return
+    count, candies_amt = int(args[1]), int(args[2])
+    if not 0 < count <= PROMO_MINT_MAX:
+        await message.reply(f"K от 1 до {PROMO_MINT_MAX}")
+        return
+    prefix = args[4].upper() + "-" if len(args) == 5 else ""
+    expires = time.time() + ttl if ttl else None
+    codes = promos.generate_codes(count, promo_codes, prefix=prefix)
+    for code in codes:
+        promo_codes[code] = PromoRecord(candies_amt, 1, expires)
+        mark_dirty("promo", code)
+    # Тысячи кодов не влезут в сообщение — отдаём файлом
+    document = types.BufferedInputFile("\n".join(codes).encode(), filename=f"promos-{int(time.time())}.txt")
+    await message.reply_document(
+        document, caption=f"Выпущено {count} одноразовых кодов на {candies_amt} конфет{describe_promo_limits(promo_codes[codes[0]])}"
+    )
 
 @router.message(Command("deletepromo"))
 async def delete_promo(message: types.Message):
-    if not await is_admin(message.from_user.id):
+    if not is_admin(message.from_user):
         await message.reply("Ты не админ.")
         return
     args = message.text.split()
@@ -1028,53 +1761,366 @@ async def delete_promo(message: types.Message):
     code = args[1].upper()
     if code in promo_codes:
         del promo_codes[code]
-        await save_all()
+        mark_dirty("promo", code)
         await message.reply(f"Промокод {code} удалён")
     else:
         await message.reply("Промокод не найден")
 
 @router.message(Command("listpromos"))
 async def list_promos(message: types.Message):
-    if not await is_admin(message.from_user.id):
+    if not is_admin(message.from_user):
         await message.reply("Ты не админ.")
         return
-    text = "Список промокодов:\n"
-    for code, data in promo_codes.items():
-        text += f"{code}: {data['candies']} конфет, использовано {len(data['used_by'])} раз\n"
-    await message.reply(text or "Промокодов нет")
+    args = message.text.split()
+    page = int(args[1]) if len(args) == 2 and args[1].isdigit() else 1
+    if not promo_codes:
+        await message.reply("Промокодов нет")
+        return
+    pages = (len(promo_codes) + PROMO_PAGE_SIZE - 1) // PROMO_PAGE_SIZE
+    page = min(max(page, 1), pages)
+    codes = sorted(promo_codes)[(page - 1) * PROMO_PAGE_SIZE:page * PROMO_PAGE_SIZE]
+    now = time.time()
+    lines = [f"Промокоды, страница {page}/{pages} (всего {len(promo_codes)}):"]
+    for code in codes:
+        promo = promo_codes[code]
+        uses = f"{promo.uses}/{promo.max_uses}" if promo.max_uses else str(promo.uses)
+        state = " (истёк)" if promo.is_expired(now) else ""
+        lines.append(f"{code}: {promo.candies} конфет, использовано {uses}{format_promo_expiry(promo)}{state}")
+    if page < pages:
+        lines.append(f"\nДальше: /listpromos {page + 1}")
+    await message.reply("\n".join(lines))
 
 # ====================== РЕЙДЫ ======================
-async def start_raid(chat_id):
-    if chat_id not in active_chats:
+# Один планировщик на все чаты: куча событий (unix-время, seq, "start"/"end", chat_id).
+# У каждого чата своя фаза внутри RAID_INTERVAL (по хешу id), поэтому рейды
+# не стартуют во всех чатах одновременно, а объявления идут через sender с лимитами.
+_raid_events = []
+_raid_seq = 0
+_raid_scheduled = set()
+_raid_wakeup = asyncio.Event()
+
+def _push_raid_event(at, kind, chat_id):
+    global _raid_seq
+    _raid_seq += 1
+    heapq.heappush(_raid_events, (at, _raid_seq, kind, chat_id))
+    _raid_wakeup.set()
+
+def next_raid_time(chat_id, now):
+    phase = zlib.crc32(str(chat_id).encode()) % RAID_INTERVAL
+    start = now - now % RAID_INTERVAL + phase
+    return start if start > now else start + RAID_INTERVAL
+
+def schedule_raids(chat_id):
+    if chat_id in _raid_scheduled:
         return
+    _raid_scheduled.add(chat_id)
+    _push_raid_event(next_raid_time(chat_id, time.time()), "start", chat_id)
+
+def load_raids():
     try:
-        await bot.send_message(chat_id, "РЕЙД! Удвоенные конфеты 30 минут!")
-        RAID_ACTIVE[chat_id] = datetime.now(timezone.utc) + timedelta(minutes=30)
-        await asyncio.sleep(1800)
-        if chat_id in RAID_ACTIVE:
-            del RAID_ACTIVE[chat_id]
-        await bot.send_message(chat_id, "Рейд завершён!")
+        with open(RAIDS_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        logging.error(f"Ошибка загрузки {RAIDS_FILE}: {e}")
+        return
+    for chat_id, end in data.items():
+        chat_id = int(chat_id)
+        RAID_ACTIVE[chat_id] = datetime.fromtimestamp(end, timezone.utc)
+        # Рейд, закончившийся во время простоя, завершится сразу с сообщением в чат
+        _push_raid_event(end, "end", chat_id)
+
+async def save_raids():
+    data = {str(chat_id): end.timestamp() for chat_id, end in RAID_ACTIVE.items()}
+    try:
+        await asyncio.to_thread(atomic_write, RAIDS_FILE, json.dumps(data))
     except Exception as e:
-        logging.error(f"Ошибка в рейде для чата {chat_id}: {e}")
+        logging.error(f"Ошибка сохранения {RAIDS_FILE}: {e}")
+
+def _run_raid_event(kind, chat_id, at):
+    if kind == "start":
+        if not active_chats.is_recent(chat_id, at - RAID_ACTIVE_HOURS * 3600):
+            # Чат удалён или давно молчит; add_chat запланирует рейды снова при первой команде
+            _raid_scheduled.discard(chat_id)
+            return False
+        _push_raid_event(at + RAID_INTERVAL, "start", chat_id)
+        if chat_id in RAID_ACTIVE:
+            return False
+        end = at + RAID_DURATION
+        RAID_ACTIVE[chat_id] = datetime.fromtimestamp(end, timezone.utc)
+        _push_raid_event(end, "end", chat_id)
+        post_to_chat(chat_id, "РЕЙД! Удвоенные конфеты 30 минут!")
+        return True
+    end = RAID_ACTIVE.get(chat_id)
+    if end is None or end.timestamp() > at:
+        return False  # Рейд уже завершён или продлён новым
+    del RAID_ACTIVE[chat_id]
+    post_to_chat(chat_id, "Рейд завершён!")
+    return True
 
 async def raid_scheduler():
+    for chat_id in active_chats.recent(time.time() - RAID_ACTIVE_HOURS * 3600):
+        schedule_raids(chat_id)
+    while True:
+        now = time.time()
+        changed = False
+        while _raid_events and _raid_events[0][0] <= now:
+            at, _, kind, chat_id = heapq.heappop(_raid_events)
+            try:
+                changed |= _run_raid_event(kind, chat_id, at)
+            except Exception as e:
+                logging.error(f"Ошибка в рейде для чата {chat_id}: {e}")
+        if changed:
+            await save_raids()
+        timeout = min(_raid_events[0][0] - time.time(), 60) if _raid_events else 60
+        _raid_wakeup.clear()
+        try:
+            await asyncio.wait_for(_raid_wakeup.wait(), timeout=max(timeout, 0))
+        except asyncio.TimeoutError:
+            pass
+
+# ====================== РЕЖИМ ВОРКЕРОВ ======================
+# Несколько процессов main.py (workers.py) с общей базой SQLite. Всё, что процесс держит в памяти,
+# — кэш: под общей блокировкой сущность перечитывается из базы (refresh_shared), перед её
+# освобождением изменения записываются (flush_changes). Казна и лакрица кланов меняются
+# приращениями (change_clan), остальное состояние кланов раз в CLAN_REFRESH с перечитывается целиком.
+def flush_pending():
+    # Есть несохранённые изменения или запись уже идёт (её изменения ещё не в базе)
+    return bool(_dirty or _clan_deltas) or _flush_lock.locked()
+
+async def refresh_shared(keys):
+    if flush_pending():
+        await flush_changes()
+    uids = [key for kind, key in keys if kind == "user"]
+    clan_names = {key for kind, key in keys if kind == "clan"}
+    codes = [key for kind, key in keys if kind == "promo"]
+    if uids:
+        for uid in uids:
+            if ("user", uid) not in _dirty:
+                candies.evict(uid)
+        fetched = await asyncio.to_thread(candies.prefetch_missing, uids)
+        candies.merge(fetched)
+        for uid, user in fetched.items():
+            user_ranks.update(uid, user.total_candies)
+        # Индекс кланов этого процесса мог отстать от записи игрока
+        for uid, user in fetched.items():
+            if user.clan != clans.clan_of(uid):
+                clan_names.update(name for name in (user.clan, clans.clan_of(uid)) if name)
+    if clan_names:
+        async with _flush_lock:  # Пока запись не идёт, база + _clan_deltas — точные значения
+            fresh = await asyncio.to_thread(store.get_clans, clan_names)
+            for name in clan_names:
+                if ("clan", name) in _dirty:
+                    continue
+                if clans.replace(name, fresh.get(name)) is None:
+                    clan_ranks.discard(name)
+                else:
+                    apply_clan_deltas(name)
+                    update_clan_rank(name)
+    if uids:
+        # Поле clan игрока приводится к составу кланов из базы: если клан распущен или игрок
+        # из него убран, а запись ещё не исправлена, обработчик не должен видеть несуществующий клан
+        for uid, user in fetched.items():
+            owner = clans.clan_of(uid)
+            if user.clan != owner:
+                user.clan = owner
+                mark_dirty("user", uid)
+    for code in codes:
+        if ("promo", code) in _dirty:
+            continue
+        stamp = await asyncio.to_thread(store.promo_stamp, code)
+        promo = promo_codes.get(code)
+        if stamp is None:
+            promo_codes.pop(code, None)
+        elif promo is None or (promo.uses, promo.created) != stamp:
+            # Множество активировавших разбирается заново, только если код менялся в другом процессе
+            data = await asyncio.to_thread(store.get_promo, code)
+            if data is not None:
+                promo_codes[code] = PromoRecord.from_dict(data)
+
+async def release_shared(keys):
+    if flush_pending():
+        await flush_changes()
+
+if SHARED:
+    locks.on_acquire = refresh_shared
+    locks.before_release = release_shared
+
+async def rank_refresher():
     while True:
-        await asyncio.sleep(RAID_INTERVAL)
-        for chat_id in active_chats[:]:
-            asyncio.create_task(start_raid(chat_id))
+        await asyncio.sleep(RANK_REFRESH)
+        try:
+            await reload_user_ranks()
+        except Exception as e:
+            logging.error(f"Ошибка пересборки рейтинга игроков: {e}")
+
+async def clan_refresher():
+    while True:
+        await asyncio.sleep(CLAN_REFRESH)
+        try:
+            async with _flush_lock:
+                data = await asyncio.to_thread(store.load_clans)
+                keep = {key for kind, key in _dirty if kind == "clan"}
+                clans.sync(data, keep)
+                for name in clans:
+                    if name not in keep:
+                        apply_clan_deltas(name)
+                clan_ranks.clear()
+                for name, clan in clans.items():
+                    clan_ranks.update(name, clan.candies)
+        except Exception as e:
+            logging.error(f"Ошибка обновления кланов из базы: {e}")
+
+# ====================== МЕТРИКИ ======================
+metrics.describe("bot_updates_total", "counter", "Апдейтов по типу")
+metrics.describe("bot_handler_calls_total", "counter", "Вызовов обработчиков команд и кнопок")
+metrics.describe("bot_handler_errors_total", "counter", "Исключений, вылетевших из обработчиков")
+metrics.describe("bot_api_calls_total", "counter", "Запросов к Telegram API по методу")
+metrics.describe("bot_api_failures_total", "counter", "Неудачных запросов к Telegram API по методу")
+metrics.describe("bot_saves_total", "counter", "Успешных сохранений изменений")
+metrics.describe("bot_save_failures_total", "counter", "Неудачных сохранений изменений")
+metrics.describe("bot_save_seconds_total", "counter", "Суммарное время сохранений, сек")
+metrics.describe("bot_save_last_seconds", "gauge", "Длительность последнего сохранения, сек")
+metrics.describe("bot_save_bytes_total", "counter", "Записано данных при сохранениях, байт")
+metrics.describe("bot_saved_entities_total", "counter", "Сохранено изменённых сущностей")
+metrics.gauge("bot_seconds_since_save", "Секунд с последнего успешного сохранения", lambda: round(time.monotonic() - _last_flush_at, 3))
+metrics.gauge("bot_unsaved_age_seconds", "Возраст самого старого несохранённого изменения, сек", lambda: round(flush_lag(), 3))
+metrics.gauge("bot_dirty_entities", "Изменённых, но не сохранённых сущностей", lambda: len(_dirty))
+# Число игроков — размер рейтинга: в режиме sqlite len(candies) — это COUNT(*) по базе
+metrics.gauge("bot_players", "Игроков", lambda: len(user_ranks))
+metrics.gauge("bot_clans", "Кланов", lambda: len(clans))
+metrics.gauge("bot_active_chats", "Активных чатов", lambda: len(active_chats))
+metrics.gauge("bot_recent_chats", "Чатов с командами за RAID_ACTIVE_HOURS", lambda: len(active_chats.recent(time.time() - RAID_ACTIVE_HOURS * 3600)))
+metrics.gauge("bot_active_raids", "Идущих рейдов", lambda: len(RAID_ACTIVE))
+metrics.gauge("bot_online_users", "Игроков онлайн", lambda: len(online_users))
+metrics.gauge("bot_pending_interactions", "Сообщений с кнопками, ждущих ответа", lambda: len(pending))
+metrics.gauge("bot_send_queue", "Сообщений в очереди отправки", lambda: len(sender))
+metrics.gauge("bot_asyncio_tasks", "Незавершённых задач asyncio", lambda: len(asyncio.all_tasks()))
+
+async def count_handler(handler, event, data):
+    name = data["handler"].callback.__name__
+    metrics.inc("bot_handler_calls_total", handler=name)
+    token = latency.begin()
+    start = time.perf_counter()
+    try:
+        return await handler(event, data)
+    except Exception:
+        metrics.inc("bot_handler_errors_total", handler=name)
+        raise
+    finally:
+        total = time.perf_counter() - start
+        api, api_calls = latency.end(token)
+        if latency.record(name, total, api):
+            user = event.from_user.id if event.from_user else None
+            logging.warning(
+                f"Медленный обработчик {name}: {total * 1000:.0f} мс (пользователь {user}), "
+                f"Telegram API {api * 1000:.0f} мс за {api_calls} запр., локально {(total - api) * 1000:.0f} мс"
+            )
+
+async def count_api_calls(make_request, bot, method):
+    name = getattr(method, "__api_method__", type(method).__name__)
+    metrics.inc("bot_api_calls_total", method=name)
+    start = time.perf_counter()
+    try:
+        return await make_request(bot, method)
+    except Exception:
+        metrics.inc("bot_api_failures_total", method=name)
+        raise
+    finally:
+        latency.add_api(time.perf_counter() - start)
+
+async def metrics_page(request):
+    return web.Response(text=metrics.render(), content_type="text/plain")
 
 # ====================== ЗАПУСК ======================
+# startup()/shutdown() общие для polling, вебхука и нагрузочного теста (loadtest.py)
+async def startup():
+    await load_state()
+    await asyncio.to_thread(names.load)
+    await asyncio.to_thread(load_admins)
+    await asyncio.to_thread(load_cooldowns)
+    load_raids()
+    pending.load()
+    dp.update.outer_middleware(track_users)
+    router.message.middleware(count_handler)
+    router.callback_query.middleware(count_handler)
+    bot.session.middleware(count_api_calls)
+    dp.include_router(router)
+    asyncio.create_task(sender.run())
+    asyncio.create_task(loop_lag_monitor(metrics))
+    asyncio.create_task(raid_scheduler())
+    asyncio.create_task(chat_pruner())
+    broadcaster.resume()
+    asyncio.create_task(pending.run(expire_interaction))
+    asyncio.create_task(persistence_loop())
+    asyncio.create_task(names_saver())
+    if journal:
+        asyncio.create_task(journal_compactor())
+    if SHARED:
+        asyncio.create_task(clan_refresher())
+        asyncio.create_task(rank_refresher())
+
+async def shutdown():
+    await save_names()
+    await save_cooldowns()
+    await save_raids()
+    await shutdown_persistence()
+
+async def serve_worker(inbox, ready=None):
+    # Воркер workers.py: апдейты (dict из JSON Telegram) приходят от ведущего процесса, None — остановка
+    async def feed(update):
+        try:
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            logging.error(f"Ошибка обработки апдейта {update.update_id}: {e}")
+
+    tasks = set()
+    try:
+        await startup()
+        if ready is not None:
+            ready.put(WORKER_INDEX)
+        logging.warning(f"Воркер {WORKER_INDEX + 1}/{WORKER_COUNT} запущен")
+        while (data := await asyncio.to_thread(inbox.get)) is not None:
+            task = asyncio.create_task(feed(types.Update.model_validate(data, context={"bot": bot})))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+    finally:
+        await shutdown()
+        await bot.session.close()
+
 async def main():
+    runner = None
     try:
-        await bot.delete_webhook(drop_pending_updates=True)
-        logging.info("Webhook удалён. Используем polling.")
-        dp.include_router(router)
-        keep_alive()  # Запуск веб-сервера для UptimeRobot
-        asyncio.create_task(raid_scheduler())
+        await startup()
+        app = create_app()
+        app.router.add_get("/metrics", metrics_page)
+        if WEBHOOK_URL:
+            # Апдейт принимается сразу, обрабатывается отдельной задачей, как при handle_as_tasks
+            SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+        runner = await keep_alive(app, WEB_HOST, WEB_PORT)  # Веб-сервер для UptimeRobot (и вебхука)
         logging.warning("Бот запущен — ВСЁ РАБОТАЕТ!")
-        await dp.start_polling(bot)
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+                drop_pending_updates=True,
+            )
+            logging.info(f"Webhook установлен, слушаем {WEB_HOST}:{WEB_PORT}{WEBHOOK_PATH}")
+            await asyncio.Event().wait()
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            logging.info("Webhook удалён. Используем polling.")
+            # Апдейты обрабатываются параллельно задачами; гонки закрыты блокировками locks
+            await dp.start_polling(bot, handle_as_tasks=True)
     except Exception as e:
         logging.error(f"Ошибка запуска: {e}")
+    finally:
+        if runner:
+            await runner.cleanup()
+        await shutdown()
 
 if __name__ == "__main__":
     asyncio.run(main())
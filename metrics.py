@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import time
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+# Счётчики и показатели в текстовом формате Prometheus.
+# inc()/set() — из обработчиков, без блокировок (всё в одном цикле событий);
+# gauge() регистрирует функцию, значение которой берётся в момент запроса /metrics.
+class Metrics:
+    def __init__(self):
+        self._meta = {}  # имя -> (тип, описание)
+        self._values = {}  # имя -> {кортеж меток: значение}
+        self._gauges = {}  # имя -> функция без аргументов
+
+    def describe(self, name, kind, text):
+        self._meta[name] = (kind, text)
+        self._values.setdefault(name, {})
+
+    def inc(self, name, value=1, **labels):
+        series = self._values.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self._values.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+
+    def gauge(self, name, text, func):
+        self.describe(name, "gauge", text)
+        self._gauges[name] = func
+
+    def get(self, name, **labels):
+        return self._values.get(name, {}).get(tuple(sorted(labels.items())), 0)
+
+    def render(self, extra=None):
+        # extra — {имя: значение} для показателей, посчитанных асинхронно перед вызовом
+        lines = []
+        for name, (kind, text) in self._meta.items():
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if name in self._gauges or (extra and name in extra):
+                value = extra[name] if extra and name in extra else self._gauges[name]()
+                lines.append(f"{name} {value}")
+                continue
+            for labels, value in self._values[name].items():
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+async def loop_lag_monitor(metrics, name="bot_event_loop_lag_seconds", interval=0.5):
+    # Насколько позже запланированного просыпается sleep — задержка цикла событий
+    metrics.describe(name, "gauge", "Задержка цикла событий, сек")
+    metrics.describe(name + "_max", "gauge", "Максимальная задержка цикла событий, сек")
+    worst = 0.0
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.perf_counter() - start - interval)
+        worst = max(worst, lag)
+        metrics.set(name, round(lag, 6))
+        metrics.set(name + "_max", round(worst, 6))
+
+
+class ErrorCounter(logging.Handler):
+    # Считает записи лога уровня ERROR и выше: большинство обработчиков ловят исключения сами
+    def __init__(self, metrics, name="bot_log_errors_total"):
+        super().__init__(logging.ERROR)
+        self.metrics = metrics
+        self.name = name
+        metrics.describe(name, "counter", "Записей лога уровня ERROR")
+
+    def emit(self, record):
+        self.metrics.inc(self.name, logger=record.name)
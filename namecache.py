@@ -0,0 +1,104 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+
+from storage import atomic_write
+
+
+# Кэш отображаемых имён игроков: LRU на capacity записей, запись живёт ttl секунд.
+# Пополняется бесплатно из from_user входящих апдейтов; промахи добираются через get_chat.
+class NameCache:
+    def __init__(self, capacity=20000, ttl=24 * 3600, path=None):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.path = path
+        self._data = OrderedDict()  # uid -> (имя, время записи)
+        self._changed = False
+
+    def __len__(self):
+        return len(self._data)
+
+    def put(self, uid, name):
+        if not name:
+            return
+        uid = str(uid)
+        old = self._data.get(uid)
+        now = time.time()
+        # Не трогаем свежую запись с тем же именем, чтобы не переписывать файл на каждое сообщение
+        if old and old[0] == name and now - old[1] < self.ttl / 2:
+            self._data.move_to_end(uid)
+            return
+        self._data[uid] = (name, now)
+        self._data.move_to_end(uid)
+        self._changed = True
+        while len(self._data) > self.capacity:
+            self._data.popitem(last=False)
+
+    def get(self, uid):
+        uid = str(uid)
+        entry = self._data.get(uid)
+        if entry is None:
+            return None
+        if time.time() - entry[1] >= self.ttl:
+            del self._data[uid]
+            return None
+        self._data.move_to_end(uid)
+        return entry[0]
+
+    async def resolve(self, uids, fetch, concurrency=5):
+        # {uid: имя}; промахи запрашиваются параллельно, не больше concurrency одновременно
+        names = {}
+        missing = []
+        for uid in uids:
+            uid = str(uid)
+            name = self.get(uid)
+            if name is None:
+                missing.append(uid)
+            else:
+                names[uid] = name
+        if missing:
+            sem = asyncio.Semaphore(concurrency)
+
+            async def one(uid):
+                async with sem:
+                    try:
+                        name = await fetch(uid)
+                    except Exception as e:
+                        logging.error(f"Ошибка получения пользователя {uid}: {e}")
+                        return uid, None
+                    self.put(uid, name)
+                    return uid, name
+
+            for uid, name in await asyncio.gather(*(one(uid) for uid in dict.fromkeys(missing))):
+                names[uid] = name or f"User #{uid}"
+        return names
+
+    def load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (json.JSONDecodeError, OSError) as e:
+            logging.error(f"Ошибка загрузки кэша имён {self.path}: {e}")
+            return
+        now = time.time()
+        for uid, (name, stamp) in sorted(data.items(), key=lambda item: item[1][1]):
+            if now - stamp < self.ttl:
+                self._data[uid] = (name, stamp)
+        while len(self._data) > self.capacity:
+            self._data.popitem(last=False)
+
+    def snapshot(self):
+        # Берётся в цикле событий; запись на диск — в рабочем потоке через write()
+        if not self.path or not self._changed:
+            return None
+        self._changed = False
+        return {uid: list(entry) for uid, entry in self._data.items()}
+
+    def write(self, data):
+        atomic_write(self.path, json.dumps(data, ensure_ascii=False))
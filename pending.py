@@ -0,0 +1,113 @@
+import asyncio
+import heapq
+import json
+import logging
+import time
+
+from storage import atomic_write
+
+
+def interaction_key(chat_id, message_id):
+    return f"{chat_id}:{message_id}"
+
+
+# Ожидающие ответа сообщения с кнопками («сладость или гадость», дуэли).
+# Ключ — "chat_id:message_id", значение — dict с данными и полем "expires" (unix-время).
+# Все сроки обслуживает одна задача run() по куче дедлайнов вместо задачи со sleep на каждое сообщение.
+# claim() снимает запись без await, поэтому повторное нажатие кнопки её уже не найдёт.
+# Записи сохраняются в path и после перезапуска истекают или доигрываются как обычно.
+# Сохраняет их не сам реестр, а то же фоновое сохранение, что пишет игроков (main.flush_changes):
+# ставка дуэли и запись о ней попадают на диск вместе, без окна, где есть одно без другого.
+class PendingInteractions:
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        self._heap = []  # (expires, ключ); устаревшие записи пропускаются при снятии
+        self._wakeup = asyncio.Event()
+        self._dirty = False
+        self.expired = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def dirty(self):
+        return self._dirty
+
+    def add(self, key, kind, ttl, **data):
+        entry = dict(data, kind=kind, expires=time.time() + ttl)
+        self.restore(key, entry)
+        return entry
+
+    def restore(self, key, entry):
+        # Вернуть снятую запись, если обработать её не получилось
+        self._entries[key] = entry
+        heapq.heappush(self._heap, (entry["expires"], key))
+        self._dirty = True
+        self._wakeup.set()
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def claim(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._dirty = True
+        return entry
+
+    def _pop_expired(self, now):
+        heap = self._heap
+        result = []
+        while heap and heap[0][0] <= now:
+            expires, key = heapq.heappop(heap)
+            entry = self._entries.get(key)
+            if entry is not None and entry["expires"] == expires:
+                del self._entries[key]
+                result.append((key, entry))
+        if result:
+            self._dirty = True
+        if len(heap) > 2 * len(self._entries) + 64:
+            self._heap = [(entry["expires"], key) for key, entry in self._entries.items()]
+            heapq.heapify(self._heap)
+        return result
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logging.error(f"Ошибка загрузки {self.path}: {e}")
+            return
+        for key, entry in data.items():
+            self._entries[key] = entry
+            self._heap.append((entry["expires"], key))
+        heapq.heapify(self._heap)
+
+    def snapshot(self):
+        # Копия записей для write() в рабочем потоке; None — с прошлого снимка ничего не менялось
+        if not self._dirty:
+            return None
+        self._dirty = False
+        return dict(self._entries)
+
+    def write(self, entries):
+        atomic_write(self.path, json.dumps(entries, ensure_ascii=False))
+
+    def unsaved(self):
+        # Запись снимка не удалась — сохранить при следующем случае
+        self._dirty = True
+
+    async def run(self, on_expire):
+        # on_expire(key, entry) — корутина; запускается отдельной задачей на каждую истёкшую запись
+        while True:
+            for key, entry in self._pop_expired(time.time()):
+                self.expired += 1
+                asyncio.create_task(on_expire(key, entry))
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(timeout, 0) if timeout is not None else None)
+            except asyncio.TimeoutError:
+                pass
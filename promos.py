@@ -0,0 +1,134 @@
+import base64
+import itertools
+import re
+import secrets
+import sys
+import time
+import zlib
+from array import array
+
+# Промокод с множеством активировавших вместо списка used_by: проверка «уже использовал» — O(1).
+# В файле множество хранится кусками по CHUNK id: отсортированные id разностями в uint64, zlib, base64
+# (поле "used" — список кусков). Заполненный кусок кодируется один раз, при сохранении
+# заново кодируется только хвост из последних активаций. Старый формат со списком "used_by" читается.
+
+CODE_ALPHABET = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"  # Без 0/O и 1/I
+CHUNK = 4096
+_TTL_UNITS = {"m": 60, "h": 3600, "d": 86400}
+
+OK = "ok"
+USED = "used"
+LIMIT = "limit"
+EXPIRED = "expired"
+
+
+def _pack_ids(ids):
+    ids = sorted(ids)
+    deltas = array("Q", [b - a for a, b in zip([0] + ids[:-1], ids)])
+    if sys.byteorder == "big":
+        deltas.byteswap()
+    return base64.b64encode(zlib.compress(deltas.tobytes())).decode("ascii")
+
+
+def _unpack_ids(text):
+    deltas = array("Q")
+    deltas.frombytes(zlib.decompress(base64.b64decode(text)))
+    if sys.byteorder == "big":
+        deltas.byteswap()
+    return itertools.accumulate(deltas)
+
+
+def parse_ttl(text):
+    # "30m" / "12h" / "7d" -> секунды; None, если формат не подходит
+    match = re.fullmatch(r"(\d+)([mhd])", text.lower())
+    if not match:
+        return None
+    return int(match.group(1)) * _TTL_UNITS[match.group(2)]
+
+
+def generate_codes(count, existing, length=10, prefix=""):
+    # count новых кодов, которых нет в existing
+    codes = set()
+    while len(codes) < count:
+        code = prefix + "".join(secrets.choice(CODE_ALPHABET) for _ in range(length))
+        if code not in existing:
+            codes.add(code)
+    return sorted(codes)
+
+
+class PromoRecord:
+    __slots__ = ("candies", "max_uses", "expires", "created", "_used", "_chunks", "_fresh", "_extra")
+    _KNOWN = frozenset(("candies", "max_uses", "expires", "created", "used", "used_by", "uses"))
+
+    def __init__(self, candies, max_uses=None, expires=None):
+        self.candies = candies
+        self.max_uses = max_uses  # None или 0 — без лимита
+        self.expires = expires  # unix-время или None
+        self.created = time.time()
+        self._used = set()
+        self._chunks = []  # Закодированные куски по CHUNK id, не меняются
+        self._fresh = []  # Активации, ещё не попавшие в кусок
+        self._extra = None
+
+    @property
+    def uses(self):
+        return len(self._used)
+
+    def used_by(self, uid):
+        return int(uid) in self._used
+
+    def is_expired(self, now=None):
+        return self.expires is not None and (now or time.time()) >= self.expires
+
+    def redeem(self, uid):
+        # Проверка и запись без await между ними — лимит не превысить параллельными /promo
+        uid = int(uid)
+        if uid in self._used:
+            return USED
+        if self.is_expired():
+            return EXPIRED
+        if self.max_uses and len(self._used) >= self.max_uses:
+            return LIMIT
+        self._used.add(uid)
+        self._fresh.append(uid)
+        if len(self._fresh) >= CHUNK:
+            self._chunks = self._chunks + [_pack_ids(self._fresh)]
+            self._fresh = []
+        return OK
+
+    @classmethod
+    def from_dict(cls, data):
+        promo = cls.__new__(cls)
+        promo.candies = data.get("candies", 0)
+        promo.max_uses = data.get("max_uses")
+        promo.expires = data.get("expires")
+        promo.created = data.get("created")
+        promo._used = set()
+        promo._chunks = []
+        promo._fresh = []
+        used = data.get("used")
+        if used is not None:
+            for chunk in used:
+                promo._used.update(_unpack_ids(chunk))
+            promo._chunks = list(used)
+        else:
+            ids = sorted({int(uid) for uid in data.get("used_by", ())})
+            promo._used.update(ids)
+            promo._chunks = [_pack_ids(ids[i:i + CHUNK]) for i in range(0, len(ids), CHUNK)]
+        extra = {key: value for key, value in data.items() if key not in cls._KNOWN}
+        promo._extra = extra or None
+        return promo
+
+    def to_dict(self):
+        fresh = list(self._fresh)
+        chunks = self._chunks
+        data = {"candies": self.candies, "uses": len(self._used), "used": chunks + [_pack_ids(fresh)] if fresh else chunks}
+        if self.max_uses:
+            data["max_uses"] = self.max_uses
+        if self.expires is not None:
+            data["expires"] = self.expires
+        if self.created is not None:
+            data["created"] = self.created
+        if self._extra:
+            data.update(self._extra)
+        return data
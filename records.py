@@ -0,0 +1,269 @@
+import sys
+from datetime import date
+
+# Компактная запись игрока вместо словаря из ~20 ключей.
+# Снаружи ведёт себя как прежний dict для скалярных полей (user["candies"] += 1, user.get(...)),
+# внутри — __slots__, даты ежедневных счётчиков хранятся номером дня от эпохи,
+# костюмы — упакованным в int списком индексов, зелья — счётчиками.
+# to_dict()/from_dict() дают прежнюю схему candies.json.
+
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def day_to_iso(day):
+    if isinstance(day, int):
+        return date.fromordinal(day + _EPOCH_ORDINAL).isoformat()
+    return day
+
+
+def iso_to_day(value):
+    if not isinstance(value, str):
+        return value
+    try:
+        return date.fromisoformat(value).toordinal() - _EPOCH_ORDINAL
+    except ValueError:
+        return value  # Нестандартная строка хранится как есть
+
+
+# Реестр ключей костюмов: индекс 1..15 на 4 бита в упакованном списке.
+# Ключи, которых нет в costumes_data (например, снятые с продажи), регистрируются на лету.
+_COSTUME_KEYS = []
+_COSTUME_INDEX = {}
+_COSTUME_BITS = 4
+
+
+def register_costumes(keys):
+    for key in keys:
+        costume_index(key)
+
+
+def costume_index(key):
+    index = _COSTUME_INDEX.get(key)
+    if index is None:
+        if len(_COSTUME_KEYS) >= (1 << _COSTUME_BITS) - 1:
+            raise ValueError(f"Слишком много видов костюмов для упаковки: {key}")
+        key = sys.intern(key)
+        _COSTUME_KEYS.append(key)
+        index = _COSTUME_INDEX[key] = len(_COSTUME_KEYS)
+    return index
+
+
+class Challenges:
+    # Представление user["challenges"] поверх полей записи
+    __slots__ = ("_user",)
+    _FIELDS = {"steal": "ch_steal", "give": "ch_give", "buy": "ch_buy"}
+
+    def __init__(self, user):
+        self._user = user
+
+    def __getitem__(self, key):
+        return getattr(self._user, self._FIELDS[key])
+
+    def __setitem__(self, key, value):
+        setattr(self._user, self._FIELDS[key], value)
+
+    def to_dict(self):
+        return {"steal": self._user.ch_steal, "give": self._user.ch_give, "buy": self._user.ch_buy}
+
+
+class UserRecord:
+    __slots__ = (
+        "candies", "total_candies", "last_claim", "costume", "_costumes", "active_potions", "_potions",
+        "licorice", "ch_steal", "ch_give", "ch_buy", "last_challenge_reset", "duel_wins",
+        "attacks_today", "last_attack_date", "buys_today", "last_buy_date", "gives_today", "last_give_date",
+        "clan", "reset_day", "_extra", "_changed",
+    )
+    # Поля, доступные как user["..."]; остальные — через методы
+    _PLAIN = frozenset((
+        "candies", "total_candies", "last_claim", "costume", "licorice", "duel_wins",
+        "attacks_today", "buys_today", "gives_today", "clan", "reset_day",
+    ))
+    _DATES = ("last_challenge_reset", "last_attack_date", "last_buy_date", "last_give_date")
+    _KNOWN = _PLAIN | frozenset(_DATES) | {"owned_costumes", "owned_potions", "active_potions", "challenges"}
+
+    def __init__(self):
+        self.candies = 10
+        self.total_candies = 10
+        self.last_claim = None
+        self.costume = None
+        self._costumes = 0
+        self.active_potions = None  # dict или None, если активных зелий нет
+        self._potions = None  # {ключ: количество} или None
+        self.licorice = 0
+        self.ch_steal = self.ch_give = self.ch_buy = 0
+        self.last_challenge_reset = None
+        self.duel_wins = 0
+        self.attacks_today = 0
+        self.last_attack_date = None
+        self.buys_today = 0
+        self.last_buy_date = None
+        self.gives_today = 0
+        self.last_give_date = None
+        self.clan = None
+        self.reset_day = None
+        self._extra = None  # Неизвестные ключи из файла, чтобы не терять их при сохранении
+        # Новая запись — уже изменение (см. __setattr__)
+
+    def __setattr__(self, name, value):
+        # Любая запись поля помечает игрока изменённым: сохраняются только такие записи
+        object.__setattr__(self, name, value)
+        object.__setattr__(self, "_changed", True)
+
+    def mark_changed(self):
+        # Для изменений внутри вложенных dict (active_potions)
+        object.__setattr__(self, "_changed", True)
+
+    def take_changed(self):
+        # Было ли изменение с прошлого вызова; флаг сбрасывается
+        changed = self._changed
+        object.__setattr__(self, "_changed", False)
+        return changed
+
+    # ---------- доступ как к словарю ----------
+    def __getitem__(self, key):
+        if key in self._PLAIN:
+            return getattr(self, key)
+        if key == "challenges":
+            return Challenges(self)
+        if key == "active_potions":
+            # Словарь отдаётся для изменения — считаем запись изменённой
+            if self.active_potions is None:
+                self.active_potions = {}
+            self.mark_changed()
+            return self.active_potions
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self._PLAIN:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        try:
+            value = self[key]
+        except KeyError:
+            return default
+        return default if value is None else value
+
+    # ---------- костюмы ----------
+    def costumes(self):
+        result = []
+        packed = self._costumes
+        while packed:
+            result.append(_COSTUME_KEYS[(packed & 0xF) - 1])
+            packed >>= _COSTUME_BITS
+        return result
+
+    def has_costume(self, key):
+        index = _COSTUME_INDEX.get(key)
+        packed = self._costumes
+        while index and packed:
+            if packed & 0xF == index:
+                return True
+            packed >>= _COSTUME_BITS
+        return False
+
+    def add_costume(self, key):
+        index = costume_index(key)
+        shift = 0
+        while self._costumes >> shift:
+            shift += _COSTUME_BITS
+        self._costumes |= index << shift
+
+    def costume_mask(self):
+        # Множество купленных костюмов битовой маской (порядок покупки не учитывается)
+        mask = 0
+        packed = self._costumes
+        while packed:
+            mask |= 1 << ((packed & 0xF) - 1)
+            packed >>= _COSTUME_BITS
+        return mask
+
+    # ---------- зелья ----------
+    def potions(self):
+        return dict(self._potions) if self._potions else {}
+
+    def potion_count(self, key):
+        return self._potions.get(key, 0) if self._potions else 0
+
+    def add_potion(self, key, qty=1):
+        if self._potions is None:
+            self._potions = {}
+        self._potions[key] = self._potions.get(key, 0) + qty
+
+    def take_potion(self, key):
+        count = self.potion_count(key)
+        if not count:
+            return False
+        if count == 1:
+            del self._potions[key]
+            if not self._potions:
+                self._potions = None
+        else:
+            self._potions[key] = count - 1
+        return True
+
+    # ---------- сериализация ----------
+    @classmethod
+    def from_dict(cls, data):
+        user = cls.__new__(cls)
+        user.candies = data.get("candies", 10)
+        user.total_candies = data.get("total_candies", 10)
+        user.last_claim = data.get("last_claim")
+        costume = data.get("costume")
+        user.costume = sys.intern(costume) if isinstance(costume, str) else costume
+        user._costumes = 0
+        for key in data.get("owned_costumes", ()):
+            user.add_costume(key)
+        user.active_potions = data.get("active_potions") or None
+        user._potions = None
+        for key in data.get("owned_potions", ()):
+            user.add_potion(sys.intern(key))
+        user.licorice = data.get("licorice", 0)
+        challenges = data.get("challenges") or {}
+        user.ch_steal = challenges.get("steal", 0)
+        user.ch_give = challenges.get("give", 0)
+        user.ch_buy = challenges.get("buy", 0)
+        for field in cls._DATES:
+            setattr(user, field, iso_to_day(data.get(field)))
+        user.duel_wins = data.get("duel_wins", 0)
+        user.attacks_today = data.get("attacks_today", 0)
+        user.buys_today = data.get("buys_today", 0)
+        user.gives_today = data.get("gives_today", 0)
+        clan = data.get("clan")
+        user.clan = sys.intern(clan) if isinstance(clan, str) else clan
+        user.reset_day = data.get("reset_day")
+        extra = {key: value for key, value in data.items() if key not in cls._KNOWN}
+        user._extra = extra or None
+        object.__setattr__(user, "_changed", False)
+        return user
+
+    def to_dict(self):
+        owned_potions = []
+        for key, qty in (self._potions or {}).items():
+            owned_potions.extend([key] * qty)
+        data = {
+            "candies": self.candies,
+            "total_candies": self.total_candies,
+            "last_claim": self.last_claim,
+            "costume": self.costume,
+            "owned_costumes": self.costumes(),
+            "active_potions": dict(self.active_potions) if self.active_potions else {},
+            "owned_potions": owned_potions,
+            "licorice": self.licorice,
+            "challenges": {"steal": self.ch_steal, "give": self.ch_give, "buy": self.ch_buy},
+            "last_challenge_reset": day_to_iso(self.last_challenge_reset),
+            "duel_wins": self.duel_wins,
+            "attacks_today": self.attacks_today,
+            "last_attack_date": day_to_iso(self.last_attack_date),
+            "buys_today": self.buys_today,
+            "last_buy_date": day_to_iso(self.last_buy_date),
+            "gives_today": self.gives_today,
+            "last_give_date": day_to_iso(self.last_give_date),
+            "clan": self.clan,
+        }
+        if self.reset_day is not None:
+            data["reset_day"] = self.reset_day
+        if self._extra:
+            data.update(self._extra)
+        return data
@@ -0,0 +1,101 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from aiogram.exceptions import TelegramRetryAfter
+
+
+# Очередь исходящих сообщений с ограничением скорости: не чаще rate сообщений в секунду
+# на весь бот и не чаще одного сообщения в per_chat_interval секунд в один чат.
+# На flood-ошибку (retry_after) вся отправка ставится на паузу, сообщение уходит повторно.
+class RateLimitedSender:
+    def __init__(self, bot, rate=25, per_chat_interval=1.0, max_retries=3):
+        self.bot = bot
+        self.interval = 1.0 / rate
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self._heap = []  # (готово_к_отправке, seq, chat_id, text, kwargs, future, попытка)
+        self._seq = itertools.count()
+        self._chat_next = {}  # chat_id -> monotonic-время, раньше которого в чат не пишем
+        self._next_send = 0.0
+        self._wakeup = asyncio.Event()
+        self.sent = 0
+        self.failed = 0
+        self.flood_waits = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def submit(self, chat_id, text, **kwargs):
+        # Поставить в очередь; результат (Message или исключение) — в возвращаемом future
+        future = asyncio.get_running_loop().create_future()
+        self._push(chat_id, text, kwargs, future, 0)
+        return future
+
+    async def send(self, chat_id, text, **kwargs):
+        return await self.submit(chat_id, text, **kwargs)
+
+    def post(self, chat_id, text, **kwargs):
+        # Отправить, не дожидаясь результата; ошибка только пишется в лог
+        def log_failure(future):
+            if not future.cancelled() and future.exception() is not None:
+                logging.error(f"Ошибка отправки в чат {chat_id}: {future.exception()}")
+
+        future = self.submit(chat_id, text, **kwargs)
+        future.add_done_callback(log_failure)
+        return future
+
+    def _push(self, chat_id, text, kwargs, future, attempt, not_before=0.0):
+        now = time.monotonic()
+        ready = max(now, not_before, self._chat_next.get(chat_id, 0.0))
+        self._chat_next[chat_id] = ready + self.per_chat_interval
+        heapq.heappush(self._heap, (ready, next(self._seq), chat_id, text, kwargs, future, attempt))
+        self._wakeup.set()
+
+    def _prune(self, now):
+        if len(self._chat_next) > 4 * len(self._heap) + 1024:
+            self._chat_next = {chat_id: t for chat_id, t in self._chat_next.items() if t > now}
+
+    async def run(self):
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = time.monotonic()
+            due = max(self._heap[0][0], self._next_send)
+            if due > now:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=due - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, _, chat_id, text, kwargs, future, attempt = heapq.heappop(self._heap)
+            self._next_send = now + self.interval
+            self._prune(now)
+            if future.cancelled():
+                continue
+            try:
+                message = await self.bot.send_message(chat_id, text, **kwargs)
+            except TelegramRetryAfter as e:
+                self.flood_waits += 1
+                resume = time.monotonic() + e.retry_after
+                self._next_send = max(self._next_send, resume)
+                logging.warning(f"Flood control: пауза {e.retry_after} с (чат {chat_id})")
+                if attempt < self.max_retries:
+                    self._push(chat_id, text, kwargs, future, attempt + 1, resume)
+                else:
+                    self.failed += 1
+                    future.set_exception(e)
+                continue
+            except Exception as e:
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            self.sent += 1
+            if not future.done():
+                future.set_result(message)
@@ -0,0 +1,616 @@
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+# Типы сущностей, которые хранит бот: игроки, кланы, промокоды, чаты
+KINDS = ("user", "clan", "promo", "chat")
+
+
+def empty_state():
+    return {kind: {} for kind in KINDS}
+
+
+def encode_record(kind, key, text):
+    # text — уже сериализованное значение (json) или None для удаления
+    return '{"k":%s,"id":%s,"v":%s}\n' % (
+        json.dumps(kind), json.dumps(key, ensure_ascii=False), text if text is not None else "null"
+    )
+
+
+def apply_record(state, record):
+    bucket = state.setdefault(record["k"], {})
+    key = str(record["id"])
+    if record["v"] is None:
+        bucket.pop(key, None)
+    else:
+        bucket[key] = record["v"]
+
+
+def atomic_write(path, text):
+    # Пишем во временный файл и подменяем целиком: падение посреди записи не обрежет оригинал
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+# ====================== JSON ======================
+# Обычные JSON-файлы, но переписываются только изменённые: candies.json делится по хешу
+# id игрока на shards файлов в shard_dir, clans/promos/chats остаются отдельными файлами.
+# Содержимое записанных файлов держится в памяти уже сериализованным ({id: json-текст}):
+# файл собирается из готовых строк, заново кодируются только изменённые записи, диск не читается.
+# Число шардов записывается в shard_dir/shards.json. Читаются только шарды этой раскладки;
+# если JSON_SHARDS изменился (или это первый запуск после одного candies.json), игроки при загрузке
+# переносятся в новую раскладку, а старые файлы переименовываются и больше не читаются.
+class JsonStore:
+    def __init__(self, files, shards=1, shard_dir="candies"):
+        self.files = files  # {"user": "candies.json", "promo": ..., "chat": ..., "clan": ...}
+        self.shards = max(1, shards)
+        self.shard_dir = shard_dir
+        self._lock = threading.Lock()
+        self._texts = {}  # путь -> {id: json-текст записи}
+
+    def shard_path(self, uid, directory=None):
+        if self.shards == 1:
+            return self.files["user"]
+        return self._shard_file(directory or self.shard_dir, zlib.crc32(str(uid).encode()) % self.shards)
+
+    @staticmethod
+    def _shard_file(directory, index):
+        return os.path.join(directory, f"shard-{index:02d}.json")
+
+    def _path(self, kind, key):
+        return self.shard_path(key) if kind == "user" else self.files[kind]
+
+    def _read(self, path, default):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return default
+
+    def _dump(self, path, texts):
+        # По записи на строку, как при indent, но без повторного кодирования неизменённых
+        body = ",\n".join(f"  {json.dumps(key, ensure_ascii=False)}: {text}" for key, text in texts.items())
+        atomic_write(path, "{\n" + body + "\n}" if body else "{}")
+
+    def _cached(self, kind, path):
+        # Тексты файла; при первой записи — из файла на диске. Битый файл считается пустым,
+        # как в _load_file, а сам откладывается в .corrupt, чтобы запись его не затёрла
+        texts = self._texts.get(path)
+        if texts is None:
+            try:
+                data = self._read(path, {})
+            except (json.JSONDecodeError, UnicodeDecodeError) as e:
+                logging.error(f"Ошибка чтения {path}: {e}; файл сохранён как {path}.corrupt")
+                os.replace(path, path + ".corrupt")
+                data = {}
+            if kind == "chat":
+                data = self._chats(data)
+            texts = self._texts[path] = {key: json.dumps(value, ensure_ascii=False) for key, value in data.items()}
+        return texts
+
+    def _load_file(self, path, default):
+        try:
+            return self._read(path, default)
+        except (json.JSONDecodeError, OSError) as e:
+            logging.error(f"Ошибка загрузки {path}: {e}")
+            return default
+
+    def _chats(self, data):
+        # Прежде chats.json был списком id; теперь {id: {"seen": ..., "fails": ...}}
+        if isinstance(data, list):
+            return {str(chat_id): True for chat_id in data}
+        return data
+
+    def load(self):
+        state = empty_state()
+        state["promo"] = self._load_file(self.files["promo"], {})
+        state["clan"] = self._load_file(self.files["clan"], {})
+        state["chat"] = self._chats(self._load_file(self.files["chat"], {}))
+        state["user"] = self._load_users()
+        return state
+
+    def _layout(self):
+        # С каким числом шардов записаны игроки на диске; None — игроков на диске нет
+        new_dir = self.shard_dir + ".new"
+        if not os.path.isdir(self.shard_dir) and os.path.isdir(new_dir):
+            os.replace(new_dir, self.shard_dir)  # Прошлый перенос упал между двумя переименованиями
+        meta = self._load_file(os.path.join(self.shard_dir, "shards.json"), None)
+        if meta:
+            return meta["shards"]
+        names = os.listdir(self.shard_dir) if os.path.isdir(self.shard_dir) else []
+        indexes = [int(name[6:-5]) for name in names if name.startswith("shard-") and name.endswith(".json") and name[6:-5].isdigit()]
+        if indexes:
+            return max(indexes) + 1  # Записаны до появления shards.json
+        if os.path.exists(self.files["user"]):
+            return 1
+        return None
+
+    def _read_users(self, shards):
+        if shards == 1:
+            return self._load_file(self.files["user"], {})
+        users = {}
+        for index in range(shards):
+            users.update(self._load_file(self._shard_file(self.shard_dir, index), {}))
+        return users
+
+    def _load_users(self):
+        old = self._layout()
+        users = self._read_users(old) if old is not None else {}
+        if old is not None and old != self.shards:
+            self._relayout(old, users)
+        elif self.shards > 1:
+            if old is not None and os.path.exists(self.files["user"]):
+                # candies.json остался от прерванного переноса: актуальны шарды
+                os.replace(self.files["user"], self.files["user"] + ".migrated")
+            meta = os.path.join(self.shard_dir, "shards.json")
+            if not os.path.exists(meta):
+                os.makedirs(self.shard_dir, exist_ok=True)
+                atomic_write(meta, json.dumps({"shards": self.shards}))
+        return users
+
+    def _relayout(self, old, users):
+        # Новая раскладка пишется рядом и подменяет старую переименованием каталога:
+        # упавший посреди перенос оставляет на диске старую раскладку целиком
+        texts = {uid: json.dumps(user, ensure_ascii=False) for uid, user in users.items()}
+        old_dir = f"{self.shard_dir}.old-{old}"
+        if self.shards == 1:
+            self._dump(self.files["user"], texts)
+            if os.path.isdir(self.shard_dir):
+                shutil.rmtree(old_dir, ignore_errors=True)
+                os.replace(self.shard_dir, old_dir)
+        else:
+            new_dir = self.shard_dir + ".new"
+            shutil.rmtree(new_dir, ignore_errors=True)
+            os.makedirs(new_dir)
+            groups = {}
+            for uid, text in texts.items():
+                groups.setdefault(self.shard_path(uid, new_dir), {})[uid] = text
+            for path, group in groups.items():
+                self._dump(path, group)
+            atomic_write(os.path.join(new_dir, "shards.json"), json.dumps({"shards": self.shards}))
+            if os.path.isdir(self.shard_dir):
+                shutil.rmtree(old_dir, ignore_errors=True)
+                os.replace(self.shard_dir, old_dir)
+            os.replace(new_dir, self.shard_dir)
+            if old == 1:
+                os.replace(self.files["user"], self.files["user"] + ".migrated")
+        self._texts.clear()
+        where = self.files["user"] if self.shards == 1 else f"{self.shards} шардов в {self.shard_dir}/"
+        logging.warning(f"Игроки ({len(users)}) перенесены в {where}; прежние файлы переименованы")
+
+    def write(self, changes):
+        groups = {}
+        for kind, key, text in changes:
+            groups.setdefault((kind, self._path(kind, key)), []).append((key, text))
+        with self._lock:
+            for (kind, path), items in groups.items():
+                texts = self._cached(kind, path)
+                for key, text in items:
+                    # id чатов — int, в JSON ключи только строки
+                    if text is None:
+                        texts.pop(str(key), None)
+                    else:
+                        texts[str(key)] = text
+                self._dump(path, texts)
+        return len(groups)
+
+
+# ====================== ЖУРНАЛ ======================
+# Каталог журнала:
+#   snapshot.json      — {"seq": N, "data": {kind: {id: value}}}, всё до сегмента N включительно
+#   wal-XXXXXXXX.log   — сегменты журнала, одна JSON-запись на строку
+# Запись дописывается в текущий сегмент; компактор закрывает сегмент и сворачивает
+# снапшот + закрытые сегменты в новый снапшот. При старте: снапшот + хвост журнала.
+class Journal:
+    def __init__(self, directory, max_bytes=8 * 1024 * 1024, max_age=15 * 60, fsync=True):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._fh = None
+        self._seq = 0
+        self._size = 0
+        self._opened_at = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def snapshot_path(self):
+        return os.path.join(self.directory, "snapshot.json")
+
+    def _segment_path(self, seq):
+        return os.path.join(self.directory, f"wal-{seq:08d}.log")
+
+    def _segments(self):
+        result = []
+        for name in os.listdir(self.directory):
+            if name.startswith("wal-") and name.endswith(".log"):
+                try:
+                    result.append((int(name[4:-4]), os.path.join(self.directory, name)))
+                except ValueError:
+                    continue
+        return sorted(result)
+
+    def is_empty(self):
+        return not os.path.exists(self.snapshot_path) and not self._segments()
+
+    def _read_snapshot(self):
+        try:
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                snap = json.load(f)
+        except FileNotFoundError:
+            return 0, empty_state()
+        state = empty_state()
+        state.update(snap.get("data", {}))
+        return snap.get("seq", 0), state
+
+    def _replay(self, state, path):
+        count = 0
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Недописанный хвост после падения — дальше ничего нет
+                    logging.warning(f"Журнал {path}: обрезанная запись, хвост пропущен")
+                    break
+                apply_record(state, record)
+                count += 1
+        return count
+
+    def _write_snapshot(self, state, seq):
+        atomic_write(self.snapshot_path, json.dumps({"seq": seq, "data": state}, ensure_ascii=False))
+
+    def _open_segment(self, seq):
+        self._seq = seq
+        self._fh = open(self._segment_path(seq), "a", encoding="utf-8")
+        self._size = self._fh.tell()
+        self._opened_at = time.monotonic()
+
+    def seed(self, state):
+        # Первый запуск: переносим существующие JSON-файлы в снапшот
+        with self._lock:
+            self._write_snapshot(state, 0)
+
+    def load(self):
+        with self._lock:
+            base_seq, state = self._read_snapshot()
+            last = base_seq
+            replayed = 0
+            for seq, path in self._segments():
+                if seq <= base_seq:
+                    continue
+                replayed += self._replay(state, path)
+                last = seq
+            logging.info(f"Журнал: снапшот #{base_seq}, применено записей: {replayed}")
+            self._open_segment(last + 1)
+            return state
+
+    def append(self, changes):
+        data = "".join(encode_record(kind, key, text) for kind, key, text in changes)
+        with self._lock:
+            self._fh.write(data)
+            self._fh.flush()
+            if self.fsync:
+                os.fsync(self._fh.fileno())
+            self._size += len(data)
+
+    def needs_compaction(self):
+        if self._size == 0:
+            return False
+        return self._size >= self.max_bytes or time.monotonic() - self._opened_at >= self.max_age
+
+    def compact(self):
+        with self._compact_lock:
+            with self._lock:
+                upto = self._seq
+                self._fh.close()
+                self._open_segment(upto + 1)
+            base_seq, state = self._read_snapshot()
+            folded = [(seq, path) for seq, path in self._segments() if base_seq < seq <= upto]
+            for _, path in folded:
+                self._replay(state, path)
+            self._write_snapshot(state, upto)
+            for seq, path in self._segments():
+                if seq <= upto:
+                    os.remove(path)
+            logging.info(f"Журнал свёрнут до сегмента #{upto} ({len(folded)} сегм.)")
+
+    def close(self):
+        with self._lock:
+            if self._fh:
+                self._fh.close()
+                self._fh = None
+
+
+# ====================== SQLITE ======================
+# Одна таблица на сущность; значение хранится в JSON, а поля для сортировки
+# (total_candies у игроков, candies у кланов) вынесены в отдельные индексированные столбцы.
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (id TEXT PRIMARY KEY, total_candies INTEGER NOT NULL DEFAULT 0, data TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS users_total ON users (total_candies DESC);
+CREATE TABLE IF NOT EXISTS clans (name TEXT PRIMARY KEY, candies INTEGER NOT NULL DEFAULT 0, data TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS clans_candies ON clans (candies DESC);
+CREATE TABLE IF NOT EXISTS promos (code TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS chats (id INTEGER PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS deadlines (kind TEXT NOT NULL, key TEXT NOT NULL, until REAL NOT NULL, PRIMARY KEY (kind, key));
+"""
+
+# Режим воркеров: казна и лакрица клана меняются только приращениями (clan_deltas в write),
+# поэтому запись клана целиком не трогает эти поля в базе, а новый клан вставляется с нулями.
+# Так прибавки от разных процессов не затирают друг друга.
+CLAN_SHARED_UPSERT = (
+    "INSERT INTO clans (name, candies, data) VALUES (?, 0, json_set(?, '$.candies', 0, '$.licorice', 0)) "
+    "ON CONFLICT(name) DO UPDATE SET data = json_set(excluded.data, '$.candies', clans.candies, "
+    "'$.licorice', coalesce(json_extract(clans.data, '$.licorice'), 0))"
+)
+CLAN_DELTA_SQL = {
+    "candies": "UPDATE clans SET candies = candies + ?1, data = json_set(data, '$.candies', candies + ?1) WHERE name = ?2",
+    "licorice": "UPDATE clans SET data = json_set(data, '$.licorice', coalesce(json_extract(data, '$.licorice'), 0) + ?1) WHERE name = ?2",
+}
+
+
+class SqliteStore:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # Одно соединение на запись (из рабочих потоков), одно на точечные чтения
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SQLITE_SCHEMA)
+        self._reader = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._read_lock = threading.Lock()
+
+    def _read(self, sql, args=()):
+        with self._read_lock:
+            return self._reader.execute(sql, args).fetchall()
+
+    def is_empty(self):
+        return not any(self._read(f"SELECT 1 FROM {table} LIMIT 1") for table in ("users", "clans", "promos", "chats"))
+
+    def write(self, changes, clan_deltas=None):
+        # clan_deltas — {(клан, "candies" | "licorice"): приращение}; задан только в режиме воркеров
+        with self._lock:
+            cur = self._conn.cursor()
+            cur.execute("BEGIN IMMEDIATE" if clan_deltas is not None else "BEGIN")
+            try:
+                for kind, key, text in changes:
+                    if kind == "user":
+                        if text is None:
+                            cur.execute("DELETE FROM users WHERE id = ?", (key,))
+                        else:
+                            total = json.loads(text).get("total_candies", 0)
+                            # UPSERT, а не REPLACE: rowid сохраняет порядок появления игрока для равных очков
+                            cur.execute("INSERT INTO users (id, total_candies, data) VALUES (?, ?, ?) "
+                                        "ON CONFLICT(id) DO UPDATE SET total_candies = excluded.total_candies, data = excluded.data",
+                                        (key, total, text))
+                    elif kind == "clan":
+                        if text is None:
+                            cur.execute("DELETE FROM clans WHERE name = ?", (key,))
+                        elif clan_deltas is not None:
+                            cur.execute(CLAN_SHARED_UPSERT, (key, text))
+                        else:
+                            candies = json.loads(text).get("candies", 0)
+                            cur.execute("INSERT OR REPLACE INTO clans (name, candies, data) VALUES (?, ?, ?)", (key, candies, text))
+                    elif kind == "promo":
+                        if text is None:
+                            cur.execute("DELETE FROM promos WHERE code = ?", (key,))
+                        else:
+                            cur.execute("INSERT OR REPLACE INTO promos (code, data) VALUES (?, ?)", (key, text))
+                    elif kind == "chat":
+                        if text is None:
+                            cur.execute("DELETE FROM chats WHERE id = ?", (int(key),))
+                        else:
+                            cur.execute("INSERT OR REPLACE INTO chats (id, data) VALUES (?, ?)", (int(key), text))
+                for (name, field), amount in (clan_deltas or {}).items():
+                    if amount:
+                        cur.execute(CLAN_DELTA_SQL[field], (amount, name))
+                cur.execute("COMMIT")
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+
+    def import_state(self, state):
+        changes = []
+        for kind in KINDS:
+            for key, value in state.get(kind, {}).items():
+                changes.append((kind, key, json.dumps(value, ensure_ascii=False)))
+        self.write(changes)
+        return len(changes)
+
+    def load_resident(self):
+        # Кланы, промокоды и чаты небольшие и держатся в памяти целиком; игроки — по требованию
+        state = empty_state()
+        state["clan"] = self.load_clans()
+        state["promo"] = {code: json.loads(data) for code, data in self._read("SELECT code, data FROM promos")}
+        state["chat"] = {str(chat_id): json.loads(data) for chat_id, data in self._read("SELECT id, data FROM chats ORDER BY rowid")}
+        return state
+
+    def load_clans(self):
+        return {name: json.loads(data) for name, data in self._read("SELECT name, data FROM clans")}
+
+    def set_user_clans(self, clans):
+        # {uid: клан или None}: меняется только поле clan, остальная запись игрока в базе не трогается
+        with self._lock:
+            cur = self._conn.cursor()
+            cur.execute("BEGIN")
+            try:
+                cur.executemany("UPDATE users SET data = json_set(data, '$.clan', ?) WHERE id = ?",
+                                [(name, uid) for uid, name in clans.items()])
+                cur.execute("COMMIT")
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+
+    def get_clans(self, names):
+        names = list(names)
+        if not names:
+            return {}
+        marks = ",".join("?" * len(names))
+        return {name: json.loads(data) for name, data in self._read(f"SELECT name, data FROM clans WHERE name IN ({marks})", names)}
+
+    def get_promo(self, code):
+        rows = self._read("SELECT data FROM promos WHERE code = ?", (code,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def promo_stamp(self, code):
+        # (активаций, время создания) без разбора всего множества активировавших; None — кода нет
+        rows = self._read("SELECT json_extract(data, '$.uses'), json_extract(data, '$.created') FROM promos WHERE code = ?", (code,))
+        return tuple(rows[0]) if rows else None
+
+    def chat_ids(self):
+        return [row[0] for row in self._read("SELECT id FROM chats ORDER BY rowid")]
+
+    # Режим воркеров: чат, который держит в памяти другой процесс, меняется одной строкой
+    def drop_chat(self, chat_id):
+        # True — строка была
+        with self._lock:
+            return self._conn.execute("DELETE FROM chats WHERE id = ?", (chat_id,)).rowcount > 0
+
+    def chat_failed(self, chat_id, max_failures):
+        # +1 к ошибкам подряд; набралось max_failures — строка удаляется. True — удалена
+        with self._lock:
+            cur = self._conn.cursor()
+            cur.execute("BEGIN")
+            try:
+                cur.execute("UPDATE chats SET data = json_set(data, '$.fails', coalesce(json_extract(data, '$.fails'), 0) + 1) "
+                            "WHERE id = ?", (chat_id,))
+                cur.execute("DELETE FROM chats WHERE id = ? AND json_extract(data, '$.fails') >= ?", (chat_id, max_failures))
+                dropped = cur.rowcount > 0
+                cur.execute("COMMIT")
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+            return dropped
+
+    def get_deadline(self, kind, key):
+        rows = self._read("SELECT until FROM deadlines WHERE kind = ? AND key = ?", (kind, key))
+        return rows[0][0] if rows else None
+
+    def set_deadline(self, kind, key, until):
+        with self._lock:
+            self._conn.execute("DELETE FROM deadlines WHERE kind = ? AND until <= ?", (kind, time.time()))
+            self._conn.execute("INSERT OR REPLACE INTO deadlines (kind, key, until) VALUES (?, ?, ?)", (kind, key, until))
+
+    def count_deadlines(self, kind):
+        return self._read("SELECT COUNT(*) FROM deadlines WHERE kind = ? AND until > ?", (kind, time.time()))[0][0]
+
+    def get_user(self, uid):
+        rows = self._read("SELECT data FROM users WHERE id = ?", (uid,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def get_users(self, uids):
+        uids = list(uids)
+        if not uids:
+            return {}
+        marks = ",".join("?" * len(uids))
+        return {uid: json.loads(data) for uid, data in self._read(f"SELECT id, data FROM users WHERE id IN ({marks})", uids)}
+
+    def user_ids(self):
+        return [row[0] for row in self._read("SELECT id FROM users")]
+
+    def count_users(self):
+        return self._read("SELECT COUNT(*) FROM users")[0][0]
+
+    def top_users(self, limit):
+        return self._read("SELECT id, total_candies FROM users ORDER BY total_candies DESC, rowid LIMIT ?", (limit,))
+
+    def user_totals(self):
+        # (id, total_candies) всех игроков в порядке появления — для рейтинга в памяти (leaderboard.RankIndex)
+        return self._read("SELECT id, total_candies FROM users ORDER BY rowid")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+        with self._read_lock:
+            self._reader.close()
+
+
+class UserCache(MutableMapping):
+    # Словарь игроков поверх SqliteStore: в памяти только недавно использованные записи.
+    # Вытесняются лишь чистые записи и только вызовом trim() после успешной записи в базу.
+    def __init__(self, store, capacity, is_dirty, factory=None):
+        self.store = store
+        self.capacity = capacity
+        self.is_dirty = is_dirty
+        self.factory = factory or (lambda data: data)  # dict из базы -> объект игрока
+        self._data = OrderedDict()
+
+    def __getitem__(self, uid):
+        try:
+            user = self._data[uid]
+        except KeyError:
+            user = self.store.get_user(uid)
+            if user is None:
+                raise KeyError(uid)
+            user = self._data[uid] = self.factory(user)
+            return user
+        self._data.move_to_end(uid)
+        return user
+
+    def __contains__(self, uid):
+        try:
+            self[uid]
+        except KeyError:
+            return False
+        return True
+
+    def __setitem__(self, uid, user):
+        self._data[uid] = user
+        self._data.move_to_end(uid)
+
+    def __delitem__(self, uid):
+        del self._data[uid]
+
+    def __iter__(self):
+        return iter(self.store.user_ids())
+
+    def __len__(self):
+        return self.store.count_users()
+
+    @property
+    def resident(self):
+        return len(self._data)
+
+    def prefetch_missing(self, uids):
+        # Вызывается из рабочего потока: читает из базы тех, кого нет в памяти
+        users = self.store.get_users(uid for uid in uids if uid not in self._data)
+        return {uid: self.factory(user) for uid, user in users.items()}
+
+    def merge(self, users):
+        for uid, user in users.items():
+            self._data.setdefault(uid, user)
+
+    def cached(self, uid):
+        # Запись, если она уже в памяти; базу не читает
+        return self._data.get(uid)
+
+    def evict(self, uid):
+        # Убрать из памяти без чтения базы (pop() из MutableMapping сначала загрузил бы запись)
+        self._data.pop(uid, None)
+
+    def trim(self):
+        excess = len(self._data) - self.capacity
+        if excess <= 0:
+            return
+        for uid in list(self._data):
+            if excess <= 0:
+                break
+            if not self.is_dirty(uid):
+                del self._data[uid]
+                excess -= 1
@@ -0,0 +1,59 @@
+import random
+
+from leaderboard import RankIndex
+
+
+def full_sort(scores):
+    # Прежний /top: устойчивая сортировка словаря в порядке вставки
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+def check(index, scores):
+    expected = full_sort(scores)
+    assert len(index) == len(scores)
+    assert index.top(len(scores) + 1) == expected
+    for place, (member, _) in enumerate(expected, 1):
+        assert index.rank(member) == place
+
+
+def test_matches_full_sort_under_updates():
+    rng = random.Random(1)
+    RankIndex.BUCKET, bucket = 4, RankIndex.BUCKET  # Маленькие корзины — чаще делятся и пропадают
+    try:
+        index = RankIndex()
+        scores = {}
+        for step in range(3000):
+            member = f"u{rng.randrange(300)}"
+            if rng.random() < 0.1:
+                index.discard(member)
+                scores.pop(member, None)
+            else:
+                score = rng.randrange(50)
+                index.update(member, score)
+                # Игрок, которого удалили, возвращается в конец порядка вставки — как в dict
+                scores[member] = score
+            if step % 100 == 0:
+                check(index, scores)
+        check(index, scores)
+    finally:
+        RankIndex.BUCKET = bucket
+
+
+def test_load_matches_updates():
+    rng = random.Random(2)
+    items = [(f"u{i}", rng.randrange(100)) for i in range(5000)]
+    loaded = RankIndex()
+    loaded.load(items)
+    check(loaded, dict(items))
+    loaded.update("u7", 1000)
+    assert loaded.rank("u7") == 1
+    assert loaded.top(1) == [("u7", 1000)]
+
+
+def test_missing_member():
+    index = RankIndex()
+    index.update("a", 5)
+    assert index.rank("b") is None
+    index.discard("b")
+    index.clear()
+    assert len(index) == 0 and index.top(5) == []
@@ -0,0 +1,50 @@
+from records import UserRecord, register_costumes
+
+
+def sample():
+    return {
+        "candies": 42,
+        "total_candies": 300,
+        "last_claim": "2026-10-16T10:00:00+00:00",
+        "costume": "witch",
+        "owned_costumes": ["witch", "ghost"],
+        "active_potions": {"temp_boost": "2026-10-16T10:30:00+00:00"},
+        "owned_potions": ["perm_boost", "temp_boost", "temp_boost"],
+        "licorice": 2,
+        "challenges": {"steal": 1, "give": 2, "buy": 3},
+        "last_challenge_reset": "2026-10-16",
+        "duel_wins": 4,
+        "attacks_today": 5,
+        "last_attack_date": "2026-10-16",
+        "buys_today": 1,
+        "last_buy_date": "2026-10-15",
+        "gives_today": 0,
+        "last_give_date": None,
+        "clan": "Тыквы",
+        "reset_day": 20742,
+        "custom": {"kept": True},  # Неизвестный ключ не теряется
+    }
+
+
+def test_round_trip():
+    register_costumes(["witch", "ghost"])
+    data = sample()
+    user = UserRecord.from_dict(data)
+    assert user.to_dict() == data
+    assert UserRecord.from_dict(user.to_dict()).to_dict() == data
+
+
+def test_new_record_round_trip():
+    data = UserRecord().to_dict()
+    assert UserRecord.from_dict(data).to_dict() == data
+
+
+def test_change_tracking():
+    user = UserRecord.from_dict(sample())
+    assert not user.take_changed()
+    user["candies"] += 1
+    assert user.take_changed()
+    assert not user.take_changed()
+    user["active_potions"]["perm_boost"] = "x"
+    assert user.take_changed()
+    assert user.to_dict()["active_potions"]["perm_boost"] == "x"
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import secrets
+import signal
+from aiohttp import web
+from aiogram import Bot
+from chats import chat_worker
+from keep_alive import keep_alive, create_app
+
+# Режим воркеров: ведущий процесс получает апдейты (polling или вебхук) и раздаёт их WORKER_COUNT
+# процессам main.py по chat_id. Все апдейты одного чата обрабатывает один воркер — его рейды,
+# ожидающие кнопки и реестр чатов живут только у него. Игроки, кланы, промокоды и кулдауны — в общей
+# базе SQLite (SQLITE_PATH), одновременные изменения разводятся общими блокировками (locks.SharedLocks).
+# Запуск: WORKER_COUNT=4 python workers.py
+# Выигрыш — только при свободных ядрах: воркеры делят работу обработчиков, но платят за общие блокировки
+# и перечитывание базы. На одном ядре режим медленнее одного процесса (loadtest.py --scale 1,2,4:
+# x0.69 при 2 воркерах); на нескольких ядрах ускорение здесь не измерено — проверять --scale на целевой машине.
+
+API_TOKEN = os.getenv('API_TOKEN')
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", os.cpu_count() or 1))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Публичный https-адрес; пусто — polling
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.getenv("WEB_PORT", 8080))
+ALLOWED_UPDATES = ["message", "callback_query"]
+
+
+def route_key(data):
+    # chat_id апдейта (dict из JSON Telegram); у апдейтов без чата — id отправителя
+    for field in ("message", "callback_query"):
+        event = data.get(field)
+        if not event:
+            continue
+        message = event.get("message") if field == "callback_query" else event
+        if message:
+            return message["chat"]["id"]
+        return event["from"]["id"]
+    return 0
+
+
+def run_worker(index, count, inbox, ready):
+    # Переменные окружения — до импорта main: константы читаются при импорте
+    os.environ["WORKER_INDEX"] = str(index)
+    os.environ["WORKER_COUNT"] = str(count)
+    os.environ["STORAGE_MODE"] = "sqlite"
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Останавливает ведущий — через None в очереди, после сохранения
+    import main
+    asyncio.run(main.serve_worker(inbox, ready))
+
+
+def start_workers(count):
+    ctx = multiprocessing.get_context("spawn")
+    ready = ctx.Queue()
+    queues, processes = [], []
+    for index in range(count):
+        inbox = ctx.Queue()
+        process = ctx.Process(target=run_worker, args=(index, count, inbox, ready), name=f"worker-{index}")
+        process.start()
+        queues.append(inbox)
+        processes.append(process)
+        if index == 0:
+            # Первый воркер создаёт базу и переносит в неё JSON, остальные стартуют после него
+            ready.get()
+    for _ in range(count - 1):
+        ready.get()
+    return queues, processes
+
+
+def stop_workers(queues, processes):
+    for inbox in queues:
+        inbox.put(None)
+    for process in processes:
+        process.join()
+
+
+def dispatch(queues, data):
+    queues[chat_worker(route_key(data), len(queues))].put(data)
+
+
+async def poll(bot, queues):
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=ALLOWED_UPDATES)
+        except Exception as e:
+            logging.error(f"Ошибка получения апдейтов: {e}")
+            await asyncio.sleep(5)
+            continue
+        for update in updates:
+            dispatch(queues, update.model_dump(mode="json", exclude_none=True, by_alias=True))
+            offset = update.update_id + 1
+
+
+def webhook_handler(queues):
+    async def handle(request):
+        if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        dispatch(queues, await request.json())
+        return web.Response()
+    return handle
+
+
+async def lead(queues):
+    bot = Bot(token=API_TOKEN)
+    runner = None
+    try:
+        app = create_app()
+        if WEBHOOK_URL:
+            app.router.add_post(WEBHOOK_PATH, webhook_handler(queues))
+        runner = await keep_alive(app, WEB_HOST, WEB_PORT)
+        logging.warning(f"Ведущий процесс запущен, воркеров: {len(queues)}")
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=ALLOWED_UPDATES,
+                drop_pending_updates=True,
+            )
+            await asyncio.Event().wait()
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            await poll(bot, queues)
+    finally:
+        if runner:
+            await runner.cleanup()
+        await bot.session.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(processName)s - %(levelname)s - %(message)s")
+    queues, processes = start_workers(WORKER_COUNT)
+    try:
+        asyncio.run(lead(queues))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_workers(queues, processes)